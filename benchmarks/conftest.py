@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from benchmarks.corpus import generate_corpus, record_list_xml
+
+SIZES = (100, 10000, 100000)
+
+
+def pytest_addoption(parser):
+    parser.addoption('--max-items', type=int, default=100,
+                     help=('Largest synthetic corpus to benchmark, out of '
+                           '%s. Default is 100.' % ', '.join(map(str, SIZES))))
+
+
+def pytest_generate_tests(metafunc):
+    if 'size' in metafunc.fixturenames:
+        max_items = metafunc.config.getoption('max_items')
+        metafunc.parametrize('size', [s for s in SIZES if s <= max_items])
+
+
+@pytest.yield_fixture(scope='session')
+def corpus_root():
+    root = tempfile.mkdtemp(prefix='foist-corpus-')
+    yield root
+    shutil.rmtree(root)
+
+
+@pytest.fixture(scope='session')
+def corpora(corpus_root):
+    '''Synthetic exports with small PDFs, generated once per size.
+    '''
+    cache = {}
+
+    def _corpus(size):
+        if size not in cache:
+            directory = os.path.join(corpus_root, str(size))
+            generate_corpus(directory, size, pdf_size=1024)
+            cache[size] = directory
+        return cache[size]
+    return _corpus
+
+
+@pytest.fixture
+def corpus(corpora, size):
+    return corpora(size)
+
+
+@pytest.fixture
+def record_list(size):
+    return record_list_xml(size)
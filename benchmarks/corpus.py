@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''Generates synthetic DSpace thesis exports for benchmarking foist.
+
+Each item follows the structure of tests/fixtures/thesis/thesis.xml with
+randomized metadata, and comes with a PDF of a configurable size, optional
+extracted text and a row in the export's text encoding error log.
+'''
+from __future__ import absolute_import
+import os
+import random
+
+import click
+
+from foist.pipeline import thesis_set_list
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+TEMPLATE = os.path.join(CUR_DIR, '..', 'tests', 'fixtures', 'thesis',
+                        'thesis.xml')
+
+TAB_HEADER = ('Subdir', 'PDFBox err', 'No text old file', 'No text new file',
+              'Encoded text old file', 'Encoded text new file',
+              'Ligatures old', 'Ligatures new', 'Variance',
+              'Varience text')
+
+DEGREES = ('S.M.', 'Ph.D.', 'S.B.', 'M.Eng.', 'M.B.A.', 'Sc.D.', 'M.C.P.',
+           'S.M. and M.B.A.', 'Nucl.E. and S.M.', 'M.Arch.')
+
+DEPARTMENTS = ('Dept. of Electrical Engineering and Computer Science',
+               'Dept. of Mechanical Engineering', 'Dept. of Physics',
+               'Dept. of Urban Studies and Planning',
+               'Sloan School of Management', 'Dept. of Chemistry',
+               'Computation for Design and Optimization Program',
+               'Dept. of Nuclear Science and Engineering')
+
+WORDS = ('analysis', 'design', 'model', 'system', 'network', 'energy',
+         'optimization', 'structure', 'control', 'urban', 'quantum',
+         'materials', 'policy', 'learning', 'dynamics', 'flow', 'signal',
+         'protein', 'market', 'theory', 'of', 'the', 'and', 'for', 'in')
+
+NAMES = ('Zhang', 'Smith', 'Garcia', 'Nguyen', 'Okafor', 'Kowalski',
+         'Tanaka', 'Haddad', 'Silva', 'Novak', 'Murphy', 'Ivanova')
+
+
+def generate_corpus(directory, count, pdf_size=200 * 1024, text=True,
+                    error_rate=0.1, seed=0):
+    '''Write count synthetic thesis items to directory, along with a
+    text_errors.tab log with a row for every item. Returns the item names.
+    '''
+    rng = random.Random(seed)
+    with open(TEMPLATE) as f:
+        template = f.read()
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    with open(os.path.join(directory, 'text_errors.tab'), 'w') as tab:
+        tab.write('\t'.join(TAB_HEADER) + '\n')
+        for i in range(count):
+            name = 'thesis-%06d' % i
+            item_dir = os.path.join(directory, name)
+            os.makedirs(item_dir, exist_ok=True)
+            with open(os.path.join(item_dir, name + '.xml'), 'w') as f:
+                f.write(mets_xml(template, 100000 + i, pdf_size, rng))
+            with open(os.path.join(item_dir, name + '.pdf'), 'wb') as f:
+                f.write(pdf_bytes(pdf_size, rng))
+            if text:
+                with open(os.path.join(item_dir, name + '-new.txt'),
+                          'w') as f:
+                    f.write(_sentence(rng, 200) + '\n')
+            tab.write(tab_row(name, error_rate, rng) + '\n')
+            names.append(name)
+    return names
+
+
+def mets_xml(template, identifier, pdf_size, rng):
+    '''Return the template METS record with randomized metadata for the item
+    with the given handle identifier.
+    '''
+    year = str(rng.randint(1950, 2017))
+    statement = 'Thesis (%s)--Massachusetts Institute of Technology, %s, %s.' \
+        % (rng.choice(DEGREES), rng.choice(DEPARTMENTS), year)
+    repls = (('1721.1/39208', '1721.1/%s' % identifier),
+             ('1721.1%2F39208', '1721.1%%2F%s' % identifier),
+             ('Thesis (S.M. and M.B.A.)--Massachusetts Institute of '
+              'Technology, Computation for Design and Optimization Program, '
+              '2006.', statement),
+             ('>2006<', '>%s<' % year),
+             ('Sample Title.', _sentence(rng, 8).capitalize() + '.'),
+             ('Alternative Title.', _sentence(rng, 5).capitalize() + '.'),
+             ('Author One.', _name(rng)), ('Author Two.', _name(rng)),
+             ('Advisor One.', _name(rng)), ('Advisor Two.', _name(rng)),
+             ('<mods:abstract>Sample</mods:abstract>',
+              '<mods:abstract>%s</mods:abstract>' % _sentence(rng, 150)),
+             ('109 p.', '%s p.' % rng.randint(20, 400)),
+             ('6476921', str(pdf_size)))
+    for old, new in repls:
+        template = template.replace(old, new)
+    return template
+
+
+def pdf_bytes(size, rng):
+    '''Return size bytes shaped like a PDF file, with a header, an
+    incompressible body and a trailer.
+    '''
+    header = b'%PDF-1.4\n'
+    trailer = b'\n%%EOF\n'
+    body = max(0, size - len(header) - len(trailer))
+    return header + rng.getrandbits(8 * body).to_bytes(body, 'little') + \
+        trailer
+
+
+def record_list_xml(count, seed=0):
+    '''Return an OAI-PMH ListIdentifiers response listing count items, most
+    of them in thesis sets.
+    '''
+    rng = random.Random(seed)
+    set_specs = sorted(thesis_set_list())
+    headers = []
+    for i in range(count):
+        sets = rng.sample(set_specs, rng.randint(0, 3))
+        headers.append(
+            '<header><identifier>oai:dspace.mit.edu:1721.1/%s</identifier>'
+            '<datestamp>2017-04-26T06:16:23Z</datestamp>%s</header>' %
+            (100000 + i, ''.join('<setSpec>%s</setSpec>' % s for s in sets)))
+    return ('<?xml version="1.0" encoding="UTF-8"?><OAI-PMH '
+            'xmlns="http://www.openarchives.org/OAI/2.0/"><ListIdentifiers>'
+            '%s</ListIdentifiers></OAI-PMH>' % ''.join(headers))
+
+
+def tab_row(name, error_rate, rng):
+    flags = ['1' if rng.random() < error_rate else '0'
+             for c in TAB_HEADER[1:-2]]
+    return '\t'.join([name] + flags + ['0', ''])
+
+
+def _name(rng):
+    return '%s, %s.' % (rng.choice(NAMES), rng.choice('ABCDEFGHJKLMNPRS'))
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+
+@click.command()
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('-n', '--count', default=100, type=click.IntRange(min=1),
+              help='Number of items to generate. Default is 100.')
+@click.option('-s', '--pdf-size', default=200 * 1024,
+              type=click.IntRange(min=0),
+              help='Size of each PDF file in bytes. Default is 200 KB.')
+@click.option('--no-text', is_flag=True,
+              help='Do not generate extracted text files.')
+@click.option('-e', '--error-rate', default=0.1, type=float,
+              help=('Probability of each text error flag being set for an '
+                    'item. Default is 0.1.'))
+@click.option('--seed', default=0, type=int)
+def main(directory, count, pdf_size, no_text, error_rate, seed):
+    '''Generate a synthetic export of COUNT thesis items in DIRECTORY.
+    '''
+    generate_corpus(directory, count, pdf_size, not no_text, error_rate,
+                    seed)
+    click.echo('%s items written to %s' % (count, directory))
+
+
+if __name__ == '__main__':
+    main()
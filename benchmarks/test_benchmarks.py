@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import subprocess
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+
+from click.testing import CliRunner
+
+from foist import parse_text_encoding_errors, Thesis
+from foist.cli import main
+from foist.pipeline import parse_record_list
+
+FIELDS = ('abstract', 'advisor', 'alt_title', 'author', 'copyright_date',
+          'degree', 'degree_statement', 'handle', 'issue_date', 'notes',
+          'title')
+
+
+def _theses(corpus):
+    errors = parse_text_encoding_errors(os.path.join(corpus,
+                                                     'text_errors.tab'))
+    theses = []
+    for name in sorted(os.listdir(corpus)):
+        xml_file = os.path.join(corpus, name, name + '.xml')
+        if os.path.isfile(xml_file):
+            mets = ET.parse(xml_file).getroot()
+            theses.append(Thesis(name, mets, ['Dept. of Testing'],
+                                 errors.get(name)))
+    return theses
+
+
+def _rounds(size):
+    return 5 if size <= 100 else 1
+
+
+def test_thesis_fields(benchmark, corpus, size):
+    theses = _theses(corpus)
+
+    def _extract():
+        for thesis in theses:
+            for field in FIELDS:
+                getattr(thesis, field)
+    benchmark.pedantic(_extract, rounds=_rounds(size))
+
+
+def test_get_metadata(benchmark, corpus, size):
+    theses = _theses(corpus)
+
+    def _serialize():
+        for thesis in theses:
+            thesis.get_metadata()
+    benchmark.pedantic(_serialize, rounds=_rounds(size))
+
+
+def test_parse_record_list(benchmark, record_list, size):
+    records = benchmark.pedantic(lambda: list(parse_record_list(record_list)),
+                                 rounds=_rounds(size))
+    assert len(records) == size
+
+
+def test_parse_text_encoding_errors(benchmark, corpus, size):
+    tab_file = os.path.join(corpus, 'text_errors.tab')
+    errors = benchmark.pedantic(parse_text_encoding_errors, (tab_file,),
+                                rounds=_rounds(size))
+    assert len(errors) == size
+
+
+def test_process_metadata(benchmark, corpus, size):
+    runner = CliRunner()
+    bundle = os.path.join(tempfile.mkdtemp(), 'bundle.db')
+
+    def _process():
+        if os.path.exists(bundle):
+            os.remove(bundle)
+        return runner.invoke(main, ['--log-file', '', 'process_metadata',
+                                    corpus, 'Dept. of Testing', '-b',
+                                    bundle])
+    result = benchmark.pedantic(_process, rounds=_rounds(size))
+    assert result.exit_code == 0
+
+
+def test_cli_startup(benchmark):
+    benchmark.pedantic(subprocess.check_call,
+                       ([sys.executable, '-m', 'foist.cli', '--help'],),
+                       {'stdout': subprocess.DEVNULL}, rounds=5)
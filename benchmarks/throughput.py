@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''Measures end-to-end throughput of batch_upload_theses and
+ingest_new_theses against the local Fedora, DSpace and Tika stand-in
+servers, at a range of worker counts.
+
+For each run it reports items per second and the number of requests and
+TCP connections each server received, which shows how well connections
+are reused.
+'''
+from __future__ import absolute_import
+import shutil
+import tempfile
+import time
+
+import click
+from click.testing import CliRunner
+from tika import tika
+
+from benchmarks.corpus import generate_corpus
+from foist import cli
+from tests.servers import DSpaceServer, FedoraServer, TikaServer
+
+ROW = '%-8s %7s %7s %9s %10s %12s'
+
+
+def run_batch_upload(corpus, count, workers, backend, options):
+    with FedoraServer(**options) as fedora:
+        elapsed = _invoke(['batch_upload_theses', corpus, '-f', fedora.url,
+                           '-w', str(workers), '--backend', backend])
+    return elapsed, {'fedora': fedora.counts}
+
+
+def run_ingest(count, workers, pdf_size, backend, options):
+    endpoint = tika.ServerEndpoint
+    with FedoraServer(**options) as fedora, \
+            DSpaceServer(count, pdf_size=pdf_size, **options) as dspace, \
+            TikaServer(**options) as tika_server:
+        tika.ServerEndpoint = tika_server.url
+        try:
+            elapsed = _invoke(['ingest_new_theses', dspace.url,
+                               'oai:dspace.mit.edu:1721.1/', '-f',
+                               fedora.url, '-w', str(workers), '--backend',
+                               backend])
+        finally:
+            tika.ServerEndpoint = endpoint
+    return elapsed, {'fedora': fedora.counts, 'dspace': dspace.counts,
+                     'tika': tika_server.counts}
+
+
+def _invoke(args):
+    start = time.perf_counter()
+    result = CliRunner().invoke(cli.main, ['--log-file', ''] + args)
+    elapsed = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise click.ClickException('%s failed: %r' % (args[0],
+                                                      result.exception))
+    return elapsed
+
+
+def _report(command, count, workers, elapsed, counts):
+    for server, c in sorted(counts.items()):
+        click.echo(ROW % (command, workers, server, c['requests'],
+                          c['connections'], ''))
+    click.echo(ROW % (command, workers, 'total', '', '',
+                      '%.1f' % (count / elapsed)))
+
+
+@click.command()
+@click.option('-n', '--count', default=100, type=click.IntRange(min=1),
+              help='Number of items per run. Default is 100.')
+@click.option('-w', '--workers', multiple=True, type=click.IntRange(min=1),
+              help='Worker count to run with. Repeat for several runs. '
+                   'Default is 1, 4 and 16.')
+@click.option('-c', '--command', type=click.Choice(['batch', 'ingest',
+                                                    'all']),
+              default='all', help='Commands to benchmark. Default is all.')
+@click.option('-s', '--pdf-size', default=200 * 1024,
+              type=click.IntRange(min=0),
+              help='Size of each PDF file in bytes. Default is 200 KB.')
+@click.option('-l', '--latency', default=0.0, type=float,
+              help='Seconds added to every request. Default is 0.')
+@click.option('-e', '--error-rate', default=0.0, type=float,
+              help='Fraction of requests answered with 503. Default is 0.')
+@click.option('-b', '--bandwidth', default=None, type=int,
+              help='Bytes per second each request body and response is '
+                   'limited to. Default is unlimited.')
+@click.option('--backend', default='threads',
+              type=click.Choice(['threads', 'asyncio']),
+              help='Backend the commands run with. Default is threads.')
+def main(count, workers, command, pdf_size, latency, error_rate, bandwidth,
+         backend):
+    '''Report items per second for batch_upload_theses and
+    ingest_new_theses against local stand-in servers.
+    '''
+    options = {'latency': latency, 'error_rate': error_rate,
+               'bandwidth': bandwidth}
+    click.echo(ROW % ('command', 'workers', 'server', 'requests',
+                      'connections', 'items/s'))
+    corpus = tempfile.mkdtemp(prefix='foist-corpus-')
+    try:
+        if command in ('batch', 'all'):
+            generate_corpus(corpus, count, pdf_size=pdf_size)
+            _invoke(['process_metadata', corpus, 'Dept. of Testing'])
+            for w in workers or (1, 4, 16):
+                _report('batch', count, w,
+                        *run_batch_upload(corpus, count, w, backend,
+                                          options))
+        if command in ('ingest', 'all'):
+            for w in workers or (1, 4, 16):
+                _report('ingest', count, w,
+                        *run_ingest(count, w, pdf_size, backend, options))
+    finally:
+        shutil.rmtree(corpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,25 @@
 FOIST
 """
 
-from .app import (create_container, initialize_custom_prefixes,
-                  parse_text_encoding_errors, Thesis, transaction,
-                  upload_file, update_metadata, upload_thesis)
-
+import importlib
 
 __version__ = '0.1.0'
+
+# Names re-exported from foist.app, which is only imported when one of them
+# is first used, as it loads rdflib
+_app_exports = ('create_container', 'initialize_custom_prefixes',
+                'parse_text_encoding_errors', 'Thesis', 'transaction',
+                'upload_content', 'upload_file', 'update_metadata',
+                'upload_thesis')
+
+__all__ = list(_app_exports)
+
+
+def __getattr__(name):
+    if name in _app_exports:
+        return getattr(importlib.import_module('foist.app'), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_app_exports))
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import asyncio
+from contextlib import asynccontextmanager
+import contextvars
+from functools import partial, wraps
+import logging
+import os
+from queue import Queue
+import tempfile
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from foist import http, metrics
+from foist.app import create_has_file_sparql
+from foist.pipeline import CHUNK_SIZE, is_thesis, RECORD_ERRORS
+from foist.workers import Backoff
+
+# Coroutine versions of the functions of the same names in foist.app and
+# foist.pipeline, and of the per-item work of the upload and ingest
+# commands, for their asyncio backend.
+# Responses are returned as requests.Response objects and failures raised as
+# requests exceptions, so callers handle them as with the thread backend.
+# Requests are counted in the same metrics and seen by the same observers as
+# those sent by foist.http, but are not traced.
+
+log = logging.getLogger(__name__)
+
+_session = contextvars.ContextVar('session', default=None)
+
+
+@asynccontextmanager
+async def session(limit=100):
+    '''Open the aiohttp session used by every request made in the block,
+    keeping up to limit connections open.
+    '''
+    connector = aiohttp.TCPConnector(limit=limit)
+    async with aiohttp.ClientSession(connector=connector) as s:
+        token = _session.set(s)
+        try:
+            yield s
+        finally:
+            _session.reset(token)
+
+
+async def request(method, url, kind=None, auth=None, timeout=None,
+                  **kwargs):
+    '''Send an HTTP request in the current session and return the response
+    as a requests.Response, with its body read.
+
+    Timeouts default to those configured in foist.http for the kind of
+    request, as for http.request.
+    '''
+    kind = kind or ('head' if method == 'HEAD' else 'metadata')
+    connect, read = timeout or http.timeouts[kind]
+    if auth is not None:
+        kwargs['auth'] = aiohttp.BasicAuth(*auth)
+    start = time.monotonic()
+    try:
+        async with _session.get().request(
+                method, url, timeout=aiohttp.ClientTimeout(
+                    sock_connect=connect, sock_read=read), **kwargs) as r:
+            content = await r.read()
+    except aiohttp.ClientError as e:
+        http._record(method, kind, url, time.monotonic() - start, None)
+        raise requests.exceptions.ConnectionError(e)
+    except asyncio.TimeoutError as e:
+        http._record(method, kind, url, time.monotonic() - start, None)
+        raise requests.exceptions.Timeout(e)
+    latency = time.monotonic() - start
+    http.latencies[kind].add(latency)
+    http._record(method, kind, url, latency, r.status)
+    return _response(r, content)
+
+
+def run_in_executor(func, *args, **kwargs):
+    '''Run a blocking or CPU-bound call in the event loop's thread pool,
+    returning a future for its result.
+    '''
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def map_concurrent(func, items, workers=1):
+    '''Call the coroutine function func on each of the given items, at most
+    workers at a time, yielding (item, result) tuples as each call
+    completes.
+
+    The calls run on an event loop in a background thread, sharing one
+    session. If a call raises, no more calls are started and the exception
+    is raised here.
+    '''
+    results = Queue()
+
+    def _run():
+        try:
+            asyncio.run(_map(func, items, workers, results))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    while True:
+        r = results.get()
+        if r is None:
+            break
+        if isinstance(r, Exception):
+            thread.join()
+            raise r
+        yield r
+    thread.join()
+
+
+async def _map(func, items, workers, results):
+    items = iter(items)
+
+    async def _worker():
+        for item in items:
+            results.put((item, await func(item)))
+
+    # Uploading an item's files in parallel takes two connections per item
+    async with session(limit=workers * 2):
+        await asyncio.gather(*(_worker() for i in range(workers)))
+
+
+@asynccontextmanager
+async def transaction(fedora_uri, auth=None):
+    '''Starts a Fedora transaction, yields a location header, commits and
+    closes the transaction.
+    '''
+    r = await request('POST', fedora_uri + 'fcr:tx', auth=auth)
+    r.raise_for_status()
+    location = r.headers['Location']
+    try:
+        yield location
+    except Exception:
+        await request('POST', location + '/fcr:tx/fcr:rollback', auth=auth)
+        raise
+    with _stage('commit'):
+        r = await request('POST', location + '/fcr:tx/fcr:commit',
+                          auth=auth)
+    r.raise_for_status()
+
+
+async def create_container(uri, turtle, auth=None):
+    '''Create basic container for an item.
+    '''
+    headers = {'Content-Type': 'text/turtle; charset=utf-8'}
+    r = await request('PUT', uri, headers=headers, auth=auth, data=turtle)
+    r.raise_for_status()
+    return r
+
+
+async def upload_content(uri, content_to_upload, mimetype, auth=None):
+    '''Add content to a given container uri. Content may be a string, bytes,
+    or a readable binary file object, which is streamed in chunks rather than
+    read into memory.
+    '''
+    headers = {'Content-Type': mimetype}
+    if hasattr(content_to_upload, 'read'):
+        # aiohttp closes file objects it sends, which would stop a retried
+        # upload from reading the file again
+        start = content_to_upload.tell()
+        headers['Content-Length'] = str(
+            content_to_upload.seek(0, os.SEEK_END) - start)
+        content_to_upload.seek(start)
+        content_to_upload = _chunks(content_to_upload)
+    r = await request('PUT', uri, 'binary', headers=headers, auth=auth,
+                      data=content_to_upload)
+    r.raise_for_status()
+    return r.status_code
+
+
+async def _chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def upload_file(uri, file_path, mimetype, auth=None):
+    '''Add a file to a given container uri, streaming it from disk as the
+    request body.
+    '''
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        status = await upload_content(uri, f, mimetype, auth=auth)
+    metrics.registry.inc('foist_stage_bytes_total', size, stage='upload')
+    return status
+
+
+async def update_metadata(uri, sparql, auth=None):
+    '''Update metadata for a single item in Fedora, given the item's URI and a
+    SPARQL update query.
+    '''
+    headers = {'Content-Type': 'application/sparql-update'}
+    r = await request('PATCH', uri, headers=headers, auth=auth, data=sparql)
+    r.raise_for_status()
+    return r.status_code
+
+
+async def upload_thesis(fedora_uri, collection_name, handle, turtle,
+                        pdf_file, pdf_sparql, text_content=None,
+                        text_sparql=None, auth=None, text_file=None,
+                        backoff=None, parallel_files=False):
+    '''Upload a single thesis item and its files to Fedora, as
+    foist.app.upload_thesis does, returning 'Success', 'Exists' or
+    'Failure'.
+    '''
+    backoff = backoff or Backoff()
+    files = [(handle + '.pdf/', pdf_file, None, 'application/pdf',
+              pdf_sparql)]
+    if text_content or text_file:
+        files.append((handle + '.txt/', text_file, text_content,
+                      'text/plain', text_sparql))
+    with _stage('upload_thesis'):
+        return await _upload_thesis(fedora_uri, collection_name, handle,
+                                    turtle, files, text_content, auth,
+                                    backoff, parallel_files)
+
+
+async def _upload_thesis(fedora_uri, collection_name, handle, turtle, files,
+                         text_content, auth, backoff, parallel_files):
+    attempt = 0
+    while True:
+        if hasattr(text_content, 'seek'):
+            text_content.seek(0)
+        try:
+            async with transaction(fedora_uri, auth=auth) as t:
+                item_uri = t + '/' + collection_name + '/' + handle + '/'
+                await create_container(item_uri, turtle, auth=auth)
+                uploads = (_upload_file_and_metadata(
+                    item_uri + name, path, content, mimetype, sparql,
+                    auth=auth)
+                    for name, path, content, mimetype, sparql in files)
+                if parallel_files:
+                    await asyncio.gather(*uploads)
+                else:
+                    for upload in uploads:
+                        await upload
+                # Link the files to the item one at a time, as concurrent
+                # updates to the same resource conflict
+                for name, path, content, mimetype, sparql in files:
+                    u = (fedora_uri + collection_name + '/' + handle + '/' +
+                         name)
+                    await update_metadata(item_uri, create_has_file_sparql(u),
+                                          auth=auth)
+            return 'Success'
+        except requests.exceptions.HTTPError as e:
+            if str(e).startswith('409'):
+                return 'Exists'
+            if not http.is_retryable(e):
+                log.warning('Upload of %s failed, not retrying', handle)
+                log.debug(e)
+                return 'Failure'
+            error = e
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            error = e
+        attempt += 1
+        if attempt >= backoff.attempts:
+            log.debug(error)
+            return 'Failure'
+        log.warning('Upload attempt failed, retrying %s', handle)
+        log.debug(error)
+        await asyncio.sleep(backoff.delay(attempt))
+
+
+async def upload_item(item, metadata, sync, fedora_uri, collection_name,
+                      auth=None, parallel_files=False):
+    '''Upload an exported thesis item as batch_upload_theses does,
+    returning 'Missing' if its metadata or PDF is missing. The command's
+    blocking metadata function, which returns the item's (turtle,
+    pdf_sparql, text_sparql), and sync function, which is given the upload
+    result, are run in the event loop's thread pool.
+    '''
+    try:
+        turtle, pdf_sparql, text_sparql = await run_in_executor(metadata,
+                                                                item)
+    except (FileNotFoundError, KeyError):
+        return 'Missing'
+    if item.pdf_file is None:
+        return 'Missing'
+    u = await upload_thesis(fedora_uri, collection_name, item.name, turtle,
+                            item.pdf_file, pdf_sparql,
+                            text_sparql=text_sparql, auth=auth,
+                            text_file=item.text_file,
+                            parallel_files=parallel_files)
+    return await run_in_executor(sync, item, u, turtle, pdf_sparql,
+                                 text_sparql)
+
+
+async def ingest_item(item, dspace_oai_uri, dspace_oai_identifier,
+                      metadata_format, fedora_uri, thesis, sync, extract,
+                      auth=None, delta=False, parallel_files=False,
+                      stopping=None):
+    '''Ingest a harvested record header as ingest_new_theses does,
+    returning a (result, missing_text) tuple. The command's blocking thesis,
+    sync and extract functions are run in the event loop's thread pool.
+    Records that cannot be ingested are returned as 'Failure'.
+    '''
+    if stopping is not None and stopping.is_set():
+        return 'Stopped', False
+    try:
+        return await _ingest_record(item, dspace_oai_uri,
+                                    dspace_oai_identifier, metadata_format,
+                                    fedora_uri, thesis, sync, extract, auth,
+                                    delta, parallel_files)
+    except RECORD_ERRORS as e:
+        log.debug(e)
+        return 'Failure', False
+
+
+async def _ingest_record(item, dspace_oai_uri, dspace_oai_identifier,
+                         metadata_format, fedora_uri, thesis, sync, extract,
+                         auth, delta, parallel_files):
+    log.debug('Checking item %s', item['handle'])
+    if not is_thesis(item['sets']):
+        return 'Not a thesis', False
+    in_fedora = await is_in_fedora(item['handle'], fedora_uri, 'theses',
+                                   auth=auth)
+    if in_fedora and not delta:
+        return 'In Fedora', False
+    log.debug('Processing item %s', item['handle'])
+    metadata = await get_record(dspace_oai_uri, dspace_oai_identifier,
+                                item['identifier'], metadata_format)
+    t, pdf_url = await run_in_executor(thesis, item, metadata)
+
+    with tempfile.NamedTemporaryFile() as pdf_file, \
+            tempfile.TemporaryFile() as text_file:
+        await download_file(pdf_url, pdf_file)
+        if in_fedora:
+            return await run_in_executor(sync, item, t, pdf_file, text_file)
+        text_content, text_sparql, turtle = await run_in_executor(
+            extract, t, pdf_file, text_file)
+        u = await upload_thesis(
+            fedora_uri, 'theses', item['handle'], turtle, pdf_file.name,
+            t.create_file_sparql_update('.pdf'), text_content=text_content,
+            text_sparql=text_sparql, auth=auth,
+            parallel_files=parallel_files)
+    return u, text_content is None
+
+
+def retrying(func):
+    '''Coroutine version of http.retrying, retrying an idempotent coroutine
+    function with a Backoff when it fails with a temporary error.
+    '''
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        backoff = Backoff()
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except requests.exceptions.HTTPError as e:
+                if not http.is_retryable(e):
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+            attempt += 1
+            if attempt >= backoff.attempts:
+                raise error
+            log.warning('%s failed, retrying', func.__name__)
+            log.debug(error)
+            await asyncio.sleep(backoff.delay(attempt))
+    return wrapper
+
+
+@retrying
+async def is_in_fedora(handle, fedora_uri, parent_container, auth=None):
+    '''Returns True if given thesis item is already in the given Fedora
+    repository, otherwise returns False.
+    '''
+    url = fedora_uri + parent_container + '/' + handle
+    r = await request('HEAD', url, auth=auth, allow_redirects=False)
+    if r.status_code == 200:
+        return True
+    elif r.status_code == 404:
+        return False
+    else:
+        raise requests.exceptions.HTTPError(r, response=r)
+
+
+@retrying
+async def get_record(dspace_oai_uri, dspace_oai_identifier, identifier,
+                     metadata_format):
+    '''Gets metadata record for a single item in OAI-PMH repository in
+    specified metadata format.
+    '''
+    params = {'verb': 'GetRecord',
+              'identifier': dspace_oai_identifier + identifier,
+              'metadataPrefix': metadata_format}
+    with _stage('get_record'):
+        r = await request('GET', dspace_oai_uri, params=params)
+    r.raise_for_status()
+    return r.text
+
+
+async def download_file(url, out_file):
+    '''Downloads the file at url into an open binary out_file, streaming it
+    in chunks. Returns the number of bytes written.
+
+    Temporary failures are retried, writing the file again from the position
+    out_file was at when called.
+    '''
+    position = out_file.tell()
+    with _stage('download_pdf'):
+        size = await _download_file(url, out_file, position)
+    out_file.flush()
+    metrics.registry.inc('foist_stage_bytes_total', size,
+                         stage='download_pdf')
+    return size
+
+
+@retrying
+async def _download_file(url, out_file, position):
+    out_file.seek(position)
+    out_file.truncate()
+    connect, read = http.timeouts['binary']
+    timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+    start = time.monotonic()
+    size = 0
+    try:
+        async with _session.get().get(url, timeout=timeout) as r:
+            if r.status < 400:
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    out_file.write(chunk)
+                    size += len(chunk)
+            response = _response(r, b'')
+    except aiohttp.ClientError as e:
+        http._record('GET', 'binary', url, time.monotonic() - start, None)
+        raise requests.exceptions.ConnectionError(e)
+    except asyncio.TimeoutError as e:
+        http._record('GET', 'binary', url, time.monotonic() - start, None)
+        raise requests.exceptions.Timeout(e)
+    http._record('GET', 'binary', url, time.monotonic() - start,
+                 response.status_code)
+    response.raise_for_status()
+    return size
+
+
+async def _upload_file_and_metadata(uri, path, content, mimetype, sparql,
+                                    auth=None):
+    if path:
+        await upload_file(uri, path, mimetype, auth=auth)
+    else:
+        await upload_content(uri, content, mimetype, auth=auth)
+    await update_metadata(uri + 'fcr:metadata', sparql, auth=auth)
+
+
+def _response(r, content):
+    response = requests.Response()
+    response.status_code = r.status
+    response.reason = r.reason
+    response.url = str(r.url)
+    response.headers = CaseInsensitiveDict(r.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = content
+    return response
+
+
+def _stage(name):
+    # metrics.stage would trace and profile the block on this thread, which
+    # is shared by every coroutine
+    return metrics.registry.timer('foist_stage_seconds', stage=name)
@@ -4,13 +4,17 @@ from contextlib import contextmanager
 from functools import reduce
 import csv
 import logging
+import os
 import re
 
 
 import rdflib
 import requests
 
+from foist import http, metrics, tracing
+from foist.error_index import has_error_flag
 from foist.namespaces import BIBO, DCTERMS, DCTYPE, LOCAL, MODS, MSL, PCDM, RDF
+from foist.workers import Backoff, map_concurrent
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +34,9 @@ degrees = ['B.Arch.', 'B.C.P.', 'B.S.', 'C.P.H.', 'Chem.E.', 'Civ.E.',
 class Thesis(object):
     '''A thesis object representing a single thesis intellectual entity with
     all its associated metadata.
+
+    Text errors may be given either as the item's row from
+    parse_text_encoding_errors or as its flags from a TextErrorIndex.
     '''
     def __init__(self, name, mets, departments, text_errors=None):
         self.name = name
@@ -194,9 +201,29 @@ class Thesis(object):
             result = None
         return result
 
+    # All predicates get_metadata can add to an item's metadata graph
+    metadata_predicates = (BIBO.handle, DCTERMS.abstract, DCTERMS.creator,
+                           DCTERMS.dateCopyrighted, DCTERMS.dateIssued,
+                           DCTERMS.publisher, DCTERMS.rights, DCTERMS.title,
+                           DCTERMS.type, LOCAL.degree_statement,
+                           LOCAL.encoded_text, LOCAL.handle_part,
+                           LOCAL.ligature_errors, LOCAL.no_full_text,
+                           MODS.note, MSL.associatedDepartment,
+                           MSL.degreeGrantedForCompletion, MSL.reviewedBy,
+                           RDF.type)
+
+    @metrics.timed('get_metadata')
     def get_metadata(self, serialization='turtle'):
+        m = self.metadata_graph()
+        if serialization == 'turtle':
+            return m.serialize(format='turtle')
+
+    def metadata_graph(self, uri=''):
+        '''Return the thesis metadata as an rdflib Graph about the given
+        subject uri, by default the relative URI <> used in Fedora requests.
+        '''
         m = rdflib.Graph()
-        s = rdflib.URIRef('')
+        s = rdflib.URIRef(uri)
 
         def _add_metadata_field(p, obj, is_uri=False):
             if isinstance(obj, list) or isinstance(obj, set):
@@ -245,9 +272,7 @@ class Thesis(object):
         _add_metadata_field(RDF.type, self.rdf_type, is_uri='uri')
         _add_metadata_field(DCTERMS.rights, self.rights_statement)
         _add_metadata_field(DCTERMS.title, self.title)
-
-        if serialization == 'turtle':
-            return m.serialize(format='turtle')
+        return m
 
     def create_file_sparql_update(self, file_ext):
         query = ('PREFIX dcterms: <http://purl.org/dc/terms/> PREFIX pcdm: '
@@ -273,13 +298,14 @@ class Thesis(object):
         return query
 
     def _has_error(self, error):
-        if self.errors[error] == '1':
+        if has_error_flag(self.errors, error):
             return True
 
     def _has_full_text_error(self):
         s = self.errors
-        if (s['PDFBox err'] == '1' or (s['No text old file'] == '1' and
-                                       s['No text new file'] == '1')):
+        if (has_error_flag(s, 'PDFBox err') or
+                (has_error_flag(s, 'No text old file') and
+                 has_error_flag(s, 'No text new file'))):
             return True
 
 
@@ -301,17 +327,19 @@ def transaction(fedora_uri, auth=None):
     closes the transaction.
     '''
     uri = fedora_uri + 'fcr:tx'
-    r = requests.post(uri, auth=auth)
+    r = http.request('POST', uri, auth=auth)
+    r.raise_for_status()
     location = r.headers['Location']
     try:
         yield location
     except Exception as e:
         uri = location + '/fcr:tx/fcr:rollback'
-        r = requests.post(uri, auth=auth)
+        r = http.request('POST', uri, auth=auth)
         raise(e)
     else:
         uri = location + '/fcr:tx/fcr:commit'
-        r = requests.post(uri, auth=auth)
+        with metrics.stage('commit'):
+            r = http.request('POST', uri, auth=auth)
         r.raise_for_status()
 
 
@@ -319,29 +347,41 @@ def create_container(uri, turtle, auth=None):
     '''Create basic container for an item.
     '''
     headers = {'Content-Type': 'text/turtle; charset=utf-8'}
-    r = requests.put(uri, headers=headers, auth=auth, data=turtle)
+    r = http.request('PUT', uri, headers=headers, auth=auth,
+                     data=turtle)
     r.raise_for_status()
     return r
 
 
 def upload_content(uri, content_to_upload, mimetype, auth=None):
-    '''Add content in string or bytes format to a given container uri.
+    '''Add content to a given container uri. Content may be a string, bytes,
+    or a readable binary file object, which is streamed in chunks rather than
+    read into memory.
     '''
     headers = {'Content-Type': mimetype}
-    r = requests.put(uri, headers=headers, auth=auth,
+    r = http.request('PUT', uri, 'binary', headers=headers, auth=auth,
                      data=content_to_upload)
     r.raise_for_status()
     return r.status_code
 
 
 def upload_file(uri, file_path, mimetype, auth=None):
-    '''Add a file to a given container uri.
+    '''Add a file to a given container uri, streaming it from disk as the
+    request body.
     '''
-    headers = {'Content-Type': mimetype}
-    f = {'file': open(file_path, 'rb')}
-    r = requests.put(uri, headers=headers, auth=auth, files=f)
-    r.raise_for_status()
-    return r.status_code
+    size = os.path.getsize(file_path)
+    with tracing.span('upload_file', bytes=size), \
+            open(file_path, 'rb') as f:
+        status = upload_content(uri, f, mimetype, auth=auth)
+    metrics.registry.inc('foist_stage_bytes_total', size, stage='upload')
+    return status
+
+
+def create_has_file_sparql(file_uri):
+    '''Create a SPARQL update query relating an item to one of its files.
+    '''
+    return ('PREFIX pcdm: <http://pcdm.org/models#> INSERT { <> pcdm:hasFile '
+            '<' + file_uri + '> . } WHERE { }')
 
 
 def update_metadata(uri, sparql, auth=None):
@@ -349,7 +389,8 @@ def update_metadata(uri, sparql, auth=None):
     SPARQL update query.
     '''
     headers = {'Content-Type': 'application/sparql-update'}
-    r = requests.patch(uri, headers=headers, auth=auth, data=sparql)
+    r = http.request('PATCH', uri, headers=headers, auth=auth,
+                     data=sparql)
     r.raise_for_status()
     return r.status_code
 
@@ -375,56 +416,85 @@ def initialize_custom_prefixes(fedora_uri, auth=None):
             mods:test 'test' ;
             msl:test 'test' .
         }'''
-    r1 = requests.put(uri, auth=auth)
+    r1 = http.request('PUT', uri, auth=auth)
     r1.raise_for_status()
-    r2 = requests.patch(uri, headers=headers, auth=auth,
+    r2 = http.request('PATCH', uri, headers=headers, auth=auth,
                         data=data)
     r2.raise_for_status()
-    r3 = requests.delete(uri, auth=auth)
+    r3 = http.request('DELETE', uri, auth=auth)
     r3.raise_for_status()
-    r4 = requests.delete(uri+'/fcr:tombstone', auth=auth)
+    r4 = http.request('DELETE', uri+'/fcr:tombstone', auth=auth)
     r4.raise_for_status()
 
 
-# Upload a single thesis item and its files to Fedora
+# Upload a single thesis item and its files to Fedora. Text can be given
+# either as text_content (bytes or a binary file object) or as the path to a
+# text_file, which is streamed from disk. With parallel_files the PDF and text
+# files are uploaded concurrently within the transaction. Failed attempts are
+# retried according to the given Backoff policy.
+@metrics.timed('upload_thesis')
 def upload_thesis(fedora_uri, collection_name, handle, turtle, pdf_file,
-                  pdf_sparql, text_content=None, text_sparql=None, auth=None):
-    retries = 0
-    while retries < 5:
+                  pdf_sparql, text_content=None, text_sparql=None, auth=None,
+                  text_file=None, backoff=None, parallel_files=False):
+    backoff = backoff or Backoff()
+    files = [(handle + '.pdf/', pdf_file, None, 'application/pdf',
+              pdf_sparql)]
+    if text_content or text_file:
+        files.append((handle + '.txt/', text_file, text_content,
+                      'text/plain', text_sparql))
+    workers = len(files) if parallel_files else 1
+    attempt = 0
+    while True:
+        if hasattr(text_content, 'seek'):
+            text_content.seek(0)
         try:
             with transaction(fedora_uri, auth=auth) as t:
                 parent_uri = t + '/' + collection_name + '/'
                 item_uri = parent_uri + handle + '/'
                 create_container(item_uri, turtle, auth=auth)
 
-                pdf_uri = item_uri + handle + '.pdf/'
-                upload_file(pdf_uri, pdf_file, 'application/pdf', auth=auth)
-                update_metadata(pdf_uri + 'fcr:metadata', pdf_sparql,
-                                auth=auth)
-                u = (fedora_uri + collection_name + '/' + handle + '/' +
-                     handle + '.pdf/')
-                query = ('PREFIX pcdm: <http://pcdm.org/models#> INSERT { '
-                         '<> pcdm:hasFile <' + u + '> . } WHERE { }')
-                update_metadata(item_uri, query, auth=auth)
-
-                if text_content:
-                    text_uri = item_uri + handle + '.txt/'
-                    upload_content(text_uri, text_content, 'text/plain',
-                                   auth=auth)
-                    update_metadata(text_uri + 'fcr:metadata', text_sparql,
+                def _upload(f):
+                    name, path, content, mimetype, sparql = f
+                    _upload_file_and_metadata(item_uri + name, path, content,
+                                              mimetype, sparql, auth=auth)
+
+                for f, result in map_concurrent(_upload, files, workers):
+                    log.debug('Uploaded %s', f[0])
+                # Link the files to the item one at a time, as concurrent
+                # updates to the same resource conflict
+                for name, path, content, mimetype, sparql in files:
+                    u = (fedora_uri + collection_name + '/' + handle + '/' +
+                         name)
+                    update_metadata(item_uri, create_has_file_sparql(u),
                                     auth=auth)
-                    u = (fedora_uri + collection_name + '/' + handle +
-                         '/' + handle + '.txt/')
-                    query = ('PREFIX pcdm: <http://pcdm.org/models#> '
-                             'INSERT { <> pcdm:hasFile <' + u + '> . } '
-                             'WHERE { }')
-                    update_metadata(item_uri, query, auth=auth)
             return 'Success'
         except requests.exceptions.HTTPError as e:
             if str(e).startswith('409'):
                 return 'Exists'
-            else:
-                log.warning('Upload attempt failed, retrying %s' % handle)
+            if not http.is_retryable(e):
+                log.warning('Upload of %s failed, not retrying', handle)
                 log.debug(e)
-                retries += 1
-        return 'Failure'
+                return 'Failure'
+            error = e
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            error = e
+        attempt += 1
+        if attempt >= backoff.attempts:
+            log.debug(error)
+            return 'Failure'
+        log.warning('Upload attempt failed, retrying %s', handle)
+        log.debug(error)
+        backoff.sleep(attempt)
+
+
+def _upload_file_and_metadata(uri, path, content, mimetype, sparql,
+                              auth=None):
+    '''Upload one of an item's files, given either as a path or as content
+    for upload_content, and add its file metadata.
+    '''
+    if path:
+        upload_file(uri, path, mimetype, auth=auth)
+    else:
+        upload_content(uri, content, mimetype, auth=auth)
+    update_metadata(uri + 'fcr:metadata', sparql, auth=auth)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import sqlite3
+import threading
+
+
+class MetadataBundle(object):
+    '''A single-file, indexed container for the turtle and SPARQL update
+    artifacts of a batch of theses.
+
+    Artifacts are stored in a SQLite database keyed by item name, so a whole
+    batch is written to one file instead of three small files per thesis and
+    any item can be read back with random access. A bundle may be shared by
+    worker threads.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS artifacts ('
+                          'name TEXT PRIMARY KEY, turtle BLOB, '
+                          'pdf_sparql BLOB, text_sparql BLOB)')
+
+    def __contains__(self, name):
+        with self.lock:
+            r = self.conn.execute('SELECT 1 FROM artifacts WHERE name = ?',
+                                  (name,)).fetchone()
+        return r is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            r = self.conn.execute('SELECT COUNT(*) FROM artifacts').fetchone()
+        return r[0]
+
+    def add(self, name, turtle, pdf_sparql, text_sparql):
+        '''Add or replace the artifacts for a single item.
+        '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO artifacts VALUES '
+                              '(?, ?, ?, ?)', (name, _to_bytes(turtle),
+                                               _to_bytes(pdf_sparql),
+                                               _to_bytes(text_sparql)))
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def get(self, name):
+        '''Return a (turtle, pdf_sparql, text_sparql) tuple of bytes for the
+        given item. Raises KeyError if the item is not in the bundle.
+        '''
+        with self.lock:
+            r = self.conn.execute('SELECT turtle, pdf_sparql, text_sparql '
+                                  'FROM artifacts WHERE name = ?',
+                                  (name,)).fetchone()
+        if r is None:
+            raise KeyError(name)
+        return tuple(bytes(a) if a is not None else None for a in r)
+
+    def names(self):
+        with self.lock:
+            r = self.conn.execute('SELECT name FROM artifacts ORDER BY name')
+            return [n[0] for n in r]
+
+
+def _to_bytes(artifact):
+    if isinstance(artifact, str):
+        return artifact.encode('utf-8')
+    return artifact
@@ -1,62 +1,156 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from contextlib import ExitStack
 import datetime
-import glob
+from itertools import takewhile
+import json
 import logging
-import logging.config
 import os
+import signal
 import tempfile
+import threading
 import xml.etree.ElementTree as ET
 
 import click
 import requests
 from timeit import default_timer as timer
 
-from foist import (create_container, initialize_custom_prefixes,
-                   parse_text_encoding_errors, Thesis, update_metadata,
-                   upload_thesis)
-
-from foist.pipeline import (extract_text, get_collection_names, get_pdf_url,
-                            get_record, get_record_list, is_thesis,
-                            is_in_fedora, parse_record_list)
+from foist import http, metrics, profiling, tracing
+from foist.bundle import MetadataBundle
+from foist.error_index import load_text_error_index, TextErrorIndex
+from foist.harvest import Watermark
+from foist.logs import configure_logging, stop_logging
+from foist.manifest import in_shard, scan_export
+from foist.pipeline import (download_file, extract_text_to_file,
+                            get_collection_names, get_pdf_url, get_record,
+                            get_record_pages, is_thesis, is_in_fedora,
+                            parse_record_list, RECORD_ERRORS)
+from foist.workers import (AdaptiveLimiter, map_concurrent, Progress,
+                           TokenBucket)
+from foist.workqueue import drain, WorkQueue
 
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# foist.app and foist.sync, which load rdflib, are imported by the commands
+# that need them rather than here, so that --help and the commands that
+# don't use them start quickly.
+
 logger = logging.getLogger(__name__)
-logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'full': {
-            'format': '%(levelname)s: [%(asctime)s] %(message)s'
-        }
-    },
-    'handlers': {
-        'console': {
-            'formatter': 'full',
-            'class': 'logging.StreamHandler',
-            'stream': 'ext://sys.stdout'
-        },
-        'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'formatter': 'full',
-            'filename': 'logfile.log',
-            'maxBytes': 1024*1024,
-            'backupCount': 3
-        }
-    },
-    'loggers': {
-        'foist': {
-            'level': 'DEBUG',
-            'handlers': ['console', 'file']
-        }
-    }
-})
+
+
+def validate_shard(ctx, param, value):
+    '''Parse an I/N shard option into an (index, count) tuple.
+    '''
+    if value is None:
+        return None
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise click.BadParameter('Shard must be given as I/N, e.g. 1/4')
+    if not 1 <= index <= count:
+        raise click.BadParameter('Shard index must be between 1 and %s' %
+                                 count)
+    return index, count
 
 
 @click.group()
-def main():
-    pass
+@click.option('--log-file', default='logfile.log',
+              type=click.Path(dir_okay=False),
+              help='Rotating log file. Default is logfile.log.')
+@click.option('--log-max-bytes', default=1024*1024,
+              type=click.IntRange(min=0),
+              help=('Size in bytes at which log files are rotated, or 0 to '
+                    'never rotate. Default is 1 MB.'))
+@click.option('--log-backups', default=3, type=click.IntRange(min=0),
+              help='Number of rotated log files to keep. Default is 3.')
+@click.option('--json-log', default=None, type=click.Path(dir_okay=False),
+              help='Also write the log as JSON lines to this file.')
+@click.option('--metrics-file', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Write a JSON report of per-stage counts, bytes and '
+                    'latencies to this file during and after the run.'))
+@click.option('--prometheus-file', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Write the same metrics to this file for the Prometheus '
+                    'node exporter textfile collector.'))
+@click.option('--metrics-interval', default=60, type=click.IntRange(min=1),
+              help=('Seconds between metrics file updates during a run. '
+                    'Default is 60.'))
+@click.option('--trace', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Trace each thesis through the pipeline and its HTTP '
+                    'requests, writing a Chrome trace-event file that can be '
+                    'opened in Perfetto or chrome://tracing.'))
+@click.option('--profile', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Profile the command, writing the profile to this file '
+                    'and a summary of the top functions to the same path '
+                    'with .txt appended.'))
+@click.option('--profile-mode', default='cprofile',
+              type=click.Choice(['cprofile', 'sample']),
+              help=('cprofile writes a pstats file for the main thread, '
+                    'so commands run with several workers or the asyncio '
+                    'backend are sampled instead. sample periodically '
+                    'samples all threads with little overhead and writes '
+                    'collapsed stacks for flame graphs. Default is '
+                    'cprofile.'))
+@click.option('--profile-top', default=25, type=click.IntRange(min=1),
+              help=('Number of functions in the profile summary. Default is '
+                    '25.'))
+@click.option('--profile-memory', is_flag=True,
+              help=('Trace memory allocations and log the peak memory used '
+                    'by each pipeline stage.'))
+@click.option('--head-timeout', nargs=2, type=float,
+              default=http.timeouts['head'],
+              help=('Connect and read timeouts in seconds for existence '
+                    'checks. Default is 5 30.'))
+@click.option('--metadata-timeout', nargs=2, type=float,
+              default=http.timeouts['metadata'],
+              help=('Connect and read timeouts in seconds for metadata '
+                    'requests and transactions. Default is 5 60.'))
+@click.option('--binary-timeout', nargs=2, type=float,
+              default=http.timeouts['binary'],
+              help=('Connect and read timeouts in seconds for PDF and text '
+                    'file transfers. Default is 10 600.'))
+@click.option('--hedge-percentile', default=None,
+              type=click.IntRange(min=1, max=99),
+              help=('Send a second copy of existence checks, OAI record '
+                    'requests and PDF downloads still outstanding after this '
+                    'percentile of recent latencies. Default is no '
+                    'hedging.'))
+@click.pass_context
+def main(ctx, log_file, log_max_bytes, log_backups, json_log, metrics_file,
+         prometheus_file, metrics_interval, trace, profile, profile_mode,
+         profile_top, profile_memory, head_timeout, metadata_timeout,
+         binary_timeout, hedge_percentile):
+    # Everything started here is shut down in reverse order when the command
+    # exits, so the log is flushed last
+    on_close = ExitStack()
+    ctx.call_on_close(on_close.close)
+    listener = configure_logging(log_file, log_max_bytes, log_backups,
+                                 json_log)
+    on_close.callback(stop_logging, listener)
+    http.timeouts.update(head=head_timeout, metadata=metadata_timeout,
+                         binary=binary_timeout)
+    http.hedge_percentile = hedge_percentile
+    metrics.registry.reset()
+    metrics.registry.info['command'] = ctx.invoked_subcommand
+    if metrics_file or prometheus_file:
+        reporter = metrics.Reporter(metrics.registry, metrics_file,
+                                    prometheus_file, metrics_interval)
+        on_close.callback(reporter.start().stop)
+    if trace:
+        tracing.tracer = tracing.Tracer()
+        on_close.callback(_write_trace, trace)
+    if profile_memory:
+        profiling.stage_memory = profiling.StageMemory().start()
+        on_close.callback(_log_stage_memory)
+    if profile:
+        if profile_mode == 'sample':
+            profiling.profiler = profiling.Sampler(profile_top).start()
+        else:
+            profiling.profiler = profiling.Profiler(profile_top).start()
+        on_close.callback(_write_profile, profile)
 
 
 @main.command()
@@ -68,6 +162,7 @@ def main():
 @click.option('-u', '--username')
 @click.option('-p', '--password')
 def initialize_fedora(parent_container, fedora_uri, username, password):
+    from foist.app import create_container, initialize_custom_prefixes
     auth = (username, password) if username else None
     logger.info(fedora_uri)
     initialize_custom_prefixes(fedora_uri, auth=auth)
@@ -81,12 +176,31 @@ def initialize_fedora(parent_container, fedora_uri, username, password):
         '''
     try:
         r = create_container(uri, turtle=turtle, auth=auth)
-        logger.info('Parent container created at location: %s' %
-                    (r.headers['Location']))
+        logger.info('Parent container created at location: %s',
+                    r.headers['Location'])
     except requests.exceptions.HTTPError as e:
         logger.error(e)
     except KeyError as e:
-        logger.warning('Parent container %s already exists' % parent_container)
+        logger.warning('Parent container %s already exists', parent_container)
+
+
+@main.command()
+@click.argument('tab_files', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output-file', required=True,
+              type=click.Path(dir_okay=False),
+              help='File to write the text error index to.')
+def index_text_errors(tab_files, output_file):
+    '''Build a compact text error index from one or more text encoding error
+    log (.tab) files.
+
+    Errors for items listed in more than one of the TAB_FILES are merged. The
+    index can be passed to process_metadata and process_and_upload with
+    --error-index instead of parsing the .tab files on every run.
+    '''
+    index = TextErrorIndex.from_tab_files(tab_files)
+    index.save(output_file)
+    logger.info('TOTAL: %s items with text errors indexed', len(index))
 
 
 @main.command()
@@ -99,44 +213,134 @@ def initialize_fedora(parent_container, fedora_uri, username, password):
                               resolve_path=False),
               help=('Output directory for thesis metadata files. Default is '
                     'same as input directory.'))
-def process_metadata(input_directory, department, output_directory):
+@click.option('-b', '--bundle', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Write all metadata files for the batch into this single '
+                    'bundle file instead of three files per thesis.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-e', '--error-index', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Text error index file created by index_text_errors. '
+                    'Default is to index all .tab files in the input '
+                    'directory.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
+def process_metadata(input_directory, department, output_directory, bundle,
+                     manifest, error_index, shard):
     '''Parse metadata for all thesis items in a directory.
 
     This script traverses the given INPUT_DIRECTORY of thesis files and for
     each thesis creates a turtle file of metadata statements and SPARQL update
     files for each file representation of the thesis. These get stored in the
-    OUTPUT_DIRECTORY, which if not specified defaults to the INPUT_DIRECTORY.
+    OUTPUT_DIRECTORY, which if not specified defaults to the INPUT_DIRECTORY,
+    or in a single BUNDLE file if one is given.
     '''
     if output_directory == '':
         output_directory = input_directory
-    error_file = glob.glob(os.path.join(input_directory, '*.tab'))[0]
-    text_encoding_errors = parse_text_encoding_errors(error_file)
-    dirnames = next(os.walk(os.path.join(input_directory, '.')))[1]
+    export = _shard_export(scan_export(input_directory, manifest), shard)
+    text_encoding_errors = _load_text_errors(export, error_index)
     department = [department]
+    metadata_bundle = MetadataBundle(bundle) if bundle else None
     count = 0
-    for d in dirnames:
-        if not os.path.exists(os.path.join(input_directory, d, d + '.pdf')):
-            logger.warning(('No PDF file for item %s. Item metadata not '
-                           'processed.') % d)
+    for item in export:
+        thesis = _build_thesis(item, department, text_encoding_errors)
+        if thesis is None:
+            metrics.registry.inc('foist_items_total', result='Skipped')
+            metrics.registry.fail(item.name, 'Skipped')
             continue
-        try:
-            mets = ET.parse(os.path.join(input_directory, d,
-                                         d + '.xml')).getroot()
-        except IOError as e:
-            logger.warning('No XML file for item %s. %s' % (d, e))
-        thesis = Thesis(d, mets, department, text_encoding_errors.get(d))
-        with open(os.path.join(output_directory, thesis.name, thesis.name +
-                               '.ttl'), 'wb') as f:
-            f.write(thesis.get_metadata())
-        with open(os.path.join(output_directory, thesis.name, thesis.name +
-                               '.pdf.ru'), 'wb') as f:
-            f.write(thesis.create_file_sparql_update('.pdf').encode('utf-8'))
-        with open(os.path.join(output_directory, thesis.name, thesis.name +
-                               '.txt.ru'), 'wb') as f:
-            f.write(thesis.create_file_sparql_update('.txt').encode('utf-8'))
+        turtle = thesis.get_metadata()
+        pdf_sparql = thesis.create_file_sparql_update('.pdf')
+        text_sparql = thesis.create_file_sparql_update('.txt')
+        if metadata_bundle is not None:
+            metadata_bundle.add(thesis.name, turtle, pdf_sparql, text_sparql)
+        else:
+            _write_metadata_files(output_directory, thesis.name, turtle,
+                                  pdf_sparql, text_sparql)
+        metrics.registry.inc('foist_items_total', result='Processed')
         count += 1
-    logger.info('TOTAL: %s theses processed in folder %s' % (str(count),
-                                                             input_directory))
+    if metadata_bundle is not None:
+        metadata_bundle.close()
+    logger.info('TOTAL: %s theses processed in folder %s', count,
+                input_directory)
+
+
+@main.command()
+@click.argument('input_directory', type=click.Path(exists=True,
+                                                   file_okay=False,
+                                                   resolve_path=True))
+@click.argument('department')
+@click.argument('output_file', type=click.Path(dir_okay=False))
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI used to name each item\'s graph. '
+                    'Default is http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of chunks to convert concurrently. Default is 1.')
+@click.option('--chunk-size', default=1000, type=click.IntRange(min=1),
+              help=('Number of theses in each compressed chunk of the '
+                    'output. Default is 1000.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-e', '--error-index', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Text error index file created by index_text_errors. '
+                    'Default is to index all .tab files in the input '
+                    'directory.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
+def dump_nquads(input_directory, department, output_file, fedora_uri,
+                parent_collection, workers, chunk_size, manifest,
+                error_index, shard):
+    '''Write the metadata of all thesis items in a directory to a single
+    gzip-compressed N-Quads file.
+
+    Each thesis's metadata, the file metadata of its PDF and text files and
+    its pcdm:hasFile links are written to a graph named after the item's
+    Fedora URI. Items are converted and compressed in chunks, so memory use
+    does not grow with the size of the export, and the files written by
+    several shards can simply be concatenated.
+    '''
+    from foist.dump import compress_chunk, item_nquads
+    profiling.sample_threads(workers > 1)
+    export = _shard_export(scan_export(input_directory, manifest), shard)
+    text_encoding_errors = _load_text_errors(export, error_index)
+    department = [department]
+    items = list(export)
+    chunks = [items[i:i + chunk_size]
+              for i in range(0, len(items), chunk_size)]
+    count = 0
+    start = timer()
+
+    def _dump(chunk):
+        quads = []
+        for item in chunk:
+            thesis = _build_thesis(item, department, text_encoding_errors)
+            if thesis is None:
+                continue
+            file_exts = ['.pdf'] + (['.txt'] if item.text_file else [])
+            quads.append(item_nquads(thesis, fedora_uri + parent_collection +
+                                     '/' + item.name, file_exts))
+        return compress_chunk(quads), len(quads)
+
+    with open(output_file, 'wb') as f:
+        for chunk, (data, n) in map_concurrent(_dump, chunks, workers):
+            f.write(data)
+            count += n
+            metrics.registry.inc('foist_items_total', n, result='Dumped')
+            logger.debug('%s theses written to %s', n, output_file)
+    end = timer()
+    logger.info('Elapsed time: %.1fs', end - start)
+    logger.info('TOTAL: %s theses written to %s', count, output_file)
 
 
 @main.command()
@@ -147,10 +351,58 @@ def process_metadata(input_directory, department, output_directory):
               help=('Base Fedora REST URI. Default is '
                     'http://localhost:8080/fcrepo/rest/'))
 @click.option('-c', '--parent-collection', default='theses')
+@click.option('-b', '--bundle', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Read thesis metadata files from this bundle file created '
+                    'by process_metadata instead of from the item '
+                    'directories.'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to upload concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('--parallel-files', is_flag=True,
+              help=('Upload the PDF and text files of each thesis '
+                    'concurrently within its transaction.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-s', '--sync-existing', is_flag=True,
+              help=('Update the metadata of items already in Fedora to match '
+                    'the generated metadata, sending only changed '
+                    'statements.'))
+@click.option('-d', '--delta', is_flag=True,
+              help=('For items already in Fedora, upload only the PDF and '
+                    'text files whose checksums differ from the binaries '
+                    'Fedora holds.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
+@click.option('-q', '--queue', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('SQLite work queue file shared by cooperating foist '
+                    'processes. Items are added to it and claimed from it, '
+                    'largest first, until it is drained.'))
+@click.option('--lease', default=600, type=click.IntRange(min=1),
+              help=('Seconds a claimed queue item is held before other '
+                    'workers may take it over. Default is 600.'))
+@click.option('--retry-failed', is_flag=True,
+              help=('Queue items that failed in an earlier run again '
+                    'instead of leaving them failed.'))
+@click.option('--backend', default='threads',
+              type=click.Choice(['threads', 'asyncio']),
+              help=('Run uploads on a pool of threads, or as coroutines on '
+                    'an asyncio event loop, which copes better with hundreds '
+                    'of workers. asyncio needs aiohttp and cannot be used '
+                    'with --adaptive or --queue. Default is threads.'))
 @click.option('-u', '--username')
 @click.option('-p', '--password')
-def batch_upload_theses(directory, fedora_uri, parent_collection, username,
-                        password):
+def batch_upload_theses(directory, fedora_uri, parent_collection, bundle,
+                        workers, adaptive, parallel_files, manifest,
+                        sync_existing, delta, shard, queue, lease,
+                        retry_failed, backend, username, password):
     '''Uploads all thesis items in a directory to Fedora.
 
     This script traverses the given DIRECTORY of thesis files exported from
@@ -158,79 +410,815 @@ def batch_upload_theses(directory, fedora_uri, parent_collection, username,
     adds file metadata, and adds PCDM relationship statements between the
     collection, item, and files.
     '''
+    from foist.app import upload_thesis
+    from foist.sync import DeltaStats
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    aio = _async_backend(backend, adaptive, queue)
     auth = (username, password) if username else None
-    dirnames = next(os.walk(os.path.join(directory, '.')))[1]
+    export = _shard_export(scan_export(directory, manifest), shard)
+    metadata_bundle = MetadataBundle(bundle) if bundle else None
+    delta_stats = DeltaStats()
     thesis_count = 0
     start = timer()
 
-    for d in dirnames:
-        pdf_file = os.path.join(directory, d, d + '.pdf')
+    def _metadata(item):
+        if metadata_bundle is not None:
+            return metadata_bundle.get(item.name)
+        return _read_metadata_files(item)
+
+    def _sync(item, u, turtle, pdf_sparql, text_sparql):
+        if u == 'Exists' and delta:
+            u = _sync_files(fedora_uri, parent_collection, item.name,
+                            item.pdf_file, pdf_sparql, item.text_file,
+                            text_sparql, auth, delta_stats)
+        if u in ('Exists', 'Synced') and sync_existing:
+            u = _sync_existing(fedora_uri, parent_collection, item.name,
+                               turtle, auth)
+        return u
+
+    def _upload(item):
+        try:
+            turtle, pdf_sparql, text_sparql = _metadata(item)
+        except (FileNotFoundError, KeyError) as e:
+            return 'Missing'
+        if item.pdf_file is None:
+            return 'Missing'
+        u = upload_thesis(fedora_uri, parent_collection, item.name, turtle,
+                          item.pdf_file, pdf_sparql,
+                          text_sparql=text_sparql, auth=auth,
+                          text_file=item.text_file,
+                          parallel_files=parallel_files)
+        return _sync(item, u, turtle, pdf_sparql, text_sparql)
 
-        if os.path.isfile(os.path.join(directory, d, d + '-new.txt')):
-            text_file = os.path.join(directory, d, d + '-new.txt')
-        elif os.path.isfile(os.path.join(directory, d, d + '.txt')):
-            text_file = os.path.join(directory, d, d + '.txt')
+    work_queue = WorkQueue(queue, lease) if queue else None
+    if aio is not None:
+        results = aio.map_concurrent(
+            lambda item: aio.upload_item(item, _metadata, _sync, fedora_uri,
+                                         parent_collection, auth=auth,
+                                         parallel_files=parallel_files),
+            export, workers)
+    else:
+        results = _map_items(_upload, export, workers, adaptive, fedora_uri,
+                             work_queue=work_queue, size=_item_size,
+                             failed=lambda u: u not in UPLOADED,
+                             retry_failed=retry_failed)
+    for item, u in results:
+        if u == 'Missing':
+            logger.warning('Missing needed file for item "%s", not '
+                           'uploaded to Fedora.', item.name)
+            metrics.registry.inc('foist_items_total', result=u)
+            metrics.registry.fail(item.name, u)
         else:
-            text_file = None
+            thesis_count += _log_upload_result(item.name, u)
+
+    if metadata_bundle is not None:
+        metadata_bundle.close()
+    if work_queue is not None:
+        work_queue.close()
+    end = timer()
+    logger.info('Elapsed time: %.1fs', end - start)
+    if delta:
+        logger.info('Delta sync: %s', delta_stats)
+    logger.info('TOTAL: %s theses ingested.\n', thesis_count)
+
+
+@main.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False,
+                                             resolve_path=True))
+@click.argument('output_directory', type=click.Path(file_okay=False,
+                                                    resolve_path=True))
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI the package will be imported into. '
+                    'Default is http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-b', '--bundle', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Read thesis metadata files from this bundle file created '
+                    'by process_metadata instead of from the item '
+                    'directories.'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to write concurrently. Default is 1.')
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
+def export_package(directory, output_directory, fedora_uri, parent_collection,
+                   bundle, workers, manifest, shard):
+    '''Writes all thesis items in a directory to an import package.
+
+    Instead of uploading to Fedora, each thesis's metadata, files and file
+    metadata are written to OUTPUT_DIRECTORY in the layout of the Fedora
+    import/export utility, with the pcdm:hasFile relationships and SHA-1
+    digests of every binary, for loading offline. The package's
+    manifest-sha1.txt can be checked with sha1sum -c before it is loaded.
+    '''
+    from foist.package import ImportPackage
+    profiling.sample_threads(workers > 1)
+    export = _shard_export(scan_export(directory, manifest), shard)
+    metadata_bundle = MetadataBundle(bundle) if bundle else None
+    package = ImportPackage(output_directory, fedora_uri)
+    thesis_count = 0
+    start = timer()
 
+    def _package(item):
         try:
-            with open(os.path.join(directory, d, d + '.pdf.ru'), 'rb') as ps, \
-                 open(os.path.join(directory, d, d + '.txt.ru'), 'rb') as ts, \
-                 open(os.path.join(directory, d, d + '.ttl'), 'rb') as tu:
-
-                pdf_sparql = ps.read()
-                text_sparql = ts.read()
-                turtle = tu.read()
-
-                u = upload_thesis(fedora_uri, parent_collection, d, turtle,
-                                  pdf_file, pdf_sparql, text_file,
-                                  text_sparql, auth=auth)
-                if u == 'Success':
-                    logger.info('Thesis "%s" uploaded' % d)
-                    thesis_count += 1
-                elif u == 'Exists':
-                    logger.warning('Item "%s" already in collection' % d)
-                    thesis_count += 1
-                else:
-                    logger.warning('Thesis "%s" upload failed' % d)
-        except FileNotFoundError as e:
-            logger.warning('Missing needed RDF file for item "%s", not '
-                           'uploaded to Fedora.' % d)
-            continue
+            if metadata_bundle is not None:
+                turtle, pdf_sparql, text_sparql = metadata_bundle.get(
+                    item.name)
+            else:
+                turtle, pdf_sparql, text_sparql = _read_metadata_files(item)
+        except (FileNotFoundError, KeyError) as e:
+            return 'Missing'
+        if item.pdf_file is None:
+            return 'Missing'
+        files = [('.pdf', item.pdf_file, 'application/pdf', pdf_sparql)]
+        if item.text_file:
+            files.append(('.txt', item.text_file, 'text/plain',
+                          text_sparql))
+        with metrics.stage('package'):
+            package.add(parent_collection, item.name, turtle, files)
+        return 'Packaged'
+
+    for item, u in map_concurrent(_package, export, workers):
+        metrics.registry.inc('foist_items_total', result=u)
+        if u == 'Missing':
+            logger.warning('Missing needed file for item "%s", not '
+                           'packaged.', item.name)
+            metrics.registry.fail(item.name, u)
+        else:
+            logger.info('Thesis "%s" packaged', item.name)
+            thesis_count += 1
 
+    package.close()
+    if metadata_bundle is not None:
+        metadata_bundle.close()
     end = timer()
-    logger.info(end - start)
-    logger.info('TOTAL: %s theses ingested.\n' % thesis_count)
+    logger.info('Elapsed time: %.1fs', end - start)
+    logger.info('TOTAL: %s theses written to %s.\n', thesis_count,
+                output_directory)
 
 
 @main.command()
 @click.argument('directory', type=click.Path(exists=True, file_okay=False,
                                              resolve_path=True))
+@click.option('-o', '--output-file', required=True,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help='File to write the JSON verification report to.')
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI. Default is '
+                    'http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to verify concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
+@click.option('-u', '--username')
+@click.option('-p', '--password')
+def verify(directory, output_file, fedora_uri, parent_collection, workers,
+           adaptive, manifest, shard, username, password):
+    '''Checks that all thesis items in a directory are in Fedora.
+
+    For every item in the export DIRECTORY this checks that its container
+    exists in the parent collection, that it links to its PDF and text files
+    with pcdm:hasFile and that the SHA-1 digests Fedora holds for them match
+    the local files. The collection is listed once rather than checking for
+    each item separately. Items that fail, or that could not be checked
+    because a request to Fedora failed, are listed in the JSON report
+    written to OUTPUT_FILE, along with counts of each result.
+    '''
+    from foist.verify import list_container, verify_item, write_report
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    auth = (username, password) if username else None
+    export = _shard_export(scan_export(directory, manifest), shard)
+    collection_uri = fedora_uri + parent_collection
+    start = timer()
+    contained = list_container(collection_uri, auth=auth)
+    if contained is None:
+        logger.warning('Collection %s not found, checking each item',
+                       collection_uri)
+    counts = {}
+    failures = []
+
+    def _verify(item):
+        item_uri = collection_uri + '/' + item.name
+        files = {}
+        if item.pdf_file:
+            files[item_uri + '/' + item.name + '.pdf'] = item.pdf_file
+        if item.text_file:
+            files[item_uri + '/' + item.name + '.txt'] = item.text_file
+        exists = contained is None or item_uri in contained
+        try:
+            return verify_item(item_uri, files, auth=auth, exists=exists)
+        except requests.exceptions.RequestException as e:
+            return 'Error', str(e)
+
+    for item, (u, problems) in _map_items(_verify, export, workers,
+                                          adaptive, fedora_uri):
+        counts[u] = counts.get(u, 0) + 1
+        metrics.registry.inc('foist_items_total', result=u)
+        if u == 'Verified':
+            logger.debug('Thesis "%s" verified', item.name)
+            continue
+        metrics.registry.fail(item.name, u)
+        if u == 'Error':
+            # problems is the error message of the failed request
+            logger.warning('Thesis "%s" could not be verified: %s',
+                           item.name, problems)
+            failures.append({'name': item.name, 'result': u,
+                             'error': problems})
+            continue
+        logger.warning('Thesis "%s" %s: %s', item.name, u.lower(),
+                       ', '.join('%s %s' % (os.path.basename(f), p.lower())
+                                 for f, p in sorted(problems.items())) or
+                       'not in Fedora')
+        failures.append({'name': item.name, 'result': u,
+                         'files': {os.path.basename(f): p
+                                   for f, p in problems.items()}})
+
+    failures.sort(key=lambda f: f['name'])
+    write_report(output_file, {'collection': collection_uri,
+                               'directory': directory,
+                               'shard': '%s/%s' % shard if shard else None,
+                               'checked': len(export),
+                               'results': counts,
+                               'failures': failures})
+    end = timer()
+    logger.info('Elapsed time: %.1fs', end - start)
+    logger.info('TOTAL: %s of %s theses verified, report written to %s\n',
+                counts.get('Verified', 0), len(export), output_file)
+
+
+@main.command()
+@click.argument('input_directory', type=click.Path(exists=True,
+                                                   file_okay=False,
+                                                   resolve_path=True))
+@click.argument('department')
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI. Default is '
+                    'http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-a', '--audit-directory', default=None,
+              type=click.Path(file_okay=False, resolve_path=True),
+              help=('Also write the generated metadata files to this '
+                    'directory for auditing. By default nothing is written '
+                    'to disk.'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to upload concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('--parallel-files', is_flag=True,
+              help=('Upload the PDF and text files of each thesis '
+                    'concurrently within its transaction.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-e', '--error-index', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Text error index file created by index_text_errors. '
+                    'Default is to index all .tab files in the input '
+                    'directory.'))
+@click.option('-s', '--sync-existing', is_flag=True,
+              help=('Update the metadata of items already in Fedora to match '
+                    'the generated metadata, sending only changed '
+                    'statements.'))
+@click.option('-q', '--queue', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('SQLite work queue file shared by cooperating foist '
+                    'processes. Items are added to it and claimed from it, '
+                    'largest first, until it is drained.'))
+@click.option('--lease', default=600, type=click.IntRange(min=1),
+              help=('Seconds a claimed queue item is held before other '
+                    'workers may take it over. Default is 600.'))
+@click.option('--retry-failed', is_flag=True,
+              help=('Queue items that failed in an earlier run again '
+                    'instead of leaving them failed.'))
+@click.option('-u', '--username')
+@click.option('-p', '--password')
+def process_and_upload(input_directory, department, fedora_uri,
+                       parent_collection, audit_directory, workers, adaptive,
+                       parallel_files, manifest, error_index, sync_existing,
+                       queue, lease, retry_failed, username, password):
+    '''Parse metadata for and upload all thesis items in a directory.
+
+    This script combines process_metadata and batch_upload_theses in a single
+    pass over the INPUT_DIRECTORY: for each thesis the metadata is generated
+    in memory and uploaded to Fedora along with its files, without writing
+    intermediate metadata files unless an AUDIT_DIRECTORY is given.
+    '''
+    from foist.app import upload_thesis
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    auth = (username, password) if username else None
+    export = scan_export(input_directory, manifest)
+    text_encoding_errors = _load_text_errors(export, error_index)
+    department = [department]
+    thesis_count = 0
+    start = timer()
+
+    def _process_and_upload(item):
+        thesis = _build_thesis(item, department, text_encoding_errors)
+        if thesis is None:
+            return 'Skipped'
+        turtle = thesis.get_metadata()
+        pdf_sparql = thesis.create_file_sparql_update('.pdf')
+        text_sparql = thesis.create_file_sparql_update('.txt')
+        if audit_directory:
+            os.makedirs(os.path.join(audit_directory, item.name),
+                        exist_ok=True)
+            _write_metadata_files(audit_directory, item.name, turtle,
+                                  pdf_sparql, text_sparql)
+        u = upload_thesis(fedora_uri, parent_collection, item.name, turtle,
+                          item.pdf_file, pdf_sparql, text_sparql=text_sparql,
+                          auth=auth, text_file=item.text_file,
+                          parallel_files=parallel_files)
+        if u == 'Exists' and sync_existing:
+            u = _sync_existing(fedora_uri, parent_collection, item.name,
+                               turtle, auth)
+        return u
+
+    work_queue = WorkQueue(queue, lease) if queue else None
+    for item, u in _map_items(
+            _process_and_upload, export, workers, adaptive, fedora_uri,
+            work_queue=work_queue, size=_item_size,
+            failed=lambda u: u not in UPLOADED + ('Skipped',),
+            retry_failed=retry_failed):
+        if u != 'Skipped':
+            thesis_count += _log_upload_result(item.name, u)
+    if work_queue is not None:
+        work_queue.close()
+
+    end = timer()
+    logger.info('Elapsed time: %.1fs', end - start)
+    logger.info('TOTAL: %s theses ingested.\n', thesis_count)
+
+
+def _build_thesis(item, departments, text_encoding_errors):
+    '''Create a Thesis from an item in an export directory manifest. Returns
+    None, logging a warning, if the item's PDF or METS XML file is missing.
+    '''
+    from foist.app import Thesis
+    if item.pdf_file is None:
+        logger.warning('No PDF file for item %s. Item metadata not '
+                       'processed.', item.name)
+        return None
+    if item.xml_file is None:
+        logger.warning('No XML file for item %s.', item.name)
+        return None
+    mets = ET.parse(item.xml_file).getroot()
+    return Thesis(item.name, mets, departments,
+                  text_encoding_errors.get(item.name))
+
+
+def _load_text_errors(export, error_index=None):
+    '''Return the text error index file if one is given, otherwise an index
+    of all .tab files in the export directory.
+    '''
+    if error_index:
+        return load_text_error_index(error_index)
+    return TextErrorIndex.from_tab_files(export.error_files)
+
+
+def _shard_export(export, shard):
+    '''Return the part of an export Manifest in the given shard, or all of it
+    if no shard is given.
+    '''
+    if shard is None:
+        return export
+    export = export.shard(shard)
+    _record_shard(shard, len(export))
+    return export
+
+
+def _record_shard(shard, items):
+    metrics.registry.info['shard'] = '%s/%s' % shard
+    logger.info('Shard %s/%s: %s items', shard[0], shard[1], items)
+
+
+def _async_backend(backend, adaptive, queue):
+    '''Return the foist.aio module if the asyncio backend is chosen, or None
+    for the thread backend.
+    '''
+    if backend != 'asyncio':
+        return None
+    if adaptive or queue:
+        raise click.UsageError('The asyncio backend cannot be used with '
+                               '--adaptive or --queue')
+    try:
+        from foist import aio
+    except ImportError:
+        raise click.UsageError('The asyncio backend needs aiohttp, which is '
+                               'not installed')
+    profiling.sample_threads(True)
+    return aio
+
+
+def _map_items(func, items, workers, adaptive, fedora_uri,
+               handle=lambda item: item.name, work_queue=None, size=None,
+               payload=None, failed=None, retry_failed=False):
+    '''Run func over items with map_concurrent, adapting the concurrency to
+    Fedora's responses if adaptive is set. When tracing, each call is traced
+    as a span labelled with the handle of its item.
+
+    If a WorkQueue is given the items are added to it instead, keyed by their
+    handle with the given size and payload functions, and this process works
+    through the queue alongside any other processes sharing it. Items whose
+    result the failed function returns True for are marked failed in the
+    queue, and are only queued again with retry_failed.
+    '''
+    if tracing.tracer is not None:
+        func = _traced(func, handle)
+    limiter = None
+    if adaptive:
+        limiter = AdaptiveLimiter(workers, url_prefix=fedora_uri)
+    if work_queue is not None:
+        results = _drain_queue(func, items, workers, limiter, work_queue,
+                               handle, size, payload, failed, retry_failed)
+    else:
+        results = map_concurrent(func, items, workers, limiter=limiter)
+    if limiter is None:
+        yield from results
+        return
+    with http.observer(limiter.observe):
+        yield from results
+
+
+def _drain_queue(func, items, workers, limiter, work_queue, handle, size,
+                 payload, failed, retry_failed):
+    by_handle = {handle(item): item for item in items}
+    added = work_queue.put(((h, size(item) if size else 0,
+                             payload(item) if payload else None)
+                            for h, item in by_handle.items()),
+                           retry_failed=retry_failed)
+    logger.info('%s of %s items added to work queue %s', added,
+                len(by_handle), work_queue.path)
+
+    def _item(task):
+        if task.payload is not None:
+            return task.payload
+        return by_handle[task.name]
+
+    for task, result in drain(work_queue, lambda t: func(_item(t)), workers,
+                              limiter, failed):
+        yield _item(task), result
+
+
+def _item_size(item):
+    return sum(size for size, mtime in item.files.values())
+
+
+def _log_stage_memory():
+    stage_memory, profiling.stage_memory = profiling.stage_memory, None
+    stage_memory.stop()
+    logger.info('Peak memory by stage:\n%s', stage_memory.summary())
+
+
+def _write_profile(path):
+    profiler, profiling.profiler = profiling.profiler, None
+    profiler.stop()
+    profiler.write(path)
+    logger.info('Profile written to %s, summary in %s.txt', path, path)
+
+
+def _write_trace(path):
+    tracer, tracing.tracer = tracing.tracer, None
+    tracer.write(path)
+    logger.info('%s trace events written to %s', len(tracer), path)
+
+
+def _traced(func, handle):
+    def wrapper(item):
+        with tracing.span('thesis', handle=handle(item)) as span:
+            result = func(item)
+            status = result[0] if isinstance(result, tuple) else result
+            if isinstance(status, str):
+                span['result'] = status
+            return result
+    return wrapper
+
+
+# Upload results for items that are now in Fedora
+UPLOADED = ('Success', 'Synced', 'Updated', 'Unchanged', 'Exists')
+
+
+def _log_upload_result(name, result):
+    '''Log the result of an upload_thesis call and return 1 if the item is
+    now in Fedora, otherwise 0.
+    '''
+    metrics.registry.inc('foist_items_total', result=result)
+    if result == 'Success':
+        logger.info('Thesis "%s" uploaded', name)
+        return 1
+    elif result == 'Synced':
+        logger.info('Files for item "%s" synced', name)
+        return 1
+    elif result == 'Updated':
+        logger.info('Metadata for item "%s" updated', name)
+        return 1
+    elif result == 'Unchanged':
+        logger.debug('Item "%s" already up to date', name)
+        return 1
+    elif result == 'Exists':
+        logger.warning('Item "%s" already in collection', name)
+        return 1
+    logger.warning('Thesis "%s" upload failed', name)
+    metrics.registry.fail(name, result)
+    return 0
+
+
+def _sync_existing(fedora_uri, collection_name, name, turtle, auth=None):
+    '''Sync the metadata of an item already in Fedora, returning 'Updated',
+    'Unchanged' or 'Failure'.
+    '''
+    from foist.sync import sync_thesis_metadata
+    try:
+        return sync_thesis_metadata(fedora_uri + collection_name + '/' + name,
+                                    turtle, auth=auth)
+    except requests.exceptions.RequestException as e:
+        logger.debug(e)
+        return 'Failure'
+
+
+def _sync_files(fedora_uri, collection_name, name, pdf_file, pdf_sparql,
+                text_file, text_sparql, auth, stats):
+    '''Upload an existing item's PDF and text files only where they differ
+    from Fedora's copies, returning 'Synced' or 'Failure'.
+    '''
+    from foist.sync import sync_file
+    try:
+        if pdf_file:
+            stats.add(*sync_file(fedora_uri, collection_name, name, '.pdf',
+                                 pdf_file, 'application/pdf', pdf_sparql,
+                                 auth=auth))
+        if text_file:
+            stats.add(*sync_file(fedora_uri, collection_name, name, '.txt',
+                                 text_file, 'text/plain', text_sparql,
+                                 auth=auth))
+    except requests.exceptions.RequestException as e:
+        logger.debug(e)
+        return 'Failure'
+    return 'Synced'
+
+
+def _read_metadata_files(item):
+    '''Read the turtle and SPARQL update files written by process_metadata for
+    a single item, returning (turtle, pdf_sparql, text_sparql).
+    '''
+    with open(item.path_for('.pdf.ru'), 'rb') as ps, \
+            open(item.path_for('.txt.ru'), 'rb') as ts, \
+            open(item.path_for('.ttl'), 'rb') as tu:
+        return tu.read(), ps.read(), ts.read()
+
+
+def _write_metadata_files(directory, name, turtle, pdf_sparql, text_sparql):
+    '''Write the turtle and SPARQL update files for a single item.
+    '''
+    with open(os.path.join(directory, name, name + '.ttl'), 'wb') as f:
+        f.write(turtle)
+    with open(os.path.join(directory, name, name + '.pdf.ru'), 'wb') as f:
+        f.write(pdf_sparql.encode('utf-8'))
+    with open(os.path.join(directory, name, name + '.txt.ru'), 'wb') as f:
+        f.write(text_sparql.encode('utf-8'))
+
+
+@main.command()
+@click.argument('input_directory', type=click.Path(exists=True,
+                                                   file_okay=False,
+                                                   resolve_path=True))
+@click.argument('department')
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI. Default is '
+                    'http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to sync concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-e', '--error-index', default=None,
+              type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help=('Text error index file created by index_text_errors. '
+                    'Default is to index all .tab files in the input '
+                    'directory.'))
+@click.option('-u', '--username')
+@click.option('-p', '--password')
+def sync_metadata(input_directory, department, fedora_uri, parent_collection,
+                  workers, adaptive, manifest, error_index, username,
+                  password):
+    '''Syncs the metadata of thesis items already in Fedora.
+
+    This script generates the metadata for each thesis in INPUT_DIRECTORY,
+    compares it with the item's current metadata in Fedora and sends a SPARQL
+    update with only the changed statements. Items whose metadata has not
+    changed are not written to.
+    '''
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    auth = (username, password) if username else None
+    export = scan_export(input_directory, manifest)
+    text_encoding_errors = _load_text_errors(export, error_index)
+    department = [department]
+    updated = 0
+    unchanged = 0
+
+    def _sync(item):
+        thesis = _build_thesis(item, department, text_encoding_errors)
+        if thesis is None:
+            return 'Skipped'
+        return _sync_existing(fedora_uri, parent_collection, item.name,
+                              thesis.get_metadata(), auth)
+
+    for item, u in _map_items(_sync, export, workers, adaptive,
+                              fedora_uri):
+        if u == 'Updated':
+            logger.info('Metadata for item "%s" updated', item.name)
+            updated += 1
+        elif u == 'Unchanged':
+            logger.debug('Item "%s" already up to date', item.name)
+            unchanged += 1
+        elif u == 'Failure':
+            logger.warning('Item "%s" sync failed', item.name)
+    logger.info('TOTAL: %s theses updated, %s unchanged.\n',
+                updated, unchanged)
+
+
+@main.command()
+@click.argument('directory', type=click.Path(exists=True, resolve_path=True))
 @click.argument('sparql')
 @click.option('-f', '--fedora-uri',
               default='http://localhost:8080/fcrepo/rest/',
               help=('Base Fedora REST URI. Default is '
                     'http://localhost:8080/fcrepo/rest/'))
+@click.option('-c', '--parent-collection', default='theses')
+@click.option('-m', '--manifest', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('Manifest file caching the scan of the export directory, '
+                    'so it can be reused by later commands.'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to update concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('-r', '--rate', default=None, type=float,
+              help=('Maximum number of updates sent to Fedora per second. '
+                    'Default is no limit.'))
+@click.option('-t', '--transaction-size', default=0,
+              type=click.IntRange(min=0),
+              help=('Number of updates to send in each Fedora transaction. '
+                    'Default is 0, no transactions.'))
+@click.option('--retry-file', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('File to write the names of items whose update failed '
+                    'to. It can be passed as DIRECTORY to retry them.'))
+@click.option('--shard', default=None, callback=validate_shard,
+              help=('Process only shard I of N, given as I/N, of the items. '
+                    'Items are assigned to shards by a stable hash of their '
+                    'name, so N hosts can split one export.'))
 @click.option('-u', '--username')
 @click.option('-p', '--password')
-def update_metadata_for_collection(directory, sparql, fedora_uri, username,
-                                   password):
+def update_metadata_for_collection(directory, sparql, fedora_uri,
+                                   parent_collection, manifest, workers,
+                                   adaptive, rate, transaction_size,
+                                   retry_file, shard, username, password):
     '''Updates a single metadata field for all items in a collection, using
-    the provided SPARQL query
+    the provided SPARQL query.
+
+    DIRECTORY is either an export directory, in which case every item in it
+    is updated, or a retry file listing one item name per line.
     '''
+    from foist.app import transaction, update_metadata
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
     auth = (username, password) if username else None
-    items = next(os.walk(os.path.join(directory, '.')))[1]
+    if os.path.isfile(directory):
+        with open(directory) as f:
+            items = [line.strip() for line in f if line.strip()]
+    else:
+        items = scan_export(directory, manifest).names()
+    if shard:
+        items = [i for i in items if in_shard(i, shard)]
+        _record_shard(shard, len(items))
+    bucket = TokenBucket(rate) if rate else None
+    progress = Progress(len(items), 'theses')
     thesis_count = 0
-    for i in items:
+    failed = []
+
+    def _update(batch):
         try:
-            uri = fedora_uri + 'theses/' + i
-            update_metadata(uri, sparql, auth=auth)
-            logger.debug('Thesis %s updated.' % i)
-            thesis_count += 1
+            if transaction_size:
+                with transaction(fedora_uri, auth=auth) as t:
+                    _update_items(t + '/', batch)
+            else:
+                _update_items(fedora_uri, batch)
+            return None
         except Exception as e:
-            logger.warning('Thesis %s update failed' % i)
+            return e
+
+    def _update_items(base_uri, batch):
+        for i in batch:
+            if bucket is not None:
+                bucket.acquire()
+            uri = base_uri + parent_collection + '/' + i
+            update_metadata(uri, sparql, auth=auth)
+
+    size = transaction_size or 1
+    batches = [items[i:i + size] for i in range(0, len(items), size)]
+    for batch, e in _map_items(_update, batches, workers, adaptive,
+                               fedora_uri, handle=' '.join):
+        progress.update(len(batch))
+        if e is None:
+            for i in batch:
+                logger.debug('Thesis %s updated.', i)
+            metrics.registry.inc('foist_items_total', len(batch),
+                                 result='Updated')
+            thesis_count += len(batch)
+        else:
+            for i in batch:
+                logger.warning('Thesis %s update failed', i)
+                metrics.registry.fail(i, 'Failure')
+            metrics.registry.inc('foist_items_total', len(batch),
+                                 result='Failure')
             logger.debug(e)
-    logger.info('TOTAL: %s theses updated.\n' % thesis_count)
+            failed.extend(batch)
+    progress.finish()
+    if retry_file and failed:
+        with open(retry_file, 'w') as f:
+            f.writelines(i + '\n' for i in failed)
+        logger.info('%s failed items written to %s', len(failed),
+                    retry_file)
+    logger.info('TOTAL: %s theses updated.\n', thesis_count)
+
+
+@main.command()
+@click.argument('reports', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output-file', required=True,
+              type=click.Path(dir_okay=False),
+              help='File to write the merged JSON run report to.')
+@click.option('--prometheus-file', default=None,
+              type=click.Path(dir_okay=False),
+              help='Also write the merged metrics as a Prometheus textfile.')
+def merge_reports(reports, output_file, prometheus_file):
+    '''Merge the JSON run reports written with --metrics-file by several
+    shards of one run into a single report.
+
+    Item counts, stage latencies and the lists of failed items are combined,
+    so the whole run can be checked in one place.
+    '''
+    loaded = []
+    for path in reports:
+        with open(path) as f:
+            loaded.append(json.load(f))
+    merged = metrics.merge_reports(loaded)
+    merged.write(output_file, prometheus_file)
+    report = merged.report()
+    for c in report['counters']:
+        if c['name'] == 'foist_items_total':
+            logger.info('%s: %s', c['labels']['result'], c['value'])
+    for failure in report['failures']:
+        logger.warning('Item "%s" failed: %s', failure['item'],
+                       failure['result'])
+    logger.info('TOTAL: %s reports merged, %s failed items.\n',
+                len(loaded), len(report['failures']))
+
+
+@main.command()
+@click.argument('queue', type=click.Path(exists=True, dir_okay=False))
+def queue_status(queue):
+    '''Show how many items in a work QUEUE are pending, leased, done and
+    failed, and list the failed items.
+    '''
+    with WorkQueue(queue) as work_queue:
+        counts = work_queue.counts()
+        failed = work_queue.results('failed')
+    for state in ('pending', 'leased', 'done', 'failed'):
+        logger.info('%s: %s', state, counts.get(state, 0))
+    for name, result in failed:
+        logger.warning('Item "%s" failed: %s', name, result)
 
 
 def validate_date(ctx, param, value):
@@ -255,80 +1243,326 @@ def validate_date(ctx, param, value):
               default='http://localhost:8080/fcrepo/rest/',
               help=('Base Fedora REST URI. Default is '
                     'http://localhost:8080/fcrepo/rest/'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to ingest concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('--parallel-files', is_flag=True,
+              help=('Upload the PDF and text files of each thesis '
+                    'concurrently within its transaction.'))
+@click.option('-d', '--delta', is_flag=True,
+              help=('For items already in Fedora, upload only the PDF and '
+                    'text files whose checksums differ from the binaries '
+                    'Fedora holds.'))
+@click.option('-q', '--queue', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('SQLite work queue file shared by cooperating foist '
+                    'processes. Items are added to it and claimed from it, '
+                    'largest first, until it is drained.'))
+@click.option('--lease', default=600, type=click.IntRange(min=1),
+              help=('Seconds a claimed queue item is held before other '
+                    'workers may take it over. Default is 600.'))
+@click.option('--retry-failed', is_flag=True,
+              help=('Queue items that failed in an earlier run again '
+                    'instead of leaving them failed.'))
+@click.option('--backend', default='threads',
+              type=click.Choice(['threads', 'asyncio']),
+              help=('Run ingests on a pool of threads, or as coroutines on '
+                    'an asyncio event loop, which copes better with hundreds '
+                    'of workers. asyncio needs aiohttp and cannot be used '
+                    'with --adaptive or --queue. Default is threads.'))
 @click.option('-u', '--username')
 @click.option('-p', '--password')
 def ingest_new_theses(dspace_oai_uri, dspace_oai_identifier, metadata_format,
-                      start_date, end_date, fedora_uri, username, password):
+                      start_date, end_date, fedora_uri, workers, adaptive,
+                      parallel_files, delta, queue, lease, retry_failed,
+                      backend, username, password):
     '''Adds new theses added to DSpace repository since start_date to Fedora
     repository.
     '''
-    total_items_processed = 0
-    not_a_thesis = 0
-    added_to_fedora = 0
-    already_in_fedora = 0
-    no_full_text = 0
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    aio = _async_backend(backend, adaptive, queue)
+    auth = (username, password) if username else None
+    items = (item for page in get_record_pages(dspace_oai_uri,
+                                               metadata_format, start_date,
+                                               end_date)
+             for item in parse_record_list(page))
+    work_queue = WorkQueue(queue, lease) if queue else None
+    counts, delta_stats, records = _ingest_items(
+        items, dspace_oai_uri, dspace_oai_identifier, metadata_format,
+        fedora_uri, workers, adaptive, parallel_files, delta, auth,
+        work_queue=work_queue, retry_failed=retry_failed, aio=aio)
+    if work_queue is not None:
+        work_queue.close()
+    _log_ingest_counts(counts, delta_stats if delta else None)
+
+
+@main.command()
+@click.argument('dspace_oai_uri')
+@click.argument('dspace_oai_identifier')
+@click.option('-md', '--metadata-format', default='mets')
+@click.option('-s', '--state-file', default='harvest_state.json',
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help=('JSON file recording the datestamp of the last record '
+                    'harvested successfully. Default is '
+                    'harvest_state.json.'))
+@click.option('-sd', '--start-date', callback=validate_date,
+              help=('Date to start harvesting from when there is no state '
+                    'file yet. Default is to harvest everything.'))
+@click.option('-i', '--interval', default=900, type=click.IntRange(min=1),
+              help='Seconds between harvests. Default is 900.')
+@click.option('--once', is_flag=True,
+              help='Harvest once and exit instead of polling.')
+@click.option('-f', '--fedora-uri',
+              default='http://localhost:8080/fcrepo/rest/',
+              help=('Base Fedora REST URI. Default is '
+                    'http://localhost:8080/fcrepo/rest/'))
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of theses to ingest concurrently. Default is 1.')
+@click.option('--adaptive', is_flag=True,
+              help=('Adapt the number of concurrent workers, up to '
+                    '--workers, to the latency and error rate of Fedora.'))
+@click.option('--parallel-files', is_flag=True,
+              help=('Upload the PDF and text files of each thesis '
+                    'concurrently within its transaction.'))
+@click.option('-d', '--delta', is_flag=True,
+              help=('For items already in Fedora, upload only the PDF and '
+                    'text files whose checksums differ from the binaries '
+                    'Fedora holds.'))
+@click.option('--backend', default='threads',
+              type=click.Choice(['threads', 'asyncio']),
+              help=('Run ingests on a pool of threads, or as coroutines on '
+                    'an asyncio event loop, which copes better with hundreds '
+                    'of workers. asyncio needs aiohttp and cannot be used '
+                    'with --adaptive. Default is threads.'))
+@click.option('-u', '--username')
+@click.option('-p', '--password')
+def harvest_daemon(dspace_oai_uri, dspace_oai_identifier, metadata_format,
+                   state_file, start_date, interval, once, fedora_uri,
+                   workers, adaptive, parallel_files, delta, backend,
+                   username, password):
+    '''Poll the DSpace repository for new theses and add them to Fedora,
+    running until stopped.
 
+    Each harvest starts from the watermark in the state file, which is
+    advanced past the records ingested successfully, so no --start-date has
+    to be worked out between runs. HTTP connections and the Tika server stay
+    warm between harvests. On SIGTERM or SIGINT no more records are listed
+    and no new items are started, the items in flight are finished and the
+    watermark is saved before exiting. A harvest stopped before all of its
+    records were listed leaves the watermark where it was, as the records
+    not listed may be older than those ingested.
+    '''
+    http.configure_pool(workers)
+    profiling.sample_threads(workers > 1)
+    aio = _async_backend(backend, adaptive, None)
     auth = (username, password) if username else None
-    items = get_record_list(dspace_oai_uri, metadata_format, start_date,
-                            end_date)
-    parsed_items = parse_record_list(items)
-    for item in parsed_items:
-        logger.debug('Checking item %s' % item['handle'])
-        total_items_processed += 1
-        if not is_thesis(item['sets']):
-            not_a_thesis += 1
-            continue
-        if is_in_fedora(item['handle'], fedora_uri, 'theses', auth=auth):
-            logger.info('%s already in Fedora' % item['handle'])
-            already_in_fedora += 1
-            continue
-        logger.debug('Processing item %s' % item['handle'])
-        metadata = get_record(dspace_oai_uri, dspace_oai_identifier,
-                              item['identifier'], metadata_format)
-        mets = ET.fromstring(metadata)
-        depts = get_collection_names(item['sets'])
+    watermark = Watermark(state_file, start_date)
+    stopping = threading.Event()
+
+    def _stop(signum, frame):
+        logger.info('Signal %s received, finishing items in flight', signum)
+        stopping.set()
 
-        thesis = Thesis(item['handle'], mets, depts)
-        pdf_url = get_pdf_url(mets)
+    handlers = {signum: signal.signal(signum, _stop)
+                for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        while not stopping.is_set():
+            logger.info('Harvesting from %s', watermark.start_date or
+                        'the beginning')
+            metrics.registry.info['watermark'] = watermark.datestamp
+            unlisted = []
 
-        with tempfile.NamedTemporaryFile() as pdf_file:
-            r = requests.get(pdf_url, stream=True)
-            r.raise_for_status()
-            for chunk in r.iter_content(1024):
-                pdf_file.write(chunk)
-            pdf_file.flush()
-            pdf_sparql = thesis.create_file_sparql_update('.pdf')
+            def _listing(item):
+                if stopping.is_set():
+                    unlisted.append(item)
+                    return False
+                return True
 
             try:
-                text_string = extract_text(pdf_file.name)
-                text_sparql = thesis.create_file_sparql_update('.txt')
+                items = takewhile(_listing, (
+                    item for page in get_record_pages(
+                        dspace_oai_uri, metadata_format,
+                        watermark.start_date)
+                    for item in parse_record_list(page)))
+                counts, delta_stats, records = _ingest_items(
+                    items, dspace_oai_uri, dspace_oai_identifier,
+                    metadata_format, fedora_uri, workers, adaptive,
+                    parallel_files, delta, auth, stopping=stopping,
+                    aio=aio)
+            except Exception as e:
+                logger.error('Harvest failed, retrying in %s seconds. %s',
+                             interval, e)
+            else:
+                _log_ingest_counts(counts, delta_stats if delta else None)
+                if unlisted:
+                    logger.info('Harvest stopped before all records were '
+                                'listed, watermark not advanced')
+                elif watermark.advance(records):
+                    logger.info('Watermark advanced to %s', watermark)
+            if once:
+                break
+            stopping.wait(interval)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    logger.info('Harvest daemon stopped at watermark %s', watermark)
+
+
+# Ingest results for items handled successfully, which the harvest watermark
+# may advance past
+INGESTED = ('Not a thesis', 'In Fedora', 'Synced', 'Success', 'Exists')
+
+
+def _ingest_items(items, dspace_oai_uri, dspace_oai_identifier,
+                  metadata_format, fedora_uri, workers, adaptive,
+                  parallel_files, delta, auth, work_queue=None,
+                  retry_failed=False, stopping=None, aio=None):
+    '''Ingest harvested record headers into Fedora, returning the counts of
+    each outcome, the delta sync statistics and a (datestamp, succeeded)
+    tuple for every record. Items are ingested with the foist.aio module if
+    it is given, otherwise with threads.
+
+    Once the stopping event is set, items that have not started yet are
+    returned unprocessed as 'Stopped' while those in flight finish. Records
+    that cannot be ingested are returned as 'Failure', so they hold back
+    the watermark without stopping the harvest.
+    '''
+    from foist.app import Thesis, upload_thesis
+    from foist.sync import DeltaStats, sync_file
+    counts = {'processed': 0, 'not_a_thesis': 0, 'added': 0,
+              'in_fedora': 0, 'no_full_text': 0}
+    delta_stats = DeltaStats()
+    records = []
+
+    def _thesis(item, metadata):
+        mets = ET.fromstring(metadata)
+        depts = get_collection_names(item['sets'])
+        return Thesis(item['handle'], mets, depts), get_pdf_url(mets)
+
+    def _sync(item, thesis, pdf_file, text_file):
+        result, size = sync_file(fedora_uri, 'theses', item['handle'],
+                                 '.pdf', pdf_file.name, 'application/pdf',
+                                 thesis.create_file_sparql_update('.pdf'),
+                                 auth=auth)
+        delta_stats.add(result, size)
+        if result == 'Uploaded':
+            try:
+                extract_text_to_file(pdf_file.name, text_file)
             except Exception as e:
                 logger.debug(e)
-                text_string = None
-                text_sparql = None
-                thesis.no_full_text = 'True'
-                no_full_text += 1
+                return 'Synced', False
+            delta_stats.add(*sync_file(
+                fedora_uri, 'theses', item['handle'], '.txt', text_file,
+                'text/plain', thesis.create_file_sparql_update('.txt'),
+                auth=auth))
+        return 'Synced', False
+
+    # The turtle metadata is generated after extraction, as it records
+    # whether the thesis has full text
+    def _extract(thesis, pdf_file, text_file):
+        try:
+            extract_text_to_file(pdf_file.name, text_file)
+            text_content = text_file
+            text_sparql = thesis.create_file_sparql_update('.txt')
+        except Exception as e:
+            logger.debug(e)
+            text_content = None
+            text_sparql = None
+            thesis.no_full_text = 'True'
+        return text_content, text_sparql, thesis.get_metadata()
+
+    def _ingest(item):
+        if stopping is not None and stopping.is_set():
+            return 'Stopped', False
+        try:
+            return _ingest_record(item)
+        except RECORD_ERRORS as e:
+            logger.debug(e)
+            return 'Failure', False
 
-            turtle = thesis.get_metadata()
+    def _ingest_record(item):
+        logger.debug('Checking item %s', item['handle'])
+        if not is_thesis(item['sets']):
+            return 'Not a thesis', False
+        in_fedora = is_in_fedora(item['handle'], fedora_uri, 'theses',
+                                 auth=auth)
+        if in_fedora and not delta:
+            return 'In Fedora', False
+        logger.debug('Processing item %s', item['handle'])
+        metadata = get_record(dspace_oai_uri, dspace_oai_identifier,
+                              item['identifier'], metadata_format)
+        thesis, pdf_url = _thesis(item, metadata)
+
+        with tempfile.NamedTemporaryFile() as pdf_file, \
+                tempfile.TemporaryFile() as text_file:
+            download_file(pdf_url, pdf_file)
+            if in_fedora:
+                return _sync(item, thesis, pdf_file, text_file)
+            text_content, text_sparql, turtle = _extract(thesis, pdf_file,
+                                                         text_file)
             u = upload_thesis(fedora_uri, 'theses', item['handle'], turtle,
-                              pdf_file.name, pdf_sparql,
-                              text_content=text_string,
-                              text_sparql=text_sparql, auth=auth)
-            if u == 'Success':
-                logger.info('Thesis "%s" uploaded' % item['handle'])
-                added_to_fedora += 1
-            elif u == 'Exists':
-                logger.warning('Item "%s" already in collection' %
-                               item['handle'])
-                already_in_fedora += 1
-            else:
-                logger.warning('Thesis "%s" upload failed' % item['handle'])
+                              pdf_file.name,
+                              thesis.create_file_sparql_update('.pdf'),
+                              text_content=text_content,
+                              text_sparql=text_sparql, auth=auth,
+                              parallel_files=parallel_files)
+        return u, text_content is None
+
+    if aio is not None:
+        results = aio.map_concurrent(
+            lambda item: aio.ingest_item(
+                item, dspace_oai_uri, dspace_oai_identifier, metadata_format,
+                fedora_uri, _thesis, _sync, _extract, auth=auth, delta=delta,
+                parallel_files=parallel_files, stopping=stopping),
+            items, workers)
+    else:
+        # Harvested items are queued with their record headers, as PDF sizes
+        # are not known until each item's METS record is fetched
+        results = _map_items(_ingest, items, workers, adaptive, fedora_uri,
+                             handle=lambda item: item['handle'],
+                             work_queue=work_queue,
+                             payload=lambda item: item,
+                             failed=lambda r: r[0] not in INGESTED,
+                             retry_failed=retry_failed)
+    for item, (u, missing_text) in results:
+        records.append((item.get('datestamp'), u in INGESTED))
+        if u == 'Stopped':
+            continue
+        counts['processed'] += 1
+        counts['no_full_text'] += missing_text
+        metrics.registry.inc('foist_items_total', result=u)
+        if u == 'Not a thesis':
+            counts['not_a_thesis'] += 1
+        elif u == 'In Fedora':
+            logger.info('%s already in Fedora', item['handle'])
+            counts['in_fedora'] += 1
+        elif u == 'Synced':
+            logger.info('Files for item "%s" synced', item['handle'])
+            counts['in_fedora'] += 1
+        elif u == 'Success':
+            logger.info('Thesis "%s" uploaded', item['handle'])
+            counts['added'] += 1
+        elif u == 'Exists':
+            logger.warning('Item "%s" already in collection',
+                           item['handle'])
+            counts['in_fedora'] += 1
+        else:
+            logger.warning('Thesis "%s" upload failed', item['handle'])
+            metrics.registry.fail(item['handle'], u)
+    return counts, delta_stats, records
+
 
+def _log_ingest_counts(counts, delta_stats=None):
     logger.info('\n%s total new items processed\n%s non-thesis items\n%s '
                 'theses added to Fedora\n%s theses already in Fedora\n%s '
-                'theses with no full text' %
-                (total_items_processed, not_a_thesis, added_to_fedora,
-                 already_in_fedora, no_full_text))
+                'theses with no full text',
+                counts['processed'], counts['not_a_thesis'], counts['added'],
+                counts['in_fedora'], counts['no_full_text'])
+    if delta_stats is not None:
+        logger.info('Delta sync: %s', delta_stats)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import gzip
+
+import rdflib
+
+from foist import metrics
+from foist.app import create_has_file_sparql
+from foist.package import insert_graph
+
+
+def item_nquads(thesis, item_uri, file_exts):
+    '''Return the N-Quads for a thesis in a graph named after its item_uri:
+    its metadata, the file metadata of each of its files with the given
+    extensions, and the pcdm:hasFile links to them.
+    '''
+    g = rdflib.ConjunctiveGraph()
+    item = g.get_context(rdflib.URIRef(item_uri))
+    item += thesis.metadata_graph(item_uri)
+    for file_ext in file_exts:
+        file_uri = item_uri + '/' + thesis.name + file_ext
+        item += insert_graph(thesis.create_file_sparql_update(file_ext),
+                             file_uri)
+        item += insert_graph(create_has_file_sparql(file_uri), item_uri)
+    return g.serialize(format='nquads').rstrip(b'\n') + b'\n'
+
+
+@metrics.timed('dump_chunk')
+def compress_chunk(quads):
+    '''Compress the N-Quads of a chunk of items into one gzip member.
+    Members can be written to a file in any order and concatenated, and the
+    result is still a single valid gzip stream.
+    '''
+    data = b''.join(quads)
+    metrics.registry.inc('foist_stage_bytes_total', len(data),
+                         stage='dump_chunk')
+    return gzip.compress(data)
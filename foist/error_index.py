@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bisect import bisect_left
+import csv
+import mmap
+import struct
+
+PDFBOX_ERR = 1
+NO_TEXT_OLD = 2
+NO_TEXT_NEW = 4
+ENCODED_TEXT_NEW = 8
+LIGATURES_NEW = 16
+
+error_flags = {'PDFBox err': PDFBOX_ERR,
+               'No text old file': NO_TEXT_OLD,
+               'No text new file': NO_TEXT_NEW,
+               'Encoded text new file': ENCODED_TEXT_NEW,
+               'Ligatures new': LIGATURES_NEW}
+
+MAGIC = b'FOISTERR1\n'
+HEADER = struct.Struct('<I')
+
+
+class TextErrorIndex(object):
+    '''A compact index of the text errors reported for each item in one or
+    more text encoding error log (.tab) files.
+
+    Only the error columns foist uses are kept, as a small integer bitfield
+    per item, and items with no errors are not stored at all.
+    '''
+    def __init__(self, flags=None):
+        self.flags = flags or {}
+
+    def __len__(self):
+        return len(self.flags)
+
+    @classmethod
+    def from_tab_files(cls, tsv_files):
+        '''Build an index by streaming the rows of the given .tab files,
+        merging the flags of items that appear in more than one file.
+        '''
+        index = cls()
+        for tsv_file in tsv_files:
+            index.update(tsv_file)
+        return index
+
+    def get(self, name, default=None):
+        return self.flags.get(name, default)
+
+    def save(self, path):
+        '''Write the index to a file that can be memory-mapped by
+        load_text_error_index.
+        '''
+        names = sorted(self.flags)
+        encoded = [n.encode('utf-8') for n in names]
+        offsets = [0]
+        for n in encoded:
+            offsets.append(offsets[-1] + len(n))
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(len(names)))
+            f.write(struct.pack('<%dI' % len(offsets), *offsets))
+            f.write(bytes(self.flags[n] for n in names))
+            f.write(b''.join(encoded))
+
+    def update(self, tsv_file):
+        with open(tsv_file) as f:
+            read = csv.reader(f, delimiter='\t')
+            header = next(read, [])
+            subdir = header.index('Subdir')
+            columns = [(header.index(c), bit) for c, bit in
+                       error_flags.items() if c in header]
+            for row in read:
+                if len(row) <= subdir:
+                    continue
+                flags = 0
+                for i, bit in columns:
+                    if i < len(row) and row[i] == '1':
+                        flags |= bit
+                if flags:
+                    name = row[subdir]
+                    self.flags[name] = self.flags.get(name, 0) | flags
+
+
+class MappedTextErrorIndex(object):
+    '''A read-only TextErrorIndex backed by a memory-mapped index file, so
+    lookups do not require loading the whole index into memory.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a text error index file' % path)
+        start = len(MAGIC)
+        self.count = HEADER.unpack_from(self.map, start)[0]
+        self.offsets_start = start + HEADER.size
+        self.flags_start = self.offsets_start + 4 * (self.count + 1)
+        self.names_start = self.flags_start + self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self._name(i)
+
+    def close(self):
+        self.map.close()
+
+    def get(self, name, default=None):
+        key = name.encode('utf-8')
+        i = bisect_left(self, key, 0, self.count)
+        if i < self.count and self._name(i) == key:
+            return self.map[self.flags_start + i]
+        return default
+
+    def _name(self, i):
+        start, end = struct.unpack_from('<2I', self.map,
+                                        self.offsets_start + 4 * i)
+        return self.map[self.names_start + start:self.names_start + end]
+
+
+def has_error_flag(errors, error):
+    '''Returns True if the given text errors, either a row from
+    parse_text_encoding_errors or a bitfield from a TextErrorIndex, report
+    the named error.
+    '''
+    if isinstance(errors, int):
+        return bool(errors & error_flags[error])
+    return errors.get(error) == '1'
+
+
+def load_text_error_index(path):
+    return MappedTextErrorIndex(path)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import datetime
+import json
+import os
+
+
+class Watermark(object):
+    '''The OAI-PMH datestamp up to which records have been harvested, kept in
+    a JSON state file so that each harvest continues where the last one
+    stopped.
+
+    The watermark only advances past records that were handled successfully.
+    If any record of a harvest fails or is not processed it stops at the
+    earliest such record's datestamp, so the record is harvested again.
+    Harvests start from the day of the watermark, as OAI-PMH from dates are
+    inclusive and not every repository supports finer granularity, so
+    records at the edge of a window are listed twice rather than missed;
+    records already in Fedora are then skipped.
+    '''
+    def __init__(self, path, initial=None):
+        self.path = path
+        self.datestamp = initial
+        self.updated = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            self.datestamp = state['datestamp']
+            self.updated = state.get('updated')
+
+    def __str__(self):
+        return self.datestamp or 'none'
+
+    @property
+    def start_date(self):
+        '''The from date to harvest from, or None to harvest everything.
+        '''
+        return self.datestamp[:10] if self.datestamp else None
+
+    def advance(self, records):
+        '''Move the watermark past a harvest of (datestamp, succeeded)
+        tuples and save it. Returns True if it moved.
+        '''
+        failed = [d for d, ok in records if not ok]
+        if failed:
+            datestamp = min(failed)
+        elif records:
+            datestamp = max(d for d, ok in records)
+        else:
+            return False
+        if self.datestamp is not None and datestamp <= self.datestamp:
+            return False
+        self.datestamp = datestamp
+        self.save()
+        return True
+
+    def save(self):
+        '''Write the watermark to its state file, replacing it atomically.
+        '''
+        self.updated = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'datestamp': self.datestamp, 'updated': self.updated},
+                      f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                TimeoutError, wait)
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import threading
+import time
+
+import requests
+
+from foist import metrics, tracing
+from foist.workers import Backoff
+
+log = logging.getLogger(__name__)
+
+# Callables notified of every request as fn(url, latency, status_code), with a
+# status_code of None if the request failed without a response
+observers = []
+
+# (connect, read) timeouts in seconds for each kind of request: existence
+# checks, metadata and RDF requests, and large binary transfers
+timeouts = {'head': (5.0, 30.0),
+            'metadata': (5.0, 60.0),
+            'binary': (10.0, 600.0)}
+
+# Latency percentile after which hedged_request sends a second attempt, or
+# None to disable hedging
+hedge_percentile = None
+
+MIN_HEDGE_SAMPLES = 20
+
+# Connections kept open to each host by the shared session, set from the
+# number of workers by configure_pool
+pool_size = requests.adapters.DEFAULT_POOLSIZE
+
+_executor = None
+_executor_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+
+
+class LatencyWindow(object):
+    '''A thread-safe window of the most recent request latencies, used to
+    estimate latency percentiles.
+    '''
+    def __init__(self, size=200):
+        self.recent = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def add(self, latency):
+        with self.lock:
+            self.recent.append(latency)
+
+    def percentile(self, p):
+        with self.lock:
+            ordered = sorted(self.recent)
+        if not ordered:
+            return None
+        i = min(len(ordered) - 1, int(len(ordered) * p / 100.0))
+        return ordered[i]
+
+
+latencies = {kind: LatencyWindow() for kind in timeouts}
+
+
+def request(method, url, kind=None, **kwargs):
+    '''Send an HTTP request with requests, reporting its latency and status to
+    all registered observers.
+
+    Unless a timeout is given, the connect and read timeouts configured for
+    the kind of request are used, defaulting to 'head' for HEAD requests and
+    'metadata' for everything else.
+    '''
+    kind = kind or ('head' if method == 'HEAD' else 'metadata')
+    kwargs.setdefault('timeout', timeouts[kind])
+    with tracing.span(method, 'http', kind=kind, url=url) as span:
+        start = time.monotonic()
+        try:
+            r = session().request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            _record(method, kind, url, time.monotonic() - start, None)
+            raise
+        latency = time.monotonic() - start
+        span['status'] = r.status_code
+    latencies[kind].add(latency)
+    _record(method, kind, url, latency, r.status_code)
+    return r
+
+
+def hedged_request(method, url, kind=None, **kwargs):
+    '''Send an idempotent request, sending a second identical request if the
+    first has not completed within the hedge_percentile latency of recent
+    requests of the same kind, and return whichever response arrives first.
+
+    The slower response is closed when it arrives. Without hedging enabled,
+    or before enough requests have been timed, this is the same as request.
+    '''
+    kind = kind or ('head' if method == 'HEAD' else 'metadata')
+    window = latencies[kind]
+    if hedge_percentile is None or len(window) < MIN_HEDGE_SAMPLES:
+        return request(method, url, kind, **kwargs)
+    delay = window.percentile(hedge_percentile)
+    executor = _get_executor()
+    first = executor.submit(request, method, url, kind, **kwargs)
+    try:
+        return first.result(timeout=delay)
+    except TimeoutError:
+        pass
+    second = executor.submit(request, method, url, kind, **kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_close_response)
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def is_retryable(error):
+    '''Returns True if an HTTPError is likely to be temporary: a server
+    error, request timeout, rate limit or expired Fedora transaction.
+    '''
+    status = error.response.status_code if error.response is not None \
+        else None
+    return status is None or status >= 500 or status in (408, 410, 429)
+
+
+def retrying(func):
+    '''Decorator retrying an idempotent request function with a Backoff
+    when it raises a connection error, timeout or retryable HTTPError. The
+    last error is raised once every attempt has failed.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        backoff = Backoff()
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except requests.exceptions.HTTPError as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+            attempt += 1
+            if attempt >= backoff.attempts:
+                raise error
+            log.warning('%s failed, retrying', func.__name__)
+            log.debug(error)
+            backoff.sleep(attempt)
+    return wrapper
+
+
+def session():
+    '''Return the requests Session shared by all threads, which keeps
+    connections to Fedora, DSpace and Tika alive between requests instead of
+    opening a new connection for every request.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def configure_pool(workers):
+    '''Size the shared session's connection pools for the given number of
+    worker threads. Each worker may upload an item's files in parallel, and
+    with hedging each request may have a second attempt outstanding. A
+    session or hedging executor already started with a different size is
+    closed, so the next request starts one with the new size.
+    '''
+    global pool_size, _session, _executor
+    size = workers * 2
+    if hedge_percentile is not None:
+        size *= 2
+    size = max(size, requests.adapters.DEFAULT_POOLSIZE)
+    with _session_lock, _executor_lock:
+        if size == pool_size:
+            return
+        if _session is not None:
+            _session.close()
+            _session = None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        pool_size = size
+
+
+@contextmanager
+def observer(fn):
+    '''Register fn as a request observer for the duration of the block.
+    '''
+    observers.append(fn)
+    try:
+        yield fn
+    finally:
+        observers.remove(fn)
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=pool_size)
+        return _executor
+
+
+def _record(method, kind, url, latency, status_code):
+    metrics.registry.inc('foist_http_requests_total', method=method,
+                         kind=kind, status=status_code or 'error')
+    metrics.registry.observe('foist_http_request_seconds', latency,
+                             method=method, kind=kind)
+    _notify(url, latency, status_code)
+
+
+def _notify(url, latency, status_code):
+    for fn in list(observers):
+        fn(url, latency, status_code)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+FORMAT = '%(levelname)s: [%(asctime)s] %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+    '''Formats each log record as a single line JSON object.
+    '''
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(
+                     record.created).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(log_file='logfile.log', max_bytes=1024*1024,
+                      backup_count=3, json_file=None, stream=None):
+    '''Configure the foist logger to hand records to a queue, from which a
+    background listener writes them to stdout, a rotating log file and
+    optionally a rotating JSON-lines log file, so that no file I/O or
+    rotation happens on the threads doing the work.
+
+    Returns the started QueueListener, which must be passed to stop_logging
+    to flush the remaining records before exiting.
+    '''
+    formatter = logging.Formatter(FORMAT)
+    console = logging.StreamHandler(stream or sys.stdout)
+    handlers = [console]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if json_file:
+        handler = logging.handlers.RotatingFileHandler(
+            json_file, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(JSONFormatter())
+        handlers.append(handler)
+
+    records = queue.Queue()
+    logger = logging.getLogger('foist')
+    _remove_handlers(logger)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_logging(listener):
+    '''Write any queued records, close the listener's handlers and detach
+    the queue from the foist logger.
+    '''
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    _remove_handlers(logging.getLogger('foist'))
+
+
+def _remove_handlers(logger):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import logging
+import os
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+class ExportItem(object):
+    '''A single thesis item directory in a DSpace@MIT export, with the size
+    and modification time of each file it contains.
+    '''
+    def __init__(self, name, path, mtime, files):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.files = files
+
+    @property
+    def pdf_file(self):
+        return self.path_for('.pdf') if self.has('.pdf') else None
+
+    @property
+    def text_file(self):
+        if self.has('-new.txt'):
+            return self.path_for('-new.txt')
+        elif self.has('.txt'):
+            return self.path_for('.txt')
+        return None
+
+    @property
+    def xml_file(self):
+        return self.path_for('.xml') if self.has('.xml') else None
+
+    def has(self, suffix):
+        '''Returns True if the item contains the file named after the item
+        with the given suffix, e.g. '.pdf' or '.txt.ru'.
+        '''
+        return self.name + suffix in self.files
+
+    def path_for(self, suffix):
+        return os.path.join(self.path, self.name + suffix)
+
+    def size(self, suffix):
+        return self.files[self.name + suffix][0]
+
+
+class Manifest(object):
+    '''An index of all thesis items in an export directory, built by a single
+    scan of the directory tree.
+    '''
+    def __init__(self, directory, items, files):
+        self.directory = directory
+        self.items = items
+        self.files = files
+
+    def __getitem__(self, name):
+        return self.items[name]
+
+    def __iter__(self):
+        return iter(self.items[name] for name in self.names())
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def error_files(self):
+        '''Paths of the text error reports (*.tab) at the top level of the
+        export directory.
+        '''
+        return [os.path.join(self.directory, f) for f in sorted(self.files)
+                if f.endswith('.tab')]
+
+    def names(self):
+        return sorted(self.items)
+
+    def shard(self, shard):
+        '''Return a Manifest of only the items in the given (index, count)
+        shard, as assigned by in_shard.
+        '''
+        items = {name: item for name, item in self.items.items()
+                 if in_shard(name, shard)}
+        return Manifest(self.directory, items, self.files)
+
+    def save(self, cache_file):
+        data = {'directory': self.directory,
+                'files': self.files,
+                'items': {i.name: {'mtime': i.mtime, 'files': i.files}
+                          for i in self.items.values()}}
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, cache_file)
+
+
+def in_shard(name, shard):
+    '''Returns True if the item with the given name belongs to shard, an
+    (index, count) tuple with index counted from 1. Items are assigned by a
+    stable hash of their name, so every host running a shard of the same
+    export agrees on which items are its own.
+    '''
+    index, count = shard
+    return zlib.crc32(name.encode('utf-8')) % count == index - 1
+
+
+def scan_export(directory, cache_file=None, refresh=False):
+    '''Scan an export directory and return a Manifest of its items.
+
+    If a cache_file is given the manifest is loaded from it and only item
+    directories whose modification time has changed since it was written are
+    scanned again; the updated manifest is then written back to the cache. Set
+    refresh to ignore an existing cache.
+    '''
+    cached = {}
+    if cache_file and not refresh:
+        cached = _load_cache(directory, cache_file)
+    items = {}
+    files = {}
+    rescanned = 0
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            mtime = entry.stat().st_mtime
+            c = cached.get(entry.name)
+            if c is not None and c['mtime'] == mtime:
+                item_files = {k: tuple(v) for k, v in c['files'].items()}
+            else:
+                item_files = _scan_files(entry.path)
+                rescanned += 1
+            items[entry.name] = ExportItem(entry.name, entry.path, mtime,
+                                           item_files)
+        elif entry.is_file():
+            st = entry.stat()
+            files[entry.name] = (st.st_size, st.st_mtime)
+    manifest = Manifest(directory, items, files)
+    log.debug('Scanned %s of %s items in %s', rescanned, len(items),
+              directory)
+    if cache_file:
+        manifest.save(cache_file)
+    return manifest
+
+
+def _load_cache(directory, cache_file):
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+    except (IOError, ValueError) as e:
+        log.debug('Manifest cache %s not loaded. %s', cache_file, e)
+        return {}
+    if data.get('directory') != directory:
+        log.warning('Manifest cache %s is for another directory, ignoring '
+                    'it', cache_file)
+        return {}
+    return data['items']
+
+
+def _scan_files(path):
+    files = {}
+    for entry in os.scandir(path):
+        if entry.is_file():
+            st = entry.stat()
+            files[entry.name] = (st.st_size, st.st_mtime)
+    return files
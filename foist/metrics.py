@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bisect import bisect_left
+from contextlib import contextmanager
+import datetime
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+from foist import profiling, tracing
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 120.0, 300.0, float('inf'))
+
+
+class Histogram(object):
+    '''A latency histogram with fixed buckets.
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''Estimate the q quantile as the upper bound of the bucket it falls
+        in, or None if nothing has been observed.
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    '''A thread-safe registry of counters and latency histograms, each
+    identified by a name and a set of labels, along with the items that
+    failed and information about the run such as its shard.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.finished = None
+            self.counters = {}
+            self.histograms = {}
+            self.failures = []
+            self.info = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def fail(self, item, result):
+        '''Record an item that failed with the given result.
+        '''
+        with self.lock:
+            self.failures.append({'item': item, 'result': result})
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Record the time taken by the block in the named histogram.
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def report(self):
+        '''Return a JSON-serializable summary of all metrics.
+        '''
+        now = self.finished or time.time()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            report = {
+                'started': _isoformat(self.started),
+                'updated': _isoformat(now),
+                'elapsed': round(now - self.started, 3),
+                'info': dict(self.info),
+                'failures': sorted(self.failures,
+                                   key=lambda f: (f['item'], f['result'])),
+                'counters': [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for (name, labels), value in counters],
+                'histograms': [{'name': name, 'labels': dict(labels),
+                                'count': h.count,
+                                'sum': round(h.sum, 6),
+                                'mean': h.sum / h.count,
+                                'p50': h.quantile(0.5),
+                                'p95': h.quantile(0.95),
+                                'p99': h.quantile(0.99),
+                                'buckets': list(h.counts)}
+                               for (name, labels), h in histograms]}
+        for h in report['histograms']:
+            for q in ('p50', 'p95', 'p99'):
+                if h[q] == float('inf'):
+                    h[q] = None
+        return report
+
+    def prometheus(self):
+        '''Return all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            for name in sorted({n for n, labels in self.counters}):
+                lines.append('# TYPE %s counter' % name)
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append('%s%s %s' % (name, _labels(labels),
+                                                  value))
+            for name in sorted({n for n, labels in self.histograms}):
+                lines.append('# TYPE %s histogram' % name)
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        total += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('%s_bucket%s %s' % (
+                            name, _labels(labels + (('le', le),)), total))
+                    lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                                  h.sum))
+                    lines.append('%s_count%s %s' % (name, _labels(labels),
+                                                    h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None, prometheus_file=None):
+        '''Write the JSON report and Prometheus textfile, replacing any
+        previous versions atomically so collectors never see a partial file.
+        '''
+        if json_file:
+            _write_atomic(json_file, json.dumps(self.report(), indent=2,
+                                                sort_keys=True))
+        if prometheus_file:
+            _write_atomic(prometheus_file, self.prometheus())
+
+
+def merge_reports(reports):
+    '''Combine the JSON reports of several runs, such as the shards of one
+    export, into a single Metrics registry. Counters, histograms and failures
+    are added up, and the run spans from the first start to the last update.
+    '''
+    m = Metrics()
+    for report in reports:
+        for c in report['counters']:
+            m.inc(c['name'], c['value'], **c['labels'])
+        for h in report['histograms']:
+            key = (h['name'], tuple(sorted(h['labels'].items())))
+            merged = m.histograms.setdefault(key, Histogram())
+            merged.counts = [a + b for a, b in zip(merged.counts,
+                                                   h['buckets'])]
+            merged.count += h['count']
+            merged.sum += h['sum']
+        m.failures.extend(report['failures'])
+    m.started = min(_timestamp(r['started']) for r in reports)
+    m.finished = max(_timestamp(r['updated']) for r in reports)
+    m.info = {'runs': [r['info'] for r in reports]}
+    return m
+
+
+class Reporter(object):
+    '''Periodically writes the metrics of a registry to a JSON report and a
+    Prometheus textfile from a background thread, and once more when stopped.
+    '''
+    def __init__(self, metrics, json_file=None, prometheus_file=None,
+                 interval=60):
+        self.metrics = metrics
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.write(self.json_file, self.prometheus_file)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.write(self.json_file, self.prometheus_file)
+
+
+# The registry used by foist's own instrumentation
+registry = Metrics()
+
+
+@contextmanager
+def stage(name):
+    '''Record the latency of the block as the given pipeline stage, and
+    trace it as a span and its peak memory if those are enabled.
+    '''
+    with tracing.span(name), profiling.memory(name), \
+            registry.timer('foist_stage_seconds', stage=name):
+        yield
+
+
+def timed(name):
+    '''Decorator recording each call to the function as the given pipeline
+    stage.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+def _timestamp(isoformat):
+    return datetime.datetime.fromisoformat(isoformat).timestamp()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import os
+import re
+import threading
+from urllib.parse import quote, urlsplit
+
+import rdflib
+
+from foist import metrics
+from foist.app import create_has_file_sparql
+from foist.namespaces import PCDM
+
+CHUNK_SIZE = 64 * 1024
+EBUCORE = rdflib.Namespace(
+    'http://www.ebu.ch/metadata/ontologies/ebucore/ebucore#')
+PREMIS = rdflib.Namespace('http://www.loc.gov/premis/rdf/v1#')
+
+PREFIX = re.compile(r'PREFIX\s+(\w*):\s*<([^>]*)>', re.IGNORECASE)
+INSERT = re.compile(r'INSERT\s*\{(.*)\}\s*WHERE\s*\{\s*\}\s*$',
+                    re.IGNORECASE | re.DOTALL)
+
+
+def insert_graph(sparql, uri):
+    '''Return the statements a SPARQL update of the form foist generates,
+    INSERT { ... } WHERE { }, would add to the resource at uri, as a graph.
+    '''
+    if isinstance(sparql, bytes):
+        sparql = sparql.decode('utf-8')
+    m = INSERT.search(sparql)
+    if m is None:
+        raise ValueError('Not an INSERT update: %s' % sparql)
+    prefixes = ''.join('@prefix %s: <%s> .\n' % p
+                       for p in PREFIX.findall(sparql[:m.start()]))
+    g = rdflib.Graph()
+    g.parse(data=prefixes + m.group(1), format='turtle', publicID=uri)
+    return g
+
+
+class ImportPackage(object):
+    '''Writes thesis items to a directory in the layout read by the Fedora
+    import/export utility, so large batches can be loaded into Fedora
+    offline instead of over HTTP.
+
+    Every resource is stored under the path of its URI: item containers as
+    Turtle files, binaries as .binary files and binary descriptions as
+    fcr%3Ametadata.ttl files recording each binary's MIME type, size and
+    SHA-1 digest. A sha1sum-compatible manifest-sha1.txt of every file
+    written is added when the package is closed, so the package can be
+    checked before it is loaded. Items may be added from several threads.
+    '''
+    def __init__(self, directory, fedora_uri):
+        self.directory = directory
+        self.fedora_uri = fedora_uri
+        self.checksums = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, collection_name, handle, turtle, files):
+        '''Write an item's container with its metadata turtle and files,
+        given as (file_ext, path, mimetype, sparql) tuples, linking the item
+        to each file with pcdm:hasFile. Returns the number of bytes written.
+        '''
+        item_uri = self.fedora_uri + collection_name + '/' + handle
+        item = rdflib.Graph()
+        item.parse(data=turtle, format='turtle', publicID=item_uri)
+        size = 0
+        for file_ext, path, mimetype, sparql in files:
+            binary_uri = item_uri + '/' + handle + file_ext
+            size += self._write_binary(binary_uri, path, mimetype, sparql)
+            item += insert_graph(create_has_file_sparql(binary_uri),
+                                 item_uri)
+        size += self._write(item_uri + '.ttl', _turtle(item))
+        metrics.registry.inc('foist_stage_bytes_total', size,
+                             stage='package')
+        return size
+
+    def close(self):
+        '''Write the checksum manifest of all files in the package.
+        '''
+        with self.lock:
+            lines = ['%s  %s\n' % (digest, path)
+                     for path, digest in sorted(self.checksums.items())]
+        with open(os.path.join(self.directory, 'manifest-sha1.txt'),
+                  'w') as f:
+            f.writelines(lines)
+
+    def _write(self, uri, data):
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(uri)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._record(path, digest)
+        return len(data)
+
+    def _write_binary(self, uri, source, mimetype, sparql):
+        path = self._path(uri + '.binary')
+        digest = hashlib.sha1()
+        size = 0
+        with open(source, 'rb') as src, open(path, 'wb') as dest:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dest.write(chunk)
+                size += len(chunk)
+        self._record(path, digest.hexdigest())
+        description = insert_graph(sparql, uri)
+        subject = rdflib.URIRef(uri)
+        description.add((subject, EBUCORE.hasMimeType,
+                         rdflib.Literal(mimetype)))
+        description.add((subject, EBUCORE.filename,
+                         rdflib.Literal(os.path.basename(source))))
+        description.add((subject, PREMIS.hasSize, rdflib.Literal(size)))
+        description.add((subject, PREMIS.hasMessageDigest,
+                         rdflib.URIRef('urn:sha1:' + digest.hexdigest())))
+        return size + self._write(uri + '/fcr:metadata.ttl',
+                                  _turtle(description))
+
+    def _path(self, uri):
+        relative = quote(urlsplit(uri).path.lstrip('/'), safe='/')
+        path = os.path.join(self.directory, *relative.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _record(self, path, digest):
+        with self.lock:
+            self.checksums[os.path.relpath(path, self.directory)] = digest
+
+
+def _turtle(graph):
+    graph.bind('ebucore', EBUCORE)
+    graph.bind('pcdm', PCDM)
+    graph.bind('premis', PREMIS)
+    return graph.serialize(format='turtle')
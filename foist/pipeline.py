@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from functools import lru_cache
 import json
 import logging
 import os
 import requests
 import xml.etree.ElementTree as ET
 
-from tika import parser
+from foist import http, metrics, tracing
+
+CHUNK_SIZE = 64 * 1024
 
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
-with open(CUR_DIR + '/resources/thesis_set_list.json', 'r') as f:
-    THESIS_SET_LIST = json.loads(f.read())
+
+# Errors that fail the ingest of a single harvested record: a request that
+# failed after retrying, a malformed METS record or one without a PDF
+RECORD_ERRORS = (requests.exceptions.RequestException, ET.ParseError,
+                 AttributeError)
 
 mets_namespace = {'mets': 'http://www.loc.gov/METS/',
                   'mods': 'http://www.loc.gov/mods/v3',
@@ -19,24 +25,106 @@ mets_namespace = {'mets': 'http://www.loc.gov/METS/',
 log = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def thesis_set_list():
+    '''Returns the mapping of DSpace thesis set specs to collection names,
+    loaded from the bundled resource the first time it is needed.
+    '''
+    with open(CUR_DIR + '/resources/thesis_set_list.json', 'r') as f:
+        return json.loads(f.read())
+
+
+@lru_cache(maxsize=None)
+def thesis_departments():
+    '''Returns a mapping of DSpace thesis set specs to normalized department
+    names, computed once from thesis_set_list.
+    '''
+    departments = {}
+    for set_spec, name in thesis_set_list().items():
+        name = name.replace(' - ', '(').replace(' (', '(')
+        departments[set_spec] = name.split('(')[0]
+    return departments
+
+
 def extract_text(pdf_file):
+    from tika import parser
     parsed = parser.from_file(pdf_file)
     return parsed['content'].encode('utf-8')
 
 
+@metrics.timed('extract_text')
+def extract_text_to_file(pdf_file, text_file):
+    '''Extracts text from a PDF file into an open binary text_file, streaming
+    it from the Tika server in chunks instead of holding the whole document
+    in memory. Returns the number of bytes written.
+
+    Falls back to extract_text, which starts a local Tika server, if the
+    server is not running yet.
+    '''
+    from tika import tika
+    try:
+        with open(pdf_file, 'rb') as f:
+            r = http.request('PUT', tika.ServerEndpoint + '/tika',
+                             'binary', data=f,
+                             headers={'Accept': 'text/plain'}, stream=True)
+    except requests.exceptions.ConnectionError:
+        text = extract_text(pdf_file)
+        text_file.write(text)
+        text_file.flush()
+        metrics.registry.inc('foist_stage_bytes_total', len(text),
+                             stage='extract_text')
+        tracing.annotate(bytes=len(text))
+        return len(text)
+    r.raise_for_status()
+    size = 0
+    for chunk in r.iter_content(CHUNK_SIZE):
+        text_file.write(chunk)
+        size += len(chunk)
+    text_file.flush()
+    if not size:
+        raise ValueError('No text extracted from %s' % pdf_file)
+    metrics.registry.inc('foist_stage_bytes_total', size,
+                         stage='extract_text')
+    tracing.annotate(bytes=size)
+    return size
+
+
+@metrics.timed('download_pdf')
+def download_file(url, out_file):
+    '''Downloads the file at url into an open binary out_file, streaming it
+    in chunks. Returns the number of bytes written.
+
+    Temporary failures are retried, writing the file again from the position
+    out_file was at when called.
+    '''
+    start = out_file.tell()
+
+    @http.retrying
+    def _download():
+        out_file.seek(start)
+        out_file.truncate()
+        r = http.hedged_request('GET', url, 'binary', stream=True)
+        r.raise_for_status()
+        size = 0
+        with r:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                out_file.write(chunk)
+                size += len(chunk)
+        return size
+
+    size = _download()
+    out_file.flush()
+    metrics.registry.inc('foist_stage_bytes_total', size,
+                         stage='download_pdf')
+    tracing.annotate(bytes=size)
+    return size
+
+
 def get_collection_names(set_specs):
     '''Gets and returns set of normalized collection names from set spec list.
     '''
-    names = set()
-    for set_spec in set_specs:
-        try:
-            name = THESIS_SET_LIST[set_spec]
-            name = name.replace(' - ', '(').replace(' (', '(')
-            split_name = name.split('(')
-            names.add(split_name[0])
-        except KeyError as e:
-            pass
-    return names
+    departments = thesis_departments()
+    return {departments[s] for s in set_specs if s in departments}
 
 
 def get_pdf_url(mets):
@@ -48,6 +136,8 @@ def get_pdf_url(mets):
     return url
 
 
+@metrics.timed('get_record')
+@http.retrying
 def get_record(dspace_oai_uri, dspace_oai_identifier, identifier,
                metadata_format):
     '''Gets metadata record for a single item in OAI-PMH repository in
@@ -56,10 +146,12 @@ def get_record(dspace_oai_uri, dspace_oai_identifier, identifier,
     params = {'verb': 'GetRecord',
               'identifier': dspace_oai_identifier + identifier,
               'metadataPrefix': metadata_format}
-    r = requests.get(dspace_oai_uri, params=params)
+    r = http.hedged_request('GET', dspace_oai_uri, params=params)
+    r.raise_for_status()
     return r.text
 
 
+@metrics.timed('harvest')
 def get_record_list(dspace_oai_uri, metadata_format, start_date=None,
                     end_date=None):
     '''Returns a list of record headers for items in OAI-PMH repository. Must
@@ -73,29 +165,50 @@ def get_record_list(dspace_oai_uri, metadata_format, start_date=None,
     if end_date:
         params['until'] = end_date
 
-    r = requests.get(dspace_oai_uri, params=params)
+    r = http.request('GET', dspace_oai_uri, params=params)
     return r.text
 
 
+def get_record_pages(dspace_oai_uri, metadata_format, start_date=None,
+                     end_date=None):
+    '''Yields each page of record headers for items in OAI-PMH repository,
+    following resumption tokens until the list is complete. Takes the same
+    arguments as get_record_list.
+    '''
+    page = get_record_list(dspace_oai_uri, metadata_format, start_date,
+                           end_date)
+    while True:
+        yield page
+        token = ET.fromstring(page).find('.//oai:resumptionToken',
+                                         mets_namespace)
+        if token is None or not token.text:
+            return
+        params = {'verb': 'ListIdentifiers', 'resumptionToken': token.text}
+        with metrics.stage('harvest'):
+            page = http.request('GET', dspace_oai_uri, params=params).text
+
+
+@http.retrying
 def is_in_fedora(handle, fedora_uri, parent_container, auth=None):
     '''Returns True if given thesis item is already in the given Fedora
     repository, otherwise returns False.
     '''
     url = fedora_uri + parent_container + '/' + handle
-    r = requests.head(url, auth=auth)
+    r = http.hedged_request('HEAD', url, auth=auth, allow_redirects=False)
     if r.status_code == 200:
         return True
     elif r.status_code == 404:
         return False
     else:
-        raise requests.exceptions.HTTPError(r)
+        raise requests.exceptions.HTTPError(r, response=r)
 
 
 def is_thesis(sets):
     '''Returns True if any set_spec in given sets is in the
     thesis_set_spec_list, otherwise returns false.
     '''
-    return any((s in THESIS_SET_LIST.keys() for s in sets))
+    thesis_sets = thesis_set_list()
+    return any(s in thesis_sets for s in sets)
 
 
 def parse_record_list(record_xml):
@@ -107,4 +220,6 @@ def parse_record_list(record_xml):
         identifier = handle.replace('1721.1-', '')
         setSpecs = record.findall('oai:setSpec', mets_namespace)
         sets = [s.text for s in setSpecs]
-        yield {'handle': handle, 'identifier': identifier, 'sets': sets}
+        datestamp = record.find('oai:datestamp', mets_namespace).text
+        yield {'handle': handle, 'identifier': identifier, 'sets': sets,
+               'datestamp': datestamp}
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+# The active Profiler or Sampler, or None when not profiling
+profiler = None
+
+# The active StageMemory tracker, or None when memory is not being traced
+stage_memory = None
+
+
+class Profiler(object):
+    '''Profiles the calling thread with cProfile, writing a pstats file and a
+    summary of the top functions by cumulative time.
+    '''
+    def __init__(self, top=25):
+        self.top = top
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.profile.disable()
+
+    def summary(self):
+        s = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=s)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return s.getvalue()
+
+    def write(self, path):
+        '''Write the pstats file to path and the summary to path.txt.
+        '''
+        self.profile.dump_stats(path)
+        with open(path + '.txt', 'w') as f:
+            f.write(self.summary())
+
+
+def sample_threads(threaded):
+    '''Switch an active Profiler to a Sampler if the command runs its work
+    on other threads, as cProfile only profiles the main thread. The samples
+    replace the pstats file at the profile path.
+    '''
+    global profiler
+    if threaded and isinstance(profiler, Profiler):
+        profiler.stop()
+        profiler = Sampler(profiler.top).start()
+        log.warning('cProfile only profiles the main thread, so the worker '
+                    'threads are sampled instead')
+
+
+class Sampler(object):
+    '''A sampling profiler for long runs, which periodically records the
+    stack of every running thread from a background thread. Unlike Profiler
+    it includes worker threads and adds little overhead.
+    '''
+    def __init__(self, top=25, interval=0.005):
+        self.top = top
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self):
+        '''Return the top functions by the share of samples in which they
+        were running (self) or on the stack (total).
+        '''
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        lines = ['%s samples of all threads every %ss' % (self.samples,
+                                                         self.interval)]
+        for title, counts in (('self', own), ('total', total)):
+            lines.append('')
+            lines.append('%8s  %6s  function' % ('samples', title))
+            for function, count in counts.most_common(self.top):
+                lines.append('%8d  %5.1f%%  %s' % (
+                    count, 100.0 * count / max(1, self.samples), function))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Write the samples to path as collapsed stacks, the input format of
+        flame graph tools, and the summary to path.txt.
+        '''
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (';'.join(stack), count))
+        with open(path + '.txt', 'w') as f:
+            f.write(self.summary())
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+
+class StageMemory(object):
+    '''Records the peak memory allocated during each pipeline stage with
+    tracemalloc. Peaks are approximate when stages run concurrently.
+
+    tracemalloc has a single peak, which is reset as each stage starts. The
+    peak reached so far by the enclosing stages on the same thread is kept
+    on a stack first, and a stage's peak is carried up to its parent when it
+    ends, so outer stages still report the peak of everything they contain.
+    '''
+    def __init__(self):
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self):
+        tracemalloc.start()
+        return self
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        # [memory at the start of the stage, highest peak seen in it]
+        frame = [current, current]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            with self.lock:
+                self.peaks[name] = max(peak - frame[0],
+                                       self.peaks.get(name, 0))
+
+    def summary(self):
+        lines = ['%12s  stage' % 'peak bytes']
+        for name, peak in sorted(self.peaks.items(), key=lambda p: -p[1]):
+            lines.append('%12d  %s' % (peak, name))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def memory(name):
+    '''Record the peak memory of the block as the given stage if stage memory
+    is being traced.
+    '''
+    if stage_memory is None:
+        yield
+    else:
+        with stage_memory.stage(name):
+            yield
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import logging
+import threading
+
+import rdflib
+from rdflib.namespace import XSD
+import requests
+
+from foist import http
+from foist.app import (create_has_file_sparql, Thesis, update_metadata,
+                       upload_content)
+from foist.namespaces import BIBO, PCDM, RDF
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+PREMIS = rdflib.Namespace('http://www.loc.gov/premis/rdf/v1#')
+
+# rdf:type statements foist manages; Fedora adds its own types to every item
+managed_types = (BIBO.Thesis, PCDM.Object)
+
+
+class DeltaStats(object):
+    '''Thread-safe counts and byte totals of files uploaded and skipped by
+    sync_file.
+    '''
+    def __init__(self):
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return ('%s files unchanged (%s bytes skipped), %s files uploaded (%s '
+                'bytes)' % (self.skipped, self.skipped_bytes, self.uploaded,
+                            self.uploaded_bytes))
+
+    def add(self, result, size):
+        with self.lock:
+            if result == 'Unchanged':
+                self.skipped += 1
+                self.skipped_bytes += size
+            else:
+                self.uploaded += 1
+                self.uploaded_bytes += size
+
+
+def create_sparql_diff(deletes, inserts):
+    '''Create a SPARQL update query removing and adding the given
+    (predicate, object) statements about an item.
+    '''
+    def _statements(pairs):
+        return ''.join(' <> %s %s .' % (p.n3(), o.n3()) for p, o in
+                       sorted(pairs))
+    return ('DELETE {%s } INSERT {%s } WHERE { }' %
+            (_statements(deletes), _statements(inserts)))
+
+
+def diff_metadata(current, turtle, item_uri):
+    '''Compare an item's current metadata graph from Fedora with freshly
+    generated turtle metadata, returning (deletes, inserts) sets of
+    (predicate, object) pairs.
+
+    Only statements foist generates are compared, so server-managed triples
+    and file relationships are left alone.
+    '''
+    new = rdflib.Graph()
+    new.parse(data=turtle, format='turtle', publicID=item_uri)
+    old = _managed_statements(current, item_uri)
+    generated = _managed_statements(new, item_uri)
+    return old - generated, generated - old
+
+
+def file_digest(local_file):
+    '''Return the SHA-1 hex digest and size of a file, given either its path
+    or an open binary file object, reading it in chunks.
+    '''
+    if not hasattr(local_file, 'read'):
+        with open(local_file, 'rb') as f:
+            return file_digest(f)
+    local_file.seek(0)
+    digest = hashlib.sha1()
+    size = 0
+    for chunk in iter(lambda: local_file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    local_file.seek(0)
+    return digest.hexdigest(), size
+
+
+def get_binary_digest(binary_uri, auth=None):
+    '''Return the SHA-1 hex digest Fedora holds for a binary, or None if the
+    binary does not exist.
+    '''
+    uri = binary_uri.rstrip('/') + '/fcr:metadata'
+    r = http.request('GET', uri, headers={'Accept': 'text/turtle'},
+                     auth=auth)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    g = rdflib.Graph()
+    g.parse(data=r.text, format='turtle', publicID=uri)
+    for digest in g.objects(None, PREMIS.hasMessageDigest):
+        if str(digest).startswith('urn:sha1:'):
+            return str(digest)[len('urn:sha1:'):]
+    return None
+
+
+def get_item_graph(uri, auth=None):
+    '''Get the current metadata graph of an item in Fedora, without
+    server-managed triples.
+    '''
+    headers = {'Accept': 'text/turtle',
+               'Prefer': ('return=representation; omit="http://fedora.info/'
+                          'definitions/v4/repository#ServerManaged"')}
+    r = http.request('GET', uri, headers=headers, auth=auth)
+    r.raise_for_status()
+    g = rdflib.Graph()
+    g.parse(data=r.text, format='turtle', publicID=uri)
+    return g
+
+
+def sync_file(fedora_uri, collection_name, handle, file_ext, local_file,
+              mimetype, sparql, auth=None):
+    '''Upload a thesis file to an existing item only if its content differs
+    from the binary already in Fedora, comparing SHA-1 digests.
+
+    local_file is a path or an open binary file object. If the item has no
+    such binary yet it is created along with its metadata and pcdm:hasFile
+    relationship. Returns a (result, size) tuple where result is 'Unchanged'
+    or 'Uploaded'.
+    '''
+    item_uri = fedora_uri + collection_name + '/' + handle + '/'
+    binary_uri = item_uri + handle + file_ext + '/'
+    local_digest, size = file_digest(local_file)
+    remote_digest = get_binary_digest(binary_uri, auth=auth)
+    if remote_digest == local_digest:
+        return 'Unchanged', size
+    if hasattr(local_file, 'read'):
+        upload_content(binary_uri, local_file, mimetype, auth=auth)
+    else:
+        with open(local_file, 'rb') as f:
+            upload_content(binary_uri, f, mimetype, auth=auth)
+    if remote_digest is None:
+        update_metadata(binary_uri + 'fcr:metadata', sparql, auth=auth)
+        update_metadata(item_uri, create_has_file_sparql(binary_uri),
+                        auth=auth)
+    return 'Uploaded', size
+
+
+def sync_thesis_metadata(item_uri, turtle, auth=None):
+    '''Update an existing item's metadata in Fedora to match the given turtle
+    metadata, sending only the statements that changed. Returns 'Updated' or
+    'Unchanged'.
+    '''
+    current = get_item_graph(item_uri, auth=auth)
+    deletes, inserts = diff_metadata(current, turtle, item_uri)
+    if not deletes and not inserts:
+        return 'Unchanged'
+    log.debug('Item %s: %s statements removed, %s added',
+              item_uri, len(deletes), len(inserts))
+    update_metadata(item_uri, create_sparql_diff(deletes, inserts),
+                    auth=auth)
+    return 'Updated'
+
+
+def _managed_statements(graph, item_uri):
+    subject = item_uri.rstrip('/')
+    statements = set()
+    for s, p, o in graph:
+        if str(s).rstrip('/') != subject:
+            continue
+        if p not in Thesis.metadata_predicates:
+            continue
+        if p == RDF.type and o not in managed_types:
+            continue
+        if isinstance(o, rdflib.Literal) and o.datatype == XSD.string:
+            o = rdflib.Literal(str(o), lang=o.language)
+        statements.add((p, o))
+    return statements
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# The active Tracer, or None when tracing is disabled
+tracer = None
+
+_local = threading.local()
+
+
+class Tracer(object):
+    '''Collects timed spans from any number of threads and writes them as a
+    Chrome trace-event file, which can be opened in chrome://tracing or
+    Perfetto.
+    '''
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': round((start - self.start) * 1e6, 3),
+                 'dur': round((end - start) * 1e6, 3),
+                 'pid': self.pid, 'tid': thread.ident, 'args': args}
+        with self.lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def write(self, path):
+        with self.lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                      'tid': tid, 'args': {'name': name}}
+                     for tid, name in sorted(self.threads.items())]
+            events = names + self.events
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+@contextmanager
+def span(name, category='foist', **args):
+    '''Record the block as a span with the given arguments if tracing is
+    enabled, yielding the arguments dict so details such as a status can be
+    added to it. Spans inherit the handle of the span they are nested in.
+    '''
+    t = tracer
+    if t is None:
+        yield args
+        return
+    stack = _stack()
+    if stack and 'handle' in stack[-1]:
+        args.setdefault('handle', stack[-1]['handle'])
+    stack.append(args)
+    start = time.perf_counter()
+    try:
+        yield args
+    except Exception as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        t.add(name, category, start, time.perf_counter(), args)
+
+
+def annotate(**args):
+    '''Add arguments to the innermost open span on this thread.
+    '''
+    if tracer is None:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].update(args)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
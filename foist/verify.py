@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import logging
+import os
+
+import rdflib
+
+from foist import http
+from foist.namespaces import PCDM
+from foist.sync import file_digest, get_binary_digest, PREMIS
+
+log = logging.getLogger(__name__)
+
+LDP = rdflib.Namespace('http://www.w3.org/ns/ldp#')
+EMBED_RESOURCES = 'http://fedora.info/definitions/v4/repository#EmbedResources'
+
+
+def list_container(uri, auth=None):
+    '''Return the URIs of the resources a Fedora container holds, from a
+    single request for its containment triples, or None if the container
+    does not exist.
+    '''
+    headers = {'Accept': 'text/turtle',
+               'Prefer': ('return=representation; include="%s"' %
+                          LDP.PreferContainment)}
+    g = _get_graph(uri, headers, auth)
+    if g is None:
+        return None
+    return {str(o).rstrip('/') for s, o in g.subject_objects(LDP.contains)
+            if str(s).rstrip('/') == uri.rstrip('/')}
+
+
+def get_item_files(item_uri, auth=None):
+    '''Return the binaries an item links to with pcdm:hasFile, mapped to the
+    SHA-1 hex digest Fedora holds for each, or None if the item does not
+    exist.
+
+    The descriptions of the item's children are embedded in its
+    representation, so one request usually covers the item and all of its
+    files. Digests missing from it are requested from each binary.
+    '''
+    headers = {'Accept': 'text/turtle',
+               'Prefer': ('return=representation; include="%s"' %
+                          EMBED_RESOURCES)}
+    g = _get_graph(item_uri, headers, auth)
+    if g is None:
+        return None
+    digests = {}
+    for s, o in g.subject_objects(PREMIS.hasMessageDigest):
+        if str(o).startswith('urn:sha1:'):
+            digests[str(s).rstrip('/')] = str(o)[len('urn:sha1:'):]
+    files = {}
+    for s, o in g.subject_objects(PCDM.hasFile):
+        if str(s).rstrip('/') != item_uri.rstrip('/'):
+            continue
+        uri = str(o).rstrip('/')
+        files[uri] = digests.get(uri) or get_binary_digest(uri, auth=auth)
+    return files
+
+
+def verify_item(item_uri, files, auth=None, exists=True):
+    '''Check an item in Fedora against its local files, given as a mapping
+    of binary URIs to local paths. Returns a (result, problems) tuple, where
+    result is 'Verified', 'Missing' or 'Failed' and problems maps the local
+    path of each file that failed to 'Not linked' or 'Digest mismatch'.
+
+    Pass exists=False if the item is already known to be missing from a
+    container listing, so no request is made for it.
+    '''
+    remote = get_item_files(item_uri, auth=auth) if exists else None
+    if remote is None:
+        return 'Missing', {}
+    problems = {}
+    for uri, path in files.items():
+        if uri not in remote:
+            problems[path] = 'Not linked'
+        elif remote[uri] != file_digest(path)[0]:
+            problems[path] = 'Digest mismatch'
+    return ('Failed' if problems else 'Verified'), problems
+
+
+def write_report(path, report):
+    '''Write a verification report as JSON, replacing any existing file.
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _get_graph(uri, headers, auth):
+    r = http.request('GET', uri, headers=headers, auth=auth)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    g = rdflib.Graph()
+    g.parse(data=r.text, format='turtle', publicID=uri)
+    return g
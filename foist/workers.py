@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter(object):
+    '''An AIMD concurrency limit for a pool of workers, driven by the latency
+    and errors of the requests they make.
+
+    The limit grows by one for every limit requests that succeed without the
+    smoothed latency rising above tolerance times its baseline, and halves at
+    most once per limit requests when a request fails with a 5xx status, 429
+    or a connection error or timeout, or when latency rises. Register
+    observe as an http request observer and wrap each task in acquire and
+    release.
+    '''
+    def __init__(self, max_limit, min_limit=1, initial=None, url_prefix=None,
+                 tolerance=2.0, smoothing=0.2):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial or min(max_limit, max(min_limit, 4)))
+        self.url_prefix = url_prefix
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.active = 0
+        self.latency = None
+        self.baseline = None
+        self.since_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def observe(self, url, latency, status_code):
+        if self.url_prefix and not url.startswith(self.url_prefix):
+            return
+        congested = (status_code is None or status_code >= 500 or
+                     status_code == 429)
+        with self.cond:
+            if not congested:
+                congested = self._update_latency(latency)
+            self.since_decrease += 1
+            if not congested:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.cond.notify_all()
+            elif self.since_decrease >= self.limit:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.since_decrease = 0
+                log.debug('Concurrency limit reduced to %d', self.limit)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def _update_latency(self, latency):
+        if self.latency is None:
+            self.latency = self.baseline = latency
+            return False
+        self.latency += self.smoothing * (latency - self.latency)
+        if self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            # Let the baseline follow a lasting change in Fedora's speed
+            self.baseline += 0.01 * (self.latency - self.baseline)
+        return self.latency > self.baseline * self.tolerance
+
+
+class Backoff(object):
+    '''A retry policy of up to attempts tries, sleeping for an exponentially
+    growing, randomly jittered delay between them.
+    '''
+    def __init__(self, attempts=5, base=0.5, cap=30.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        '''Return the delay before retrying after the given failed attempt,
+        numbered from 1.
+        '''
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def sleep(self, attempt):
+        time.sleep(self.delay(attempt))
+
+
+class Progress(object):
+    '''Tracks the number of completed items in a long-running batch and
+    periodically logs throughput and an estimated time remaining.
+    '''
+    def __init__(self, total, label='items', interval=10):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.done / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self):
+        '''Estimated seconds until all items are done, or None if unknown.
+        '''
+        rate = self.rate
+        if not rate or self.total is None:
+            return None
+        return (self.total - self.done) / rate
+
+    def finish(self):
+        self.report()
+
+    def report(self):
+        eta = self.eta
+        log.info('%s/%s %s done, %.1f/s, ETA %s',
+                 self.done, self.total if self.total is not None else '?',
+                 self.label, self.rate,
+                 '%ds' % eta if eta is not None else 'unknown')
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        self.report()
+
+
+class TokenBucket(object):
+    '''A thread-safe token bucket rate limiter allowing on average rate
+    acquisitions per second, with bursts of up to capacity.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a token is available, then take it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def map_concurrent(func, items, workers=1, limiter=None):
+    '''Call func on each of the given items using a pool of worker threads,
+    yielding (item, result) tuples as each call completes.
+
+    With a single worker items are processed serially in order, without
+    starting any threads. If an AdaptiveLimiter is given, workers is the
+    maximum pool size and the limiter decides how many calls run at once.
+    Items are taken from the iterable only as workers become free, so at
+    most workers calls are in flight and results are not held once yielded.
+    '''
+    if limiter is not None:
+        def _limited(item, func=func):
+            limiter.acquire()
+            try:
+                return func(item)
+            finally:
+                limiter.release()
+        func = _limited
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, item): item
+                   for item in islice(items, workers)}
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = futures.pop(future)
+                yield item, future.result()
+            for item in islice(items, len(done)):
+                futures[executor.submit(func, item)] = item
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import logging
+import os
+from queue import Queue
+import socket
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Task(object):
+    '''An item claimed from a WorkQueue.
+    '''
+    def __init__(self, name, size, payload, attempts):
+        self.name = name
+        self.size = size
+        self.payload = payload
+        self.attempts = attempts
+
+
+class WorkQueue(object):
+    '''A durable queue of items to process, kept in a SQLite database that
+    any number of foist processes on any number of hosts can share.
+
+    Workers claim items largest first, taking a lease on each that they
+    renew while they work on it. If a worker dies its leases expire and the
+    items are handed to other workers, up to max_attempts times, after which
+    they are marked failed. Adding an item that is already queued, in
+    progress or done has no effect, so every worker can enqueue the same
+    batch; failed items are only queued again if asked to.
+
+    Hosts sharing a queue need reasonably synchronized clocks and a
+    filesystem with working POSIX locks for SQLite.
+    '''
+    def __init__(self, path, lease=600, max_attempts=3, worker=None):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker = worker or '%s:%s' % (socket.gethostname(), os.getpid())
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                              'name TEXT PRIMARY KEY, size INTEGER, '
+                              'payload TEXT, state TEXT, worker TEXT, '
+                              'expires REAL, attempts INTEGER, result TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tasks_by_size ON '
+                              'tasks (state, size DESC, name)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def put(self, items, retry_failed=False):
+        '''Add (name, size, payload) tuples to the queue, where payload is
+        any JSON-serializable value or None. With retry_failed, items that
+        failed before are queued again. Returns the number added.
+        '''
+        rows = [(name, size, json.dumps(payload)) for name, size, payload
+                in items]
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO tasks (name, size, '
+                                  'payload, state, attempts) VALUES '
+                                  "(?, ?, ?, 'pending', 0)", rows)
+            if retry_failed:
+                self.conn.executemany(
+                    "UPDATE tasks SET state = 'pending', attempts = 0, "
+                    "result = NULL WHERE state = 'failed' AND name = ?",
+                    [(row[0],) for row in rows])
+            self.conn.execute('COMMIT')
+            return self.conn.total_changes - before
+
+    def claim(self):
+        '''Lease the largest item that is pending or whose lease has expired,
+        returning it as a Task, or None if there is nothing left to claim.
+        '''
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute(
+                    "UPDATE tasks SET state = 'failed', result = ? WHERE "
+                    "state = 'leased' AND expires < ? AND attempts >= ?",
+                    (json.dumps('Expired'), now, self.max_attempts))
+                r = self.conn.execute(
+                    "SELECT name, size, payload, attempts FROM tasks WHERE "
+                    "state = 'pending' OR (state = 'leased' AND expires < ?) "
+                    "ORDER BY size DESC, name LIMIT 1", (now,)).fetchone()
+                if r is not None:
+                    self.conn.execute(
+                        "UPDATE tasks SET state = 'leased', worker = ?, "
+                        "expires = ?, attempts = attempts + 1 WHERE name = ?",
+                        (self.worker, now + self.lease, r[0]))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        if r is None:
+            return None
+        return Task(r[0], r[1], json.loads(r[2]), r[3] + 1)
+
+    def complete(self, task, result):
+        '''Mark a claimed task done with a JSON-serializable result.
+        '''
+        self._finish(task, "state = 'done', result = ?", (json.dumps(result),))
+
+    def fail(self, task, result):
+        '''Mark a claimed task failed with a JSON-serializable result.
+        '''
+        self._finish(task, "state = 'failed', result = ?",
+                     (json.dumps(result),))
+
+    def release(self, task):
+        '''Give up the lease on a task so another worker can claim it.
+        '''
+        self._finish(task, "state = 'pending'", ())
+
+    def renew(self):
+        '''Extend the leases on every task this worker holds.
+        '''
+        with self.lock:
+            self.conn.execute("UPDATE tasks SET expires = ? WHERE "
+                              "state = 'leased' AND worker = ?",
+                              (time.time() + self.lease, self.worker))
+
+    def counts(self):
+        '''Return the number of tasks in each state.
+        '''
+        with self.lock:
+            r = self.conn.execute('SELECT state, COUNT(*) FROM tasks GROUP '
+                                  'BY state')
+            return dict(r.fetchall())
+
+    def results(self, state='done'):
+        '''Return (name, result) tuples for the tasks in the given state.
+        '''
+        with self.lock:
+            r = self.conn.execute('SELECT name, result FROM tasks WHERE '
+                                  'state = ? ORDER BY name', (state,))
+            return [(name, json.loads(result) if result else None)
+                    for name, result in r]
+
+    def _finish(self, task, assignment, args):
+        with self.lock:
+            self.conn.execute('UPDATE tasks SET %s, worker = NULL, '
+                              'expires = NULL WHERE name = ? AND worker = ?'
+                              % assignment, args + (task.name, self.worker))
+
+
+def drain(queue, func, workers=1, limiter=None, failed=None):
+    '''Claim and process tasks from a WorkQueue until none are left, calling
+    func on each Task with a pool of worker threads and yielding (task,
+    result) tuples as each call completes. Tasks are marked done, or failed
+    if the failed function returns True for their result.
+
+    Leases are renewed in the background while tasks are processed. If func
+    raises, its task is released for another worker, no more tasks are
+    claimed and the exception is raised once running calls finish.
+    '''
+    results = Queue()
+    stopped = threading.Event()
+
+    def _run():
+        try:
+            while not stopped.is_set():
+                task = queue.claim()
+                if task is None:
+                    break
+                if limiter is not None:
+                    limiter.acquire()
+                try:
+                    result = func(task)
+                except Exception as e:
+                    queue.release(task)
+                    stopped.set()
+                    results.put((task, e, True))
+                    break
+                finally:
+                    if limiter is not None:
+                        limiter.release()
+                if failed is not None and failed(result):
+                    queue.fail(task, result)
+                else:
+                    queue.complete(task, result)
+                results.put((task, result, False))
+        finally:
+            results.put(None)
+
+    heartbeat = threading.Thread(target=_renew, args=(queue, stopped),
+                                 daemon=True)
+    threads = [threading.Thread(target=_run, daemon=True)
+               for i in range(workers)]
+    heartbeat.start()
+    for t in threads:
+        t.start()
+    error = None
+    running = len(threads)
+    try:
+        while running:
+            r = results.get()
+            if r is None:
+                running -= 1
+            elif r[2]:
+                error = error or r[1]
+            else:
+                yield r[0], r[1]
+    finally:
+        stopped.set()
+        for t in threads:
+            t.join()
+        heartbeat.join()
+    if error is not None:
+        raise error
+
+
+def _renew(queue, stopped):
+    while not stopped.wait(queue.lease / 3.0):
+        try:
+            queue.renew()
+        except sqlite3.Error as e:
+            log.warning('Work queue leases not renewed. %s', e)
@@ -28,11 +28,15 @@ setup(
     author='Helen Bailey',
     author_email='hbailey@mit.edu',
     packages=find_packages(exclude=['tests']),
+    python_requires='>=3.9',
     install_requires=[
         'click',
         'rdflib',
         'requests',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     entry_points={
         'console_scripts': [
             'foist=foist.cli:main',
@@ -42,6 +46,6 @@ setup(
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.9',
     ],
 )
@@ -123,6 +123,13 @@ def fedora_errors():
         yield m
 
 
+@pytest.yield_fixture
+def tika_server():
+    with requests_mock.Mocker() as m:
+        m.put('http://localhost:9998/tika', content=b'Extracted text.')
+        yield m
+
+
 @pytest.yield_fixture
 def pipeline():
     with requests_mock.Mocker() as m:
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+'''Lightweight local stand-ins for the Fedora, DSpace and Tika services foist
+talks to, for end-to-end tests and throughput benchmarks over real HTTP.
+
+Each server runs in a background thread on a free localhost port and can
+add latency, random 503 errors and a bandwidth limit to every request. They
+count requests and TCP connections, so connection reuse can be measured.
+'''
+from __future__ import absolute_import
+import datetime
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+HAS_FILE = re.compile(r'pcdm:hasFile\s+<([^>]+)>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.standin._count('connections')
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        standin = self.server.standin
+        standin._count('requests')
+        body = self._read_body()
+        if standin.latency:
+            time.sleep(standin.latency)
+        if standin._fail():
+            status, headers, data = 503, {}, b''
+        else:
+            status, headers, data = standin.handle(self.command, self.path,
+                                                   self.headers, body)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            standin._throttle(len(data))
+            self.wfile.write(data)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    break
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length',
+                                                        0)))
+        self.server.standin._throttle(len(body))
+        return body
+
+    do_DELETE = do_GET = do_HEAD = do_PATCH = do_POST = do_PUT = _handle
+
+
+class StandIn(object):
+    '''Base class for the stand-in servers. latency is added to every
+    request in seconds, error_rate is the fraction of requests answered
+    with 503 and bandwidth limits request and response bodies to that many
+    bytes per second.
+    '''
+    def __init__(self, latency=0.0, error_rate=0.0, bandwidth=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'connections': 0}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, headers, body):
+        '''Return a (status, headers, body) response to a request.
+        '''
+        raise NotImplementedError
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            time.sleep(size / float(self.bandwidth))
+
+
+class FedoraServer(StandIn):
+    '''Imitates the subset of the Fedora 4 REST API foist uses: containers
+    and binaries created with PUT, SPARQL updates with PATCH, HEAD, GET,
+    DELETE and transactions with commit and rollback.
+
+    Creating a resource that already exists returns 409. SPARQL updates are
+    recorded rather than applied, except that pcdm:hasFile relationships
+    are added to the item's RDF. Binaries report their SHA-1 digest in their
+    fcr:metadata description. Containers list their children with
+    ldp:contains, and embed the children's descriptions if asked to with
+    the EmbedResources preference.
+    '''
+    def __init__(self, **kwargs):
+        StandIn.__init__(self, **kwargs)
+        self.resources = {}
+        self.transactions = {}
+        self.tx_ids = itertools.count(1)
+
+    @property
+    def url(self):
+        return self.base_url + '/rest/'
+
+    def handle(self, method, path, headers, body):
+        path = urlsplit(path).path
+        if not path.startswith('/rest/'):
+            return 404, {}, b''
+        path = path[len('/rest/'):].rstrip('/')
+        if path == 'fcr:tx' and method == 'POST':
+            return self._begin()
+        tx = None
+        if path.startswith('tx:'):
+            tx_id, _, path = path.partition('/')
+            with self.lock:
+                tx = self.transactions.get(tx_id)
+            if tx is None:
+                return 410, {}, b''
+            if path in ('fcr:tx/fcr:commit', 'fcr:tx/fcr:rollback'):
+                return self._end(tx_id, path.endswith('commit'))
+        with self.lock:
+            return self._resource(method, path, headers, body, tx)
+
+    def _begin(self):
+        with self.lock:
+            tx_id = 'tx:%s' % next(self.tx_ids)
+            self.transactions[tx_id] = {}
+        return 201, {'Location': self.url + tx_id}, b''
+
+    def _end(self, tx_id, commit):
+        with self.lock:
+            tx = self.transactions.pop(tx_id)
+            if commit:
+                self.resources.update(tx)
+        return 204, {}, b''
+
+    def _get(self, path, tx):
+        if tx is not None and path in tx:
+            return tx[path]
+        return self.resources.get(path)
+
+    def _resource(self, method, path, headers, body, tx):
+        writes = tx if tx is not None else self.resources
+        metadata = path.endswith('/fcr:metadata')
+        if metadata:
+            path = path[:-len('/fcr:metadata')]
+        resource = self._get(path, tx)
+        if method == 'PUT':
+            if resource is not None:
+                return 409, {}, b''
+            writes[path] = {'type': headers.get('Content-Type', ''),
+                            'body': body, 'updates': [],
+                            'sha1': hashlib.sha1(body).hexdigest()}
+            return 201, {'Location': self.url + path}, b''
+        if resource is None:
+            return 404, {}, b''
+        if method == 'PATCH':
+            resource = dict(resource, updates=resource['updates'] +
+                            [body.decode('utf-8')])
+            writes[path] = resource
+            return 204, {}, b''
+        if method == 'DELETE':
+            writes.pop(path, None)
+            return 204, {}, b''
+        if metadata or resource['type'].startswith('text/turtle'):
+            embed = 'EmbedResources' in headers.get('Prefer', '')
+            return 200, {'Content-Type': 'text/turtle'}, \
+                self._describe(path, resource, metadata, embed)
+        return 200, {'Content-Type': resource['type']}, resource['body']
+
+    def _describe(self, path, resource, metadata, embed=False):
+        uri = self.url + path
+        if metadata or not resource['type'].startswith('text/turtle'):
+            return ('<%s> <http://www.loc.gov/premis/rdf/v1#hasMessageDigest>'
+                    ' <urn:sha1:%s> .\n' % (uri, resource['sha1'])).encode()
+        links = ''.join('<%s> <http://pcdm.org/models#hasFile> <%s> .\n' %
+                        (uri, f) for update in resource['updates']
+                        for f in HAS_FILE.findall(update))
+        children = sorted(p for p in self.resources
+                          if p.rpartition('/')[0] == path)
+        links += ''.join('<%s> <http://www.w3.org/ns/ldp#contains> <%s> .\n'
+                         % (uri, self.url + p) for p in children)
+        body = resource['body'] + b'\n' + links.encode('utf-8')
+        if embed:
+            for p in children:
+                body += b'\n' + self._describe(p, self.resources[p], False)
+        return body
+
+
+class DSpaceServer(StandIn):
+    '''Imitates the DSpace OAI-PMH ListIdentifiers and GetRecord verbs with
+    resumption token paging, and serves a PDF bitstream for every item.
+
+    Items are numbered from 1721.1/100000, all in the Earth, Atmospheric and
+    Planetary Sciences thesis set, with one datestamp per hour from
+    2017-01-01. Requests for the PDFs of the items numbered in forbidden are
+    refused.
+    '''
+    def __init__(self, count=100, page_size=100, pdf_size=64 * 1024,
+                 forbidden=(), **kwargs):
+        StandIn.__init__(self, **kwargs)
+        self.count = count
+        self.page_size = page_size
+        self.forbidden = {'1721.1/%s' % (100000 + i) for i in forbidden}
+        self.pdf = b'%PDF-1.4\n' + os.urandom(max(0, pdf_size - 16)) + \
+            b'\n%%EOF\n'
+        with open(os.path.join(CUR_DIR, 'fixtures/mets_record.xml')) as f:
+            self.template = f.read()
+
+    @property
+    def url(self):
+        return self.base_url + '/oai/request'
+
+    def datestamp(self, i):
+        return (datetime.datetime(2017, 1, 1) +
+                datetime.timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def handle(self, method, path, headers, body):
+        parts = urlsplit(path)
+        if parts.path.startswith('/bitstream/'):
+            if any(h + '/' in parts.path for h in self.forbidden):
+                return 403, {}, b''
+            return 200, {'Content-Type': 'application/pdf'}, self.pdf
+        if parts.path != '/oai/request':
+            return 404, {}, b''
+        params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if params.get('verb') == 'GetRecord':
+            return self._get_record(params['identifier'])
+        if params.get('verb') == 'ListIdentifiers':
+            return self._list_identifiers(params)
+        return 400, {}, b''
+
+    def _get_record(self, identifier):
+        number = identifier.rsplit('/', 1)[-1]
+        record = self.template.replace(
+            'http://dspace.mit.edu/bitstream/1721.1/107085/',
+            self.base_url + '/bitstream/1721.1/%s/' % number).replace(
+            '1721.1/107085', '1721.1/' + number)
+        return 200, {'Content-Type': 'text/xml'}, record.encode('utf-8')
+
+    def _list_identifiers(self, params):
+        if 'resumptionToken' in params:
+            offset, start, end = params['resumptionToken'].split('|')
+            offset = int(offset)
+        else:
+            offset, start, end = 0, params.get('from', ''), \
+                params.get('until', '')
+        matches = [i for i in range(self.count)
+                   if (not start or self.datestamp(i)[:10] >= start) and
+                   (not end or self.datestamp(i)[:10] <= end)]
+        page = matches[offset:offset + self.page_size]
+        headers = ''.join(
+            '<header><identifier>oai:dspace.mit.edu:1721.1/%s</identifier>'
+            '<datestamp>%s</datestamp><setSpec>hdl_1721.1_7805</setSpec>'
+            '</header>' % (100000 + i, self.datestamp(i)) for i in page)
+        token = ''
+        if offset + self.page_size < len(matches):
+            token = '%s|%s|%s' % (offset + self.page_size, start, end)
+        xml = ('<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns='
+               '"http://www.openarchives.org/OAI/2.0/"><ListIdentifiers>%s'
+               '<resumptionToken completeListSize="%s">%s</resumptionToken>'
+               '</ListIdentifiers></OAI-PMH>' % (headers, len(matches),
+                                                  token))
+        return 200, {'Content-Type': 'text/xml'}, xml.encode('utf-8')
+
+
+class TikaServer(StandIn):
+    '''Imitates the Tika server's text extraction endpoint, returning the
+    same text for every PDF.
+    '''
+    def __init__(self, text=b'Extracted text.', **kwargs):
+        StandIn.__init__(self, **kwargs)
+        self.text = text
+
+    @property
+    def url(self):
+        return self.base_url
+
+    def handle(self, method, path, headers, body):
+        if method == 'PUT' and urlsplit(path).path == '/tika':
+            return 200, {'Content-Type': 'text/plain'}, self.text
+        return 404, {}, b''
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import asyncio
+import tempfile
+
+import pytest
+import requests
+
+from foist.manifest import ExportItem
+from foist.workers import Backoff
+from tests.servers import DSpaceServer, FedoraServer
+
+aio = pytest.importorskip('foist.aio')
+
+
+@pytest.yield_fixture
+def fedora_server():
+    with FedoraServer() as server:
+        yield server
+
+
+def run(coro):
+    async def _run():
+        async with aio.session():
+            return await coro
+    return asyncio.run(_run())
+
+
+def test_upload_thesis_commits_transaction(fedora_server, pdf):
+    result = run(aio.upload_thesis(fedora_server.url, 'theses', 'thesis',
+                                   b'<> a <http://pcdm.org/models#Object> .',
+                                   pdf, 'INSERT { } WHERE { }',
+                                   text_content=b'text',
+                                   text_sparql='INSERT { } WHERE { }',
+                                   parallel_files=True))
+    assert result == 'Success'
+    assert fedora_server.resources['theses/thesis/thesis.txt']['body'] == \
+        b'text'
+    assert 'theses/thesis/thesis.pdf' in fedora_server.resources
+    assert not fedora_server.transactions
+    assert run(aio.is_in_fedora('thesis', fedora_server.url, 'theses'))
+    assert run(aio.upload_thesis(fedora_server.url, 'theses', 'thesis',
+                                 b'', pdf, '')) == 'Exists'
+
+
+def test_upload_thesis_retries_busy_transaction_start(pdf):
+    with FedoraServer(error_rate=1.0) as server:
+        result = run(aio.upload_thesis(server.url, 'theses', 'thesis', b'',
+                                       pdf, '', backoff=Backoff(3, base=0)))
+    assert result == 'Failure'
+    assert server.counts['requests'] == 3
+
+
+def test_upload_content_leaves_file_open_for_retries(fedora_server):
+    with tempfile.TemporaryFile() as f:
+        f.write(b'text')
+        f.seek(0)
+        for name in ('first', 'second'):
+            f.seek(0)
+            run(aio.upload_content(fedora_server.url + name, f,
+                                   'text/plain'))
+        assert not f.closed
+    assert fedora_server.resources['second']['body'] == b'text'
+
+
+def test_transaction_rolls_back_on_error(fedora_server):
+    async def _fail():
+        async with aio.transaction(fedora_server.url) as t:
+            await aio.create_container(t + '/theses/thesis', b'')
+            await aio.create_container(t + '/theses/thesis', b'')
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        run(_fail())
+    assert not fedora_server.resources
+    assert not fedora_server.transactions
+
+
+def test_upload_item_without_pdf_is_missing(fedora_server):
+    item = ExportItem('thesis', tempfile.mkdtemp(), 0,
+                      {'thesis.pdf.ru': (1, 0)})
+    result = run(aio.upload_item(
+        item, lambda item: (b'', 'INSERT { } WHERE { }', None),
+        lambda *args: args[1], fedora_server.url, 'theses'))
+    assert result == 'Missing'
+    assert not fedora_server.counts['requests']
+
+
+def test_is_in_fedora_returns_false_for_uningested_item(fedora_server):
+    assert not run(aio.is_in_fedora('thesis', fedora_server.url, 'theses'))
+
+
+def test_get_record_and_download_file():
+    with DSpaceServer(count=1, pdf_size=1024) as dspace:
+        record = run(aio.get_record(dspace.url, 'oai:dspace.mit.edu:1721.1/',
+                                    '100000', 'mets'))
+        assert '1721.1/100000' in record
+        with tempfile.TemporaryFile() as f:
+            url = dspace.base_url + '/bitstream/1721.1/100000/1/thesis.pdf'
+            assert run(aio.download_file(url, f)) == 1024
+            with pytest.raises(requests.exceptions.HTTPError):
+                run(aio.download_file(dspace.base_url + '/missing', f))
+
+
+def test_connection_errors_are_raised_as_requests_errors():
+    with pytest.raises(requests.exceptions.ConnectionError):
+        run(aio.request('GET', 'http://127.0.0.1:1/'))
+
+
+def test_retrying_retries_temporary_errors(monkeypatch):
+    monkeypatch.setattr(Backoff, 'delay', lambda self, attempt: 0)
+    responses = [503, 404]
+    calls = []
+
+    @aio.retrying
+    async def _get():
+        calls.append(1)
+        r = requests.Response()
+        r.status_code = responses[len(calls) - 1]
+        r.raise_for_status()
+
+    with pytest.raises(requests.exceptions.HTTPError) as e:
+        asyncio.run(_get())
+    assert e.value.response.status_code == 404
+    assert len(calls) == 2
+
+
+def test_map_concurrent_runs_coroutines():
+    running = []
+
+    async def _double(i):
+        running.append(i)
+        await asyncio.sleep(0.01)
+        assert len(running) <= 4
+        running.remove(i)
+        return i * 2
+
+    results = dict(aio.map_concurrent(_double, range(20), workers=4))
+    assert results == {i: i * 2 for i in range(20)}
+
+
+def test_map_concurrent_raises_errors():
+    async def _fail(i):
+        raise ValueError(i)
+
+    with pytest.raises(ValueError):
+        list(aio.map_concurrent(_fail, range(3), workers=2))
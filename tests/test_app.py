@@ -3,12 +3,15 @@ from __future__ import absolute_import
 
 import pytest
 import requests
+import requests_mock
 import xml.etree.ElementTree as ET
 
 from foist import (create_container, parse_text_encoding_errors, Thesis,
-                   transaction, upload_file, update_metadata)
+                   transaction, upload_content, upload_file, update_metadata,
+                   upload_thesis)
 
 from foist.namespaces import BIBO, DCTYPE, PCDM
+from foist.workers import Backoff
 
 
 def test_thesis(xml, text_errors):
@@ -236,3 +239,87 @@ def test_add_file_metadata_failure_raises_error(fedora_errors, sparql,
         uri = ('mock://example.com/rest/tx:error/theses/thesis/thesis.pdf/'
                'fcr:metadata')
         update_metadata(uri, sparql)
+
+
+def test_upload_content_streams_file_object(fedora, pdf):
+    uri = 'mock://example.com/rest/tx:123456789/theses/thesis/thesis.txt/'
+    with open(pdf, 'rb') as f:
+        r = upload_content(uri, f, 'text/plain')
+    assert r == 201
+
+
+def test_upload_thesis_streams_text_file(fedora, turtle, pdf, sparql):
+    text_file = pdf.replace('thesis.pdf', 'thesis-new.txt')
+    r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis', turtle,
+                      pdf, sparql, text_sparql=sparql, text_file=text_file)
+    assert r == 'Success'
+    text_put = [h for h in fedora.request_history if h.method == 'PUT' and
+                h.url.endswith('thesis.txt/')][0]
+    assert text_put.body.name == text_file
+
+
+def test_upload_thesis_parallel_files(fedora, turtle, pdf, sparql):
+    text_file = pdf.replace('thesis.pdf', 'thesis-new.txt')
+    r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis', turtle,
+                      pdf, sparql, text_sparql=sparql, text_file=text_file,
+                      parallel_files=True)
+    assert r == 'Success'
+    item_uri = 'mock://example.com/rest/tx:123456789/theses/thesis/'
+    requests = [(h.method, h.url) for h in fedora.request_history]
+    assert ('PUT', item_uri + 'thesis.pdf/') in requests
+    assert ('PUT', item_uri + 'thesis.txt/') in requests
+    assert requests[-3:-1] == [('PATCH', item_uri), ('PATCH', item_uri)]
+
+
+def test_upload_thesis_retries_server_errors(turtle, pdf, sparql):
+    with requests_mock.Mocker() as m:
+        m.post('/rest/fcr:tx', status_code=201,
+               headers={'Location': 'mock://example.com/rest/tx:1'})
+        m.post('/rest/tx:1/fcr:tx/fcr:rollback', status_code=204)
+        m.put('/rest/tx:1/theses/thesis/', status_code=503)
+        r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis',
+                          turtle, pdf, sparql,
+                          backoff=Backoff(attempts=3, base=0))
+        assert r == 'Failure'
+        assert m.call_count == 9
+
+
+def test_upload_thesis_retries_busy_transaction_start(turtle, pdf, sparql):
+    with requests_mock.Mocker() as m:
+        m.post('/rest/fcr:tx', [
+            {'status_code': 503},
+            {'status_code': 201,
+             'headers': {'Location': 'mock://example.com/rest/tx:1'}}])
+        m.put('/rest/tx:1/theses/thesis/', status_code=201)
+        m.put('/rest/tx:1/theses/thesis/thesis.pdf/', status_code=201)
+        m.patch(requests_mock.ANY, status_code=204)
+        m.post('/rest/tx:1/fcr:tx/fcr:commit', status_code=204)
+        r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis',
+                          turtle, pdf, sparql,
+                          backoff=Backoff(attempts=3, base=0))
+        assert r == 'Success'
+        assert m.request_history[0].method == 'POST'
+        assert m.request_history[1].url.endswith('/rest/fcr:tx')
+
+
+def test_upload_thesis_does_not_retry_client_errors(turtle, pdf, sparql):
+    with requests_mock.Mocker() as m:
+        m.post('/rest/fcr:tx', status_code=201,
+               headers={'Location': 'mock://example.com/rest/tx:1'})
+        m.post('/rest/tx:1/fcr:tx/fcr:rollback', status_code=204)
+        m.put('/rest/tx:1/theses/thesis/', status_code=412)
+        r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis',
+                          turtle, pdf, sparql,
+                          backoff=Backoff(attempts=3, base=0))
+        assert r == 'Failure'
+        assert m.call_count == 3
+
+
+def test_upload_thesis_retries_connection_errors(turtle, pdf, sparql):
+    with requests_mock.Mocker() as m:
+        m.post('/rest/fcr:tx', exc=requests.exceptions.ConnectTimeout)
+        r = upload_thesis('mock://example.com/rest/', 'theses', 'thesis',
+                          turtle, pdf, sparql,
+                          backoff=Backoff(attempts=2, base=0))
+        assert r == 'Failure'
+        assert m.call_count == 2
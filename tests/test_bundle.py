@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import tempfile
+
+import pytest
+
+from foist.bundle import MetadataBundle
+
+
+def test_bundle_stores_and_returns_artifacts():
+    path = os.path.join(tempfile.mkdtemp(), 'batch.bundle')
+    with MetadataBundle(path) as b:
+        b.add('thesis', b'<> a <x> .', 'INSERT pdf', 'INSERT txt')
+        b.add('thesis-02', b'<> a <y> .', 'INSERT pdf', 'INSERT txt')
+
+    with MetadataBundle(path) as b:
+        assert len(b) == 2
+        assert 'thesis' in b
+        assert 'thesis-03' not in b
+        assert b.names() == ['thesis', 'thesis-02']
+        assert b.get('thesis-02') == (b'<> a <y> .', b'INSERT pdf',
+                                      b'INSERT txt')
+
+
+def test_bundle_get_missing_item_raises_key_error():
+    path = os.path.join(tempfile.mkdtemp(), 'batch.bundle')
+    with MetadataBundle(path) as b:
+        with pytest.raises(KeyError):
+            b.get('thesis')
@@ -1,18 +1,40 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import gzip
+import hashlib
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
 import tempfile
 
 import click
 from click.testing import CliRunner
 import pytest
+import requests_mock
 
+from foist.bundle import MetadataBundle
 from foist.cli import main
 
 
+class LogFileRunner(CliRunner):
+    '''Invokes commands with their log file in the given path rather than
+    the default in the working directory.
+    '''
+    def __init__(self, log_file):
+        super(LogFileRunner, self).__init__()
+        self.log_file = log_file
+
+    def invoke(self, cli, args=None, **kwargs):
+        args = ['--log-file', self.log_file] + list(args or [])
+        return super(LogFileRunner, self).invoke(cli, args, **kwargs)
+
+
 @pytest.fixture
-def runner():
-    return CliRunner()
+def runner(tmp_path):
+    return LogFileRunner(str(tmp_path / 'logfile.log'))
 
 
 def test_initialize_fedora(runner, fedora):
@@ -30,6 +52,21 @@ def test_ingest_new_theses(runner, pipeline):
     assert result.exit_code == 0
 
 
+def test_ingest_new_theses_with_timeouts(runner, pipeline):
+    result = runner.invoke(main, ['--head-timeout', '1', '2',
+                                  '--binary-timeout', '3', '4',
+                                  '--hedge-percentile', '95',
+                                  'ingest_new_theses',
+                                  'http://example.com/oai/request?',
+                                  'oai:dspace.mit.edu:1721.1/', '-sd',
+                                  '2017-01-01', '-ed', '2017-02-01', '-f',
+                                  'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    timeouts = {(r.method, r.timeout) for r in pipeline.request_history}
+    assert ('HEAD', (1, 2)) in timeouts
+    assert ('PUT', (3, 4)) in timeouts
+
+
 def test_ingest_new_theses_with_bad_date_returns_error(runner, pipeline):
     result = runner.invoke(main, ['ingest_new_theses',
                                   'http://example.com/oai/request?',
@@ -58,15 +95,366 @@ def test_process_metadata(runner, theses_dir, tmpdir):
     assert result.exit_code == 0
 
 
+def test_process_metadata_to_bundle(runner, theses_dir):
+    bundle = os.path.join(tempfile.mkdtemp(), 'batch.bundle')
+    result = runner.invoke(main, ['process_metadata', theses_dir,
+                           'Test Collection', '-b', bundle])
+    assert result.exit_code == 0
+    with MetadataBundle(bundle) as b:
+        assert 'thesis' in b
+        assert 'thesis-04' not in b
+
+
+def test_index_text_errors(runner, text_errors, theses_dir):
+    tmp = tempfile.mkdtemp()
+    index = os.path.join(tmp, 'errors.idx')
+    result = runner.invoke(main, ['index_text_errors', text_errors, '-o',
+                           index])
+    assert result.exit_code == 0
+    result = runner.invoke(main, ['process_metadata', theses_dir,
+                           'Test Collection', '-b',
+                           os.path.join(tmp, 'batch.bundle'), '-e', index])
+    assert result.exit_code == 0
+
+
 def test_upload_theses(runner, theses_dir, fedora):
     result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
                            'mock://example.com/rest/'])
     assert result.exit_code == 0
 
 
+def test_upload_theses_from_bundle(runner, theses_dir, fedora, caplog):
+    bundle = os.path.join(tempfile.mkdtemp(), 'batch.bundle')
+    runner.invoke(main, ['process_metadata', theses_dir, 'Test Collection',
+                         '-b', bundle])
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '-b', bundle])
+    assert result.exit_code == 0
+    assert 'TOTAL: 4 theses ingested.' in caplog.text
+
+
+def test_upload_theses_with_workers(runner, theses_dir, fedora, caplog):
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '-w', '4'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses ingested.' in caplog.text
+
+
+def test_export_package(runner, theses_dir, caplog):
+    d = tempfile.mkdtemp()
+    result = runner.invoke(main, ['export_package', theses_dir, d, '-w', '2'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses written to' in caplog.text
+    assert os.path.isfile(os.path.join(d, 'fcrepo', 'rest', 'theses',
+                                       'thesis-03', 'thesis-03.txt.binary'))
+    assert os.path.isfile(os.path.join(d, 'manifest-sha1.txt'))
+
+
+def test_dump_nquads(runner, theses_dir, caplog):
+    output = os.path.join(tempfile.mkdtemp(), 'theses.nq.gz')
+    result = runner.invoke(main, ['dump_nquads', theses_dir, 'Dept', output,
+                                  '-w', '2', '--chunk-size', '2'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 4 theses written to' in caplog.text
+    with gzip.open(output, 'rb') as f:
+        graphs = {line.split()[-2] for line in f}
+    assert len(graphs) == 4
+
+
+def test_process_and_upload(runner, theses_dir, fedora, caplog):
+    audit = tempfile.mkdtemp()
+    result = runner.invoke(main, ['process_and_upload', theses_dir,
+                           'Test Collection', '-f', 'mock://example.com/rest/',
+                           '-a', audit, '-w', '2'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 4 theses ingested.' in caplog.text
+    assert os.path.isfile(os.path.join(audit, 'thesis', 'thesis.ttl'))
+    assert not os.path.exists(os.path.join(audit, 'thesis-03'))
+
+
+def test_upload_theses_with_manifest(runner, theses_dir, fedora):
+    manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+    for i in range(2):
+        result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                               'mock://example.com/rest/', '-m', manifest])
+        assert result.exit_code == 0
+    assert os.path.isfile(manifest)
+
+
 def test_update_metadata(runner, theses_dir, fedora):
     result = runner.invoke(main, ['update_metadata_for_collection', theses_dir,
                            ('PREFIX local: <http://example.com/> INSERT { <> '
                             'local:isFun "True" . } WHERE { }'), '-f',
                            'mock://example.com/rest/'])
     assert result.exit_code == 0
+
+
+def test_update_metadata_writes_and_replays_retry_file(runner, theses_dir,
+                                                       fedora):
+    retry_file = os.path.join(tempfile.mkdtemp(), 'retry.txt')
+    sparql = ('PREFIX local: <http://example.com/> INSERT { <> '
+              'local:isFun "True" . } WHERE { }')
+    result = runner.invoke(main, ['update_metadata_for_collection', theses_dir,
+                           sparql, '-f', 'mock://example.com/rest/', '-w', '3',
+                           '-r', '100', '--retry-file', retry_file])
+    assert result.exit_code == 0
+    with open(retry_file) as f:
+        assert sorted(f.read().split()) == ['thesis-02', 'thesis-03',
+                                            'thesis-04', 'thesis-05',
+                                            'thesis-06']
+
+    result = runner.invoke(main, ['update_metadata_for_collection', retry_file,
+                           sparql, '-f', 'mock://example.com/rest/', '-t',
+                           '2'])
+    assert result.exit_code == 0
+    assert fedora.call_count > 0
+
+
+def test_update_metadata_in_transactions(runner, theses_dir, fedora, caplog):
+    result = runner.invoke(main, ['update_metadata_for_collection', theses_dir,
+                           ('PREFIX local: <http://example.com/> INSERT { <> '
+                            'local:isFun "True" . } WHERE { }'), '-f',
+                           'mock://example.com/rest/', '-t', '4'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 6 theses updated.' in caplog.text
+
+
+def test_sync_metadata(runner, theses_dir, caplog):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('/rest/theses/'), text='')
+        m.patch(re.compile('/rest/theses/'), status_code=204)
+        result = runner.invoke(main, ['sync_metadata', theses_dir,
+                               'Test Collection', '-f',
+                               'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 4 theses updated, 0 unchanged.' in caplog.text
+
+
+def test_verify_reports_request_errors(runner, theses_dir, caplog):
+    report = os.path.join(tempfile.mkdtemp(), 'report.json')
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('/rest/theses'), status_code=404)
+        m.get('mock://example.com/rest/theses/thesis-03', status_code=500)
+        result = runner.invoke(main, ['verify', theses_dir, '-o', report,
+                                      '-f', 'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    assert 'Thesis "thesis-03" could not be verified: 500' in caplog.text
+    with open(report) as f:
+        report = json.load(f)
+    assert report['results'] == {'Missing': 5, 'Error': 1}
+    error = [f for f in report['failures'] if f['result'] == 'Error']
+    assert error[0]['name'] == 'thesis-03'
+    assert error[0]['error'].startswith('500')
+
+
+def test_upload_theses_skips_item_without_pdf(runner, theses_dir, fedora,
+                                              caplog):
+    directory = tempfile.mkdtemp()
+    for name in ('thesis', 'thesis-03'):
+        shutil.copytree(os.path.join(theses_dir, name),
+                        os.path.join(directory, name))
+    os.remove(os.path.join(directory, 'thesis', 'thesis.pdf'))
+    result = runner.invoke(main, ['batch_upload_theses', directory, '-f',
+                                  'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    assert 'Missing needed file for item "thesis"' in caplog.text
+    assert 'TOTAL: 1 theses ingested.' in caplog.text
+
+
+def test_upload_theses_sync_existing(runner, theses_dir, fedora, caplog):
+    fedora.get(re.compile('/rest/theses/'), text='')
+    fedora.patch(re.compile('/rest/theses/'), status_code=204)
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '-s'])
+    assert result.exit_code == 0
+    assert 'Metadata for item "thesis-03" updated' in caplog.text
+
+
+def test_upload_theses_delta(runner, theses_dir, fedora, caplog):
+    fedora.get(re.compile('/fcr:metadata'), status_code=404)
+    fedora.put(re.compile('/rest/theses/'), status_code=201)
+    fedora.patch(re.compile('/rest/theses/'), status_code=204)
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '-d'])
+    assert result.exit_code == 0
+    assert 'Files for item "thesis-03" synced' in caplog.text
+    assert '0 files unchanged' in caplog.text
+
+
+def test_ingest_new_theses_delta_skips_unchanged_pdf(runner, pipeline, pdf,
+                                                     caplog):
+    with open(pdf, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    pipeline.get('/bitstream/1721.1/107085/1/971247903-MIT.pdf', content=data)
+    pipeline.head('/rest/theses/1721.1-108390', status_code=200)
+    pipeline.get(re.compile('/1721.1-108390.pdf/fcr:metadata'),
+                 text=('<> <http://www.loc.gov/premis/rdf/v1#'
+                       'hasMessageDigest> <urn:sha1:%s> .' % digest))
+    result = runner.invoke(main, ['ingest_new_theses',
+                                  'http://example.com/oai/request?',
+                                  'oai:dspace.mit.edu:1721.1/', '-sd',
+                                  '2017-01-01', '-ed', '2017-02-01', '-f',
+                                  'mock://example.com/rest/', '-d'])
+    assert result.exit_code == 0
+    assert 'Delta sync: 1 files unchanged' in caplog.text
+
+
+def test_upload_theses_adaptive(runner, theses_dir, fedora, caplog):
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '-w', '4',
+                           '--adaptive'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses ingested.' in caplog.text
+
+
+def test_upload_theses_asyncio_backend_rejects_adaptive(runner, theses_dir):
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir,
+                                  '--backend', 'asyncio', '--adaptive'])
+    assert result.exit_code == 2
+    assert 'cannot be used with --adaptive' in result.output
+
+
+def test_upload_theses_parallel_files(runner, theses_dir, fedora, caplog):
+    result = runner.invoke(main, ['batch_upload_theses', theses_dir, '-f',
+                           'mock://example.com/rest/', '--parallel-files'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses ingested.' in caplog.text
+
+
+def test_upload_theses_writes_metrics(runner, theses_dir, fedora):
+    d = tempfile.mkdtemp()
+    json_file = os.path.join(d, 'metrics.json')
+    prom_file = os.path.join(d, 'foist.prom')
+    result = runner.invoke(main, ['--metrics-file', json_file,
+                                  '--prometheus-file', prom_file,
+                                  'batch_upload_theses', theses_dir, '-f',
+                                  'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    with open(json_file) as f:
+        report = json.load(f)
+    assert {'name': 'foist_items_total', 'labels': {'result': 'Success'},
+            'value': 1} in report['counters']
+    stages = {h['labels'].get('stage') for h in report['histograms']}
+    assert {'upload_thesis', 'commit'} <= stages
+    with open(prom_file) as f:
+        assert 'foist_http_requests_total{' in f.read()
+
+
+def test_sharded_runs_merge_into_one_report(runner, theses_dir, fedora,
+                                           caplog):
+    d = tempfile.mkdtemp()
+    reports = [os.path.join(d, 'shard-%s.json' % i) for i in (1, 2)]
+    for i, report in enumerate(reports, 1):
+        result = runner.invoke(main, ['--metrics-file', report,
+                                      'batch_upload_theses', theses_dir,
+                                      '-f', 'mock://example.com/rest/',
+                                      '--shard', '%s/2' % i])
+        assert result.exit_code == 0
+    merged = os.path.join(d, 'merged.json')
+    result = runner.invoke(main, ['merge_reports', '-o', merged] + reports)
+    assert result.exit_code == 0
+    with open(merged) as f:
+        report = json.load(f)
+    counts = {c['labels']['result']: c['value'] for c in report['counters']
+              if c['name'] == 'foist_items_total'}
+    assert counts == {'Success': 1, 'Exists': 1, 'Missing': 4}
+    assert len(report['failures']) == 4
+    assert [r['shard'] for r in report['info']['runs']] == ['1/2', '2/2']
+    assert 'TOTAL: 2 reports merged, 4 failed items.' in caplog.text
+
+
+def test_shard_must_be_valid(runner, theses_dir):
+    result = runner.invoke(main, ['process_metadata', theses_dir, 'Dept',
+                                  '--shard', '3/2'])
+    assert result.exit_code == 2
+
+
+def test_upload_theses_from_work_queue(runner, theses_dir, fedora, caplog):
+    queue = os.path.join(tempfile.mkdtemp(), 'queue.db')
+    for i in range(2):
+        result = runner.invoke(main, ['batch_upload_theses', theses_dir,
+                                      '-f', 'mock://example.com/rest/',
+                                      '-w', '2', '-q', queue])
+        assert result.exit_code == 0
+    assert '6 of 6 items added to work queue' in caplog.text
+    assert '0 of 6 items added to work queue' in caplog.text
+    assert caplog.text.count('TOTAL: 2 theses ingested.') == 1
+    result = runner.invoke(main, ['queue_status', queue])
+    assert result.exit_code == 0
+    assert 'done: 2' in caplog.text
+    assert 'failed: 4' in caplog.text
+    assert caplog.text.count('failed: Missing') >= 4
+
+
+def test_upload_theses_retries_failed_queue_items(runner, theses_dir, fedora,
+                                                  caplog):
+    queue = os.path.join(tempfile.mkdtemp(), 'queue.db')
+    args = ['batch_upload_theses', theses_dir, '-f',
+            'mock://example.com/rest/', '-q', queue]
+    result = runner.invoke(main, args)
+    assert result.exit_code == 0
+    result = runner.invoke(main, args + ['--retry-failed'])
+    assert result.exit_code == 0
+    assert '4 of 6 items added to work queue' in caplog.text
+
+
+def test_upload_theses_writes_trace(runner, theses_dir, fedora):
+    trace_file = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    result = runner.invoke(main, ['--trace', trace_file,
+                                  'batch_upload_theses', theses_dir, '-f',
+                                  'mock://example.com/rest/', '-w', '2'])
+    assert result.exit_code == 0
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    theses = [e for e in events if e['name'] == 'thesis']
+    assert {e['args']['handle'] for e in theses} >= {'thesis'}
+    puts = [e for e in events if e['name'] == 'PUT' and
+            e['args']['handle'] == 'thesis']
+    assert puts and all(e['cat'] == 'http' for e in puts)
+
+
+def test_process_metadata_with_profile(runner, theses_dir, caplog):
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, 'foist.pstats')
+    result = runner.invoke(main, ['--profile', path, '--profile-memory',
+                                  'process_metadata', theses_dir,
+                                  'Dept of Testing', '-b',
+                                  os.path.join(d, 'bundle.db')])
+    assert result.exit_code == 0
+    assert os.path.exists(path)
+    with open(path + '.txt') as f:
+        assert 'process_metadata' in f.read()
+    assert 'get_metadata' in caplog.text
+
+
+def test_upload_theses_with_workers_samples_profile(runner, theses_dir,
+                                                    fedora, caplog):
+    path = os.path.join(tempfile.mkdtemp(), 'foist.stacks')
+    result = runner.invoke(main, ['--profile', path, 'batch_upload_theses',
+                                  theses_dir, '-f',
+                                  'mock://example.com/rest/', '-w', '2'])
+    assert result.exit_code == 0
+    assert 'worker threads are sampled instead' in caplog.text
+    with open(path + '.txt') as f:
+        assert 'samples of all threads' in f.read()
+
+
+def test_json_log(runner, theses_dir, fedora):
+    d = tempfile.mkdtemp()
+    json_log = os.path.join(d, 'foist.jsonl')
+    result = runner.invoke(main, ['--log-file', os.path.join(d, 'foist.log'),
+                                  '--json-log', json_log,
+                                  'batch_upload_theses', theses_dir, '-f',
+                                  'mock://example.com/rest/'])
+    assert result.exit_code == 0
+    with open(json_log) as f:
+        messages = [json.loads(line)['message'] for line in f]
+    assert 'TOTAL: 2 theses ingested.\n' in messages
+
+
+def test_cli_starts_without_heavy_dependencies():
+    code = ('import sys, foist.cli; print(" ".join(m for m in ("rdflib", '
+            '"tika", "foist.app", "foist.sync") if m in sys.modules))')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b''
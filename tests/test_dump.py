@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import gzip
+import xml.etree.ElementTree as ET
+
+import rdflib
+
+from foist.app import Thesis
+from foist.dump import compress_chunk, item_nquads
+from foist.namespaces import DCTERMS, PCDM
+
+ITEM = 'http://localhost:8080/fcrepo/rest/theses/thesis'
+
+
+def test_item_nquads_names_graph_after_item(xml):
+    thesis = Thesis('thesis', ET.parse(xml).getroot(), ['Dept'])
+    g = rdflib.ConjunctiveGraph()
+    g.parse(data=item_nquads(thesis, ITEM, ['.pdf', '.txt']),
+            format='nquads')
+    item = g.get_context(rdflib.URIRef(ITEM))
+    pdf = rdflib.URIRef(ITEM + '/thesis.pdf')
+    assert (rdflib.URIRef(ITEM), PCDM.hasFile, pdf) in item
+    assert (pdf, DCTERMS.extent, rdflib.Literal('109 p.')) in item
+    assert len(list(g.contexts())) == 1
+
+
+def test_compressed_chunks_concatenate():
+    data = compress_chunk([b'a\n', b'b\n']) + compress_chunk([b'c\n'])
+    assert gzip.decompress(data) == b'a\nb\nc\n'
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+from foist import Thesis
+from foist.error_index import (ENCODED_TEXT_NEW, has_error_flag,
+                               load_text_error_index, NO_TEXT_NEW,
+                               NO_TEXT_OLD, TextErrorIndex)
+
+
+def test_text_error_index_stores_flags(text_errors):
+    index = TextErrorIndex.from_tab_files([text_errors])
+    assert index.get('thesis') == NO_TEXT_OLD | NO_TEXT_NEW | ENCODED_TEXT_NEW
+    assert index.get('thesis-02') is None
+    assert len(index) == 1
+
+
+def test_text_error_index_merges_files(text_errors):
+    tab = os.path.join(tempfile.mkdtemp(), 'more_errors.tab')
+    with open(tab, 'w') as f:
+        f.write('Subdir\tPDFBox err\tLigatures new\n'
+                'thesis\t1\t0\n'
+                'thesis-07\t0\t1\n')
+    index = TextErrorIndex.from_tab_files([text_errors, tab])
+    assert has_error_flag(index.get('thesis'), 'PDFBox err')
+    assert has_error_flag(index.get('thesis'), 'Encoded text new file')
+    assert has_error_flag(index.get('thesis-07'), 'Ligatures new')
+
+
+def test_text_error_index_saves_and_maps(text_errors):
+    path = os.path.join(tempfile.mkdtemp(), 'errors.idx')
+    index = TextErrorIndex({'a': 1, 'thesis': 14, 'zzz': 16})
+    index.save(path)
+    mapped = load_text_error_index(path)
+    assert len(mapped) == 3
+    assert mapped.get('thesis') == 14
+    assert mapped.get('zzz') == 16
+    assert mapped.get('b') is None
+    mapped.close()
+
+
+def test_thesis_reads_errors_from_index(xml, text_errors):
+    mets = ET.parse(xml).getroot()
+    errors = TextErrorIndex.from_tab_files([text_errors]).get('thesis')
+    t = Thesis('thesis', mets, ['Department One'], errors)
+    assert t.encoded_text is True
+    assert t.ligatures is None
+    assert t.no_full_text is True
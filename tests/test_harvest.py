@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import os
+import tempfile
+
+import pytest
+
+from foist.harvest import Watermark
+
+
+@pytest.fixture
+def state_file():
+    return os.path.join(tempfile.mkdtemp(), 'state.json')
+
+
+def test_watermark_advances_to_latest_record(state_file):
+    watermark = Watermark(state_file, '2017-01-01')
+    assert watermark.start_date == '2017-01-01'
+    assert watermark.advance([('2017-01-02T10:00:00Z', True),
+                              ('2017-01-03T09:00:00Z', True)])
+    assert Watermark(state_file).datestamp == '2017-01-03T09:00:00Z'
+    assert Watermark(state_file).start_date == '2017-01-03'
+
+
+def test_watermark_stops_at_earliest_failure(state_file):
+    watermark = Watermark(state_file)
+    assert watermark.start_date is None
+    watermark.advance([('2017-01-02T10:00:00Z', True),
+                       ('2017-01-04T10:00:00Z', False),
+                       ('2017-01-03T10:00:00Z', False),
+                       ('2017-01-05T10:00:00Z', True)])
+    assert watermark.datestamp == '2017-01-03T10:00:00Z'
+
+
+def test_watermark_never_moves_back(state_file):
+    watermark = Watermark(state_file, '2017-01-03T10:00:00Z')
+    assert not watermark.advance([('2017-01-03T09:00:00Z', False)])
+    assert not watermark.advance([])
+    assert watermark.datestamp == '2017-01-03T10:00:00Z'
+    assert not os.path.exists(state_file)
+
+
+def test_watermark_state_file_is_json(state_file):
+    Watermark(state_file).advance([('2017-01-02T10:00:00Z', True)])
+    with open(state_file) as f:
+        state = json.load(f)
+    assert state['datestamp'] == '2017-01-02T10:00:00Z'
+    assert 'updated' in state
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+import requests
+import requests_mock
+
+from foist import http
+
+
+def test_request_notifies_observers():
+    seen = []
+    with requests_mock.Mocker() as m:
+        m.get('mock://example.com/rest/thesis', status_code=200)
+        m.get('mock://example.com/rest/down',
+              exc=requests.exceptions.ConnectionError)
+        with http.observer(lambda *args: seen.append(args)):
+            r = http.request('GET', 'mock://example.com/rest/thesis')
+            with pytest.raises(requests.exceptions.ConnectionError):
+                http.request('GET', 'mock://example.com/rest/down')
+        http.request('GET', 'mock://example.com/rest/thesis')
+    assert r.status_code == 200
+    assert [(url, status) for url, latency, status in seen] == [
+        ('mock://example.com/rest/thesis', 200),
+        ('mock://example.com/rest/down', None)]
+
+
+def test_request_uses_timeouts_for_kind():
+    with requests_mock.Mocker() as m:
+        m.head('mock://example.com/rest/thesis', status_code=200)
+        m.put('mock://example.com/rest/thesis.pdf', status_code=201)
+        m.patch('mock://example.com/rest/thesis', status_code=204)
+        http.request('HEAD', 'mock://example.com/rest/thesis')
+        http.request('PUT', 'mock://example.com/rest/thesis.pdf', 'binary')
+        http.request('PATCH', 'mock://example.com/rest/thesis', timeout=1)
+        timeouts = [r.timeout for r in m.request_history]
+    assert timeouts == [http.timeouts['head'], http.timeouts['binary'], 1]
+
+
+def test_hedged_request_sends_second_attempt(monkeypatch):
+    window = http.LatencyWindow()
+    for i in range(http.MIN_HEDGE_SAMPLES):
+        window.add(0.01)
+    monkeypatch.setattr(http, 'hedge_percentile', 95)
+    monkeypatch.setitem(http.latencies, 'head', window)
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            calls.append(self.path)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%s/rest/thesis' % server.server_port
+        start = time.monotonic()
+        r = http.hedged_request('HEAD', url)
+        elapsed = time.monotonic() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert r.status_code == 200
+    assert len(calls) == 2
+    assert elapsed < 0.5
+
+
+def test_hedged_request_without_samples_sends_one_request(monkeypatch):
+    monkeypatch.setattr(http, 'hedge_percentile', 95)
+    monkeypatch.setitem(http.latencies, 'head', http.LatencyWindow())
+    with requests_mock.Mocker() as m:
+        m.head('mock://example.com/rest/thesis', status_code=200)
+        http.hedged_request('HEAD', 'mock://example.com/rest/thesis')
+        assert m.call_count == 1
+
+
+def test_configure_pool_sizes_session_for_workers(monkeypatch):
+    monkeypatch.setattr(http, 'hedge_percentile', 95)
+    try:
+        http.configure_pool(20)
+        adapter = http.session().get_adapter('http://example.com/')
+        assert adapter._pool_maxsize == 80
+        assert adapter.poolmanager.connection_pool_kw['maxsize'] == 80
+        assert http._get_executor()._max_workers == 80
+    finally:
+        http.configure_pool(1)
+    adapter = http.session().get_adapter('http://example.com/')
+    assert adapter._pool_maxsize == requests.adapters.DEFAULT_POOLSIZE
+
+
+def test_latency_window_percentile():
+    window = http.LatencyWindow(size=100)
+    for i in range(200):
+        window.add(i)
+    assert len(window) == 100
+    assert window.percentile(50) == 150
+    assert window.percentile(99) == 199
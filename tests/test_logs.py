@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+import json
+import logging
+import os
+import tempfile
+
+from foist.logs import configure_logging, stop_logging
+
+
+def test_configure_logging_writes_through_queue():
+    d = tempfile.mkdtemp()
+    log_file = os.path.join(d, 'foist.log')
+    json_file = os.path.join(d, 'foist.jsonl')
+    stream = io.StringIO()
+    listener = configure_logging(log_file, json_file=json_file,
+                                 stream=stream)
+    logger = logging.getLogger('foist.test')
+    assert isinstance(logging.getLogger('foist').handlers[0],
+                      logging.handlers.QueueHandler)
+    logger.info('Thesis "%s" uploaded', 'thesis')
+    stop_logging(listener)
+    assert 'INFO: [' in stream.getvalue()
+    with open(log_file) as f:
+        assert f.read().endswith('] Thesis "thesis" uploaded\n')
+    with open(json_file) as f:
+        entry = json.loads(f.readline())
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'foist.test'
+    assert entry['message'] == 'Thesis "thesis" uploaded'
+    assert logging.getLogger('foist').handlers == []
+
+
+def test_configure_logging_rotates_log_file():
+    d = tempfile.mkdtemp()
+    log_file = os.path.join(d, 'foist.log')
+    listener = configure_logging(log_file, max_bytes=100, backup_count=2,
+                                 stream=io.StringIO())
+    for i in range(20):
+        logging.getLogger('foist').info('Line %s of the log', i)
+    stop_logging(listener)
+    assert sorted(os.listdir(d)) == ['foist.log', 'foist.log.1',
+                                     'foist.log.2']
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+from foist.manifest import in_shard, scan_export
+
+
+def test_scan_export_finds_items_and_files(theses_dir):
+    m = scan_export(theses_dir)
+    assert m.names() == ['thesis', 'thesis-02', 'thesis-03', 'thesis-04',
+                         'thesis-05', 'thesis-06']
+    assert m.error_files == [os.path.join(theses_dir, 'text_errors.tab')]
+    item = m['thesis']
+    assert item.pdf_file == os.path.join(theses_dir, 'thesis', 'thesis.pdf')
+    assert item.text_file == os.path.join(theses_dir, 'thesis',
+                                          'thesis-new.txt')
+    assert item.has('.pdf.ru')
+    assert item.size('.pdf') == os.path.getsize(item.pdf_file)
+
+
+def test_export_item_missing_files(theses_dir):
+    m = scan_export(theses_dir)
+    assert m['thesis-03'].xml_file is None
+    assert m['thesis-03'].text_file.endswith('thesis-03.txt')
+    assert m['thesis-04'].pdf_file is None
+    assert m['thesis-05'].text_file is None
+
+
+def test_scan_export_uses_and_updates_cache(theses_dir):
+    tmp = tempfile.mkdtemp()
+    export = os.path.join(tmp, 'export')
+    shutil.copytree(os.path.join(theses_dir, 'thesis'),
+                    os.path.join(export, 'thesis'))
+    cache = os.path.join(tmp, 'manifest.json')
+    m = scan_export(export, cache)
+    assert os.path.isfile(cache)
+    assert not m['thesis'].has('.txt')
+
+    cached = scan_export(export, cache)
+    assert cached['thesis'].files == m['thesis'].files
+
+    with open(os.path.join(export, 'thesis', 'thesis.txt'), 'w') as f:
+        f.write('text')
+    os.utime(os.path.join(export, 'thesis'), (0, 0))
+    assert scan_export(export, cache)['thesis'].has('.txt')
+
+
+def test_in_shard_assigns_each_item_to_one_shard():
+    names = ['thesis-%02d' % i for i in range(50)]
+    shards = [[n for n in names if in_shard(n, (i, 3))] for i in (1, 2, 3)]
+    assert sorted(sum(shards, [])) == names
+    assert all(shards)
+
+
+def test_manifest_shard(theses_dir):
+    m = scan_export(theses_dir)
+    parts = [m.shard((i, 2)).names() for i in (1, 2)]
+    assert sorted(parts[0] + parts[1]) == m.names()
+    assert not set(parts[0]) & set(parts[1])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import os
+import tempfile
+
+from foist.metrics import Histogram, merge_reports, Metrics, Reporter
+
+
+def test_histogram_quantiles():
+    h = Histogram(buckets=(1, 2, 5, float('inf')))
+    for v in (0.5, 0.5, 1.5, 3, 10):
+        h.observe(v)
+    assert h.count == 5
+    assert h.sum == 15.5
+    assert h.quantile(0.4) == 1
+    assert h.quantile(0.6) == 2
+    assert h.quantile(0.99) == float('inf')
+
+
+def test_metrics_report_includes_counters_and_histograms():
+    m = Metrics()
+    m.inc('foist_items_total', result='Success')
+    m.inc('foist_items_total', result='Success')
+    m.inc('foist_stage_bytes_total', 1024, stage='download_pdf')
+    with m.timer('foist_stage_seconds', stage='get_metadata'):
+        pass
+    report = m.report()
+    assert {'name': 'foist_items_total', 'labels': {'result': 'Success'},
+            'value': 2} in report['counters']
+    h = report['histograms'][0]
+    assert h['name'] == 'foist_stage_seconds'
+    assert h['labels'] == {'stage': 'get_metadata'}
+    assert h['count'] == 1
+    assert h['p99'] == 0.005
+
+
+def test_metrics_prometheus_format():
+    m = Metrics()
+    m.inc('foist_items_total', result='Success')
+    m.observe('foist_stage_seconds', 0.2, stage='commit')
+    text = m.prometheus()
+    assert '# TYPE foist_items_total counter' in text
+    assert 'foist_items_total{result="Success"} 1' in text
+    assert '# TYPE foist_stage_seconds histogram' in text
+    assert 'foist_stage_seconds_bucket{stage="commit",le="0.1"} 0' in text
+    assert 'foist_stage_seconds_bucket{stage="commit",le="0.25"} 1' in text
+    assert 'foist_stage_seconds_bucket{stage="commit",le="+Inf"} 1' in text
+    assert 'foist_stage_seconds_count{stage="commit"} 1' in text
+
+
+def test_reporter_writes_files_when_stopped():
+    m = Metrics()
+    m.inc('foist_items_total', result='Success')
+    d = tempfile.mkdtemp()
+    json_file = os.path.join(d, 'metrics.json')
+    prom_file = os.path.join(d, 'foist.prom')
+    reporter = Reporter(m, json_file, prom_file, interval=60).start()
+    reporter.stop()
+    with open(json_file) as f:
+        assert json.load(f)['counters'][0]['value'] == 1
+    with open(prom_file) as f:
+        assert 'foist_items_total{result="Success"} 1' in f.read()
+    assert sorted(os.listdir(d)) == ['foist.prom', 'metrics.json']
+
+
+def test_merge_reports_adds_up_shards():
+    reports = []
+    for i in range(2):
+        m = Metrics()
+        m.info['shard'] = '%s/2' % (i + 1)
+        m.inc('foist_items_total', result='Success')
+        m.observe('foist_stage_seconds', 0.2 * (i + 1), stage='commit')
+        m.fail('thesis-%s' % i, 'Failure')
+        reports.append(json.loads(json.dumps(m.report())))
+    report = merge_reports(reports).report()
+    assert report['counters'] == [{'name': 'foist_items_total',
+                                   'labels': {'result': 'Success'},
+                                   'value': 2}]
+    h = report['histograms'][0]
+    assert h['count'] == 2
+    assert h['p99'] == 0.5
+    assert [f['item'] for f in report['failures']] == ['thesis-0',
+                                                       'thesis-1']
+    assert report['info'] == {'runs': [{'shard': '1/2'}, {'shard': '2/2'}]}
+    assert report['started'] == reports[0]['started']
+    assert report['updated'] == reports[1]['updated']
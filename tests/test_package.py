@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import os
+import tempfile
+
+import rdflib
+
+from foist.namespaces import PCDM, RDF
+from foist.package import ImportPackage, insert_graph, PREMIS
+
+BASE = 'http://localhost:8080/fcrepo/rest/'
+
+
+def test_insert_graph_resolves_relative_uris():
+    g = insert_graph(b'PREFIX pcdm: <http://pcdm.org/models#> INSERT { <> a '
+                     b'pcdm:File . } WHERE { }', BASE + 'theses/a/a.pdf')
+    assert list(g) == [(rdflib.URIRef(BASE + 'theses/a/a.pdf'), RDF.type,
+                        PCDM.File)]
+
+
+def test_import_package_writes_resources_and_manifest(pdf, sparql, turtle):
+    d = tempfile.mkdtemp()
+    with open(turtle, 'rb') as f:
+        metadata = f.read()
+    with open(sparql, 'rb') as f:
+        pdf_sparql = f.read()
+    with ImportPackage(d, BASE) as package:
+        package.add('theses', 'thesis', metadata,
+                    [('.pdf', pdf, 'application/pdf', pdf_sparql)])
+    item_dir = os.path.join(d, 'fcrepo', 'rest', 'theses')
+    item = rdflib.Graph().parse(os.path.join(item_dir, 'thesis.ttl'),
+                                format='turtle')
+    assert (rdflib.URIRef(BASE + 'theses/thesis'), PCDM.hasFile,
+            rdflib.URIRef(BASE + 'theses/thesis/thesis.pdf')) in item
+    with open(pdf, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    description = rdflib.Graph().parse(
+        os.path.join(item_dir, 'thesis', 'thesis.pdf', 'fcr%3Ametadata.ttl'),
+        format='turtle')
+    assert rdflib.URIRef('urn:sha1:' + digest) in \
+        description.objects(None, PREMIS.hasMessageDigest)
+    with open(os.path.join(d, 'manifest-sha1.txt')) as f:
+        manifest = f.read()
+    assert '%s  fcrepo/rest/theses/thesis/thesis.pdf.binary' % digest in \
+        manifest
+    assert manifest.count('\n') == 3
@@ -1,13 +1,56 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import tempfile
+
 import pytest
 import requests
+import requests_mock
 import xml.etree.ElementTree as ET
 
-from foist.pipeline import (extract_text, get_collection_names, get_pdf_url,
-                            get_record, get_record_list, is_in_fedora,
-                            is_thesis, parse_record_list)
+from foist import http
+from foist.workers import Backoff
+from foist.pipeline import (download_file, extract_text,
+                            extract_text_to_file,
+                            get_collection_names, get_pdf_url, get_record,
+                            get_record_list, get_record_pages,
+                            is_in_fedora, is_thesis,
+                            parse_record_list)
+
+
+def test_download_file_streams_to_file(pipeline, pdf):
+    with tempfile.TemporaryFile() as f:
+        size = download_file('http://example.com/bitstream/handle/test/pdf',
+                             f)
+        f.seek(0)
+        data = f.read()
+    with open(pdf, 'rb') as expected:
+        assert data == expected.read()
+    assert size == len(data)
+
+
+def test_download_file_error_raises_error(pipeline):
+    with pytest.raises(requests.exceptions.HTTPError):
+        with tempfile.TemporaryFile() as f:
+            download_file('http://example.com/bitstream/handle/test/bad_pdf',
+                          f)
+
+
+def test_download_file_retries_temporary_errors(monkeypatch):
+    monkeypatch.setattr(Backoff, 'sleep', lambda self, attempt: None)
+    url = 'http://example.com/bitstream/handle/test/pdf'
+    with requests_mock.Mocker() as m:
+        m.get(url, [{'status_code': 503, 'content': b'busy'},
+                    {'exc': requests.exceptions.ConnectionError},
+                    {'status_code': 200, 'content': b'pdf'}])
+        with tempfile.TemporaryFile() as f:
+            f.write(b'header')
+            size = download_file(url, f)
+            f.seek(0)
+            data = f.read()
+    assert m.call_count == 3
+    assert size == 3
+    assert data == b'headerpdf'
 
 
 def test_extract_text_returns_bytes(pdf):
@@ -15,6 +58,27 @@ def test_extract_text_returns_bytes(pdf):
     assert type(text) == bytes
 
 
+def test_extract_text_to_file_streams_text(pdf, tika_server):
+    with tempfile.TemporaryFile() as f:
+        size = extract_text_to_file(pdf, f)
+        f.seek(0)
+        assert f.read() == b'Extracted text.'
+    assert size == 15
+
+
+def test_extract_text_to_file_uses_binary_timeouts(pdf, tika_server):
+    with tempfile.TemporaryFile() as f:
+        extract_text_to_file(pdf, f)
+    assert tika_server.last_request.timeout == http.timeouts['binary']
+
+
+def test_extract_text_to_file_without_text_raises_error(pdf, tika_server):
+    tika_server.put('http://localhost:9998/tika', content=b'')
+    with pytest.raises(ValueError):
+        with tempfile.TemporaryFile() as f:
+            extract_text_to_file(pdf, f)
+
+
 def test_get_collection_names_returns_correct_names():
     names = get_collection_names(['hdl_1721.1_7888', 'hdl_1721.1_7710',
                                   'hdl_1721.1_7929', 'hdl_1721.1_7742',
@@ -43,6 +107,27 @@ def test_get_record_succeeds(pipeline):
     assert '<?xml version="1.0" encoding="UTF-8"?>' in r
 
 
+def test_get_record_retries_temporary_errors(monkeypatch):
+    monkeypatch.setattr(Backoff, 'sleep', lambda self, attempt: None)
+    with requests_mock.Mocker() as m:
+        m.get('http://example.com/oai/request',
+              [{'status_code': 429}, {'status_code': 200, 'text': '<a/>'}])
+        r = get_record('http://example.com/oai/request',
+                       'oai:dspace.mit.edu:1721.1/', '12345', 'mets')
+    assert r == '<a/>'
+    assert m.call_count == 2
+
+
+def test_get_record_error_raises_error(monkeypatch):
+    monkeypatch.setattr(Backoff, 'sleep', lambda self, attempt: None)
+    with requests_mock.Mocker() as m:
+        m.get('http://example.com/oai/request', status_code=503)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_record('http://example.com/oai/request',
+                       'oai:dspace.mit.edu:1721.1/', '12345', 'mets')
+    assert m.call_count == Backoff().attempts
+
+
 def test_get_record_list_succeeds(pipeline):
     '''Correctly-formed request should return XML response.
     '''
@@ -55,6 +140,19 @@ def test_get_record_list_succeeds(pipeline):
     assert '<?xml version="1.0" encoding="UTF-8"?>' in r
 
 
+def test_get_record_pages_follows_resumption_tokens(pipeline):
+    page = ('<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+            '<ListIdentifiers><resumptionToken>%s</resumptionToken>'
+            '</ListIdentifiers></OAI-PMH>')
+    pipeline.get('/oai/request?verb=ListIdentifiers&metadataPrefix=mets',
+                 text=page % 'next', complete_qs=True)
+    pipeline.get('/oai/request?verb=ListIdentifiers&resumptionToken=next',
+                 text=page % '')
+    pages = list(get_record_pages('http://example.com/oai/request',
+                                  'mets'))
+    assert pages == [page % 'next', page % '']
+
+
 def test_is_in_fedora_returns_true_for_ingested_item(fedora):
     handle = 'thesis'
     fedora_uri = 'http://example.com/rest/'
@@ -72,6 +170,7 @@ def test_is_in_fedora_error_raises_error(fedora_errors):
         handle = 'no_auth'
         fedora_uri = 'http://example.com/rest/'
         is_in_fedora(handle, fedora_uri, 'theses')
+    assert fedora_errors.call_count == 1
 
 
 def test_is_thesis_returns_true_for_thesis():
@@ -87,4 +186,5 @@ def test_is_thesis_returns_false_for_not_thesis():
 def test_parse_record_list_returns_correct_json(record_list):
     json_records = parse_record_list(record_list)
     assert {'identifier': '108425', 'sets': ['hdl_1721.1_494'],
-            'handle': '1721.1-108425'} in json_records
+            'handle': '1721.1-108425',
+            'datestamp': '2017-04-27T06:16:19Z'} in json_records
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import pstats
+import tempfile
+import time
+
+from foist import profiling
+
+
+def _work():
+    return sum(i * i for i in range(100000))
+
+
+def test_profiler_writes_pstats_and_summary():
+    path = os.path.join(tempfile.mkdtemp(), 'foist.pstats')
+    profiler = profiling.Profiler(top=5).start()
+    _work()
+    profiler.stop()
+    profiler.write(path)
+    stats = pstats.Stats(path)
+    assert any(f[2] == '_work' for f in stats.stats)
+    with open(path + '.txt') as f:
+        assert '_work' in f.read()
+
+
+def test_sampler_samples_other_threads():
+    path = os.path.join(tempfile.mkdtemp(), 'foist.stacks')
+    sampler = profiling.Sampler(top=5, interval=0.001).start()
+    end = time.monotonic() + 0.1
+    while time.monotonic() < end:
+        _work()
+    sampler.stop()
+    sampler.write(path)
+    assert sampler.samples
+    with open(path) as f:
+        assert '_work (test_profiling.py' in f.read()
+    with open(path + '.txt') as f:
+        assert 'samples of all threads' in f.read()
+
+
+def test_sample_threads_switches_profiler_to_sampler(monkeypatch):
+    monkeypatch.setattr(profiling, 'profiler',
+                        profiling.Profiler(top=5).start())
+    profiling.sample_threads(False)
+    assert isinstance(profiling.profiler, profiling.Profiler)
+    profiling.sample_threads(True)
+    assert isinstance(profiling.profiler, profiling.Sampler)
+    assert profiling.profiler.top == 5
+    profiling.profiler.stop()
+
+
+def test_stage_memory_records_peaks():
+    profiling.stage_memory = profiling.StageMemory().start()
+    try:
+        with profiling.memory('get_metadata'):
+            data = bytearray(1024 * 1024)
+            del data
+        with profiling.memory('commit'):
+            pass
+    finally:
+        stage_memory, profiling.stage_memory = profiling.stage_memory, None
+        stage_memory.stop()
+    assert stage_memory.peaks['get_metadata'] > 1000 * 1000
+    assert stage_memory.peaks['commit'] < 1000 * 1000
+    assert stage_memory.summary().splitlines()[1].endswith('get_metadata')
+
+
+def test_stage_memory_keeps_peaks_of_enclosing_stages():
+    profiling.stage_memory = profiling.StageMemory().start()
+    try:
+        with profiling.memory('upload_thesis'):
+            data = bytearray(10 * 1024 * 1024)
+            del data
+            with profiling.memory('commit'):
+                pass
+    finally:
+        stage_memory, profiling.stage_memory = profiling.stage_memory, None
+        stage_memory.stop()
+    assert stage_memory.peaks['upload_thesis'] > 10 * 1000 * 1000
+    assert stage_memory.peaks['commit'] < 1000 * 1000
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+
+from click.testing import CliRunner
+import pytest
+import requests
+from tika import tika
+
+from foist.cli import main
+from tests.servers import DSpaceServer, FedoraServer, TikaServer
+
+
+@pytest.yield_fixture
+def fedora_server():
+    with FedoraServer() as server:
+        yield server
+
+
+@pytest.yield_fixture
+def dspace_server():
+    with DSpaceServer(count=5, page_size=2, pdf_size=1024) as server:
+        yield server
+
+
+@pytest.yield_fixture
+def tika_standin():
+    endpoint = tika.ServerEndpoint
+    with TikaServer() as server:
+        tika.ServerEndpoint = server.url
+        yield server
+    tika.ServerEndpoint = endpoint
+
+
+def test_fedora_server_commits_transactions(fedora_server):
+    r = requests.post(fedora_server.url + 'fcr:tx')
+    assert r.status_code == 201
+    tx = r.headers['Location']
+    r = requests.put(tx + '/theses/item', data=b'<> a <urn:x> .',
+                     headers={'Content-Type': 'text/turtle'})
+    assert r.status_code == 201
+    assert requests.head(fedora_server.url + 'theses/item').status_code == 404
+    assert requests.head(tx + '/theses/item').status_code == 200
+    r = requests.post(tx + '/fcr:tx/fcr:commit')
+    assert r.status_code == 204
+    assert requests.head(fedora_server.url + 'theses/item').status_code == 200
+    assert requests.post(tx + '/fcr:tx/fcr:commit').status_code == 410
+
+
+def test_fedora_server_rolls_back_transactions(fedora_server):
+    tx = requests.post(fedora_server.url + 'fcr:tx').headers['Location']
+    requests.put(tx + '/theses/item', data=b'')
+    assert requests.post(tx + '/fcr:tx/fcr:rollback').status_code == 204
+    assert requests.head(fedora_server.url + 'theses/item').status_code == 404
+
+
+def test_fedora_server_returns_409_for_existing_resources(fedora_server):
+    assert requests.put(fedora_server.url + 'item/').status_code == 201
+    assert requests.put(fedora_server.url + 'item').status_code == 409
+
+
+def test_fedora_server_describes_files_and_digests(fedora_server):
+    item = fedora_server.url + 'item'
+    requests.put(item, data=b'<> a <urn:x> .',
+                 headers={'Content-Type': 'text/turtle'})
+    requests.put(item + '/item.pdf', data=b'PDF',
+                 headers={'Content-Type': 'application/pdf'})
+    r = requests.patch(item, data=('PREFIX pcdm: <http://pcdm.org/models#> '
+                                   'INSERT { <> pcdm:hasFile <%s/item.pdf> . '
+                                   '} WHERE { }' % item))
+    assert r.status_code == 204
+    assert '<http://pcdm.org/models#hasFile> <%s/item.pdf>' % item in \
+        requests.get(item).text
+    assert 'urn:sha1:%s' % hashlib.sha1(b'PDF').hexdigest() in \
+        requests.get(item + '/item.pdf/fcr:metadata').text
+    assert requests.get(item + '/item.pdf').content == b'PDF'
+
+
+def test_standin_injects_errors_and_counts_connections():
+    with FedoraServer(error_rate=1.0) as server:
+        with requests.Session() as s:
+            assert s.head(server.url).status_code == 503
+            assert s.head(server.url).status_code == 503
+    assert server.counts == {'requests': 2, 'connections': 1}
+
+
+def test_dspace_server_pages_identifiers(dspace_server):
+    params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'mets'}
+    r = requests.get(dspace_server.url, params=params)
+    assert r.text.count('<header>') == 2
+    token = r.text.split('completeListSize="5">')[1].split('<')[0]
+    r = requests.get(dspace_server.url, params={'verb': 'ListIdentifiers',
+                                                'resumptionToken': token})
+    assert '1721.1/100002' in r.text
+
+
+def test_dspace_server_filters_identifiers_by_date(dspace_server):
+    params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'mets',
+              'from': '2017-01-02'}
+    r = requests.get(dspace_server.url, params=params)
+    assert '<header>' not in r.text
+
+
+def test_dspace_server_serves_records_and_bitstreams(dspace_server):
+    r = requests.get(dspace_server.url, params={
+        'verb': 'GetRecord', 'metadataPrefix': 'mets',
+        'identifier': 'oai:dspace.mit.edu:1721.1/100003'})
+    pdf = dspace_server.base_url + '/bitstream/1721.1/100003/1/'
+    assert pdf in r.text
+    assert len(requests.get(pdf + 'thesis.pdf').content) == 1024
+
+
+def test_batch_upload_against_fedora_server(fedora_server, theses_dir,
+                                            caplog):
+    directory = tempfile.mkdtemp()
+    for name in ('thesis', 'thesis-03'):
+        shutil.copytree(os.path.join(theses_dir, name),
+                        os.path.join(directory, name))
+    result = CliRunner().invoke(main, ['--log-file', '',
+                                       'batch_upload_theses', directory,
+                                       '-f', fedora_server.url, '-w', '4'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses ingested.' in caplog.text
+    assert 'theses/thesis/thesis.pdf' in fedora_server.resources
+    assert not fedora_server.transactions
+
+
+def test_ingest_against_standin_servers(fedora_server, tika_standin,
+                                        caplog):
+    with DSpaceServer(count=3, page_size=3, pdf_size=1024) as dspace:
+        result = CliRunner().invoke(main, [
+            '--log-file', '', 'ingest_new_theses', dspace.url,
+            'oai:dspace.mit.edu:1721.1/', '-f', fedora_server.url, '-w',
+            '2'])
+    assert result.exit_code == 0
+    assert '3 theses added to Fedora' in caplog.text
+    assert 'theses/1721.1-100001/1721.1-100001.txt' in \
+        fedora_server.resources
+
+
+def test_asyncio_backend_against_standin_servers(fedora_server, theses_dir,
+                                                 tika_standin, caplog):
+    pytest.importorskip('aiohttp')
+    directory = tempfile.mkdtemp()
+    for name in ('thesis', 'thesis-03'):
+        shutil.copytree(os.path.join(theses_dir, name),
+                        os.path.join(directory, name))
+    result = CliRunner().invoke(main, ['--log-file', '',
+                                       'batch_upload_theses', directory,
+                                       '-f', fedora_server.url, '-w', '4',
+                                       '--backend', 'asyncio'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 2 theses ingested.' in caplog.text
+    with DSpaceServer(count=3, page_size=2, pdf_size=1024) as dspace:
+        result = CliRunner().invoke(main, [
+            '--log-file', '', 'ingest_new_theses', dspace.url,
+            'oai:dspace.mit.edu:1721.1/', '-f', fedora_server.url, '-w',
+            '8', '--backend', 'asyncio', '--parallel-files'])
+    assert result.exit_code == 0
+    assert '3 theses added to Fedora' in caplog.text
+    assert 'theses/1721.1-100002/1721.1-100002.txt' in \
+        fedora_server.resources
+    assert not fedora_server.transactions
+
+
+def test_verify_against_fedora_server(fedora_server, theses_dir, caplog):
+    directory = tempfile.mkdtemp()
+    for name in ('thesis', 'thesis-03'):
+        shutil.copytree(os.path.join(theses_dir, name),
+                        os.path.join(directory, name))
+    requests.put(fedora_server.url + 'theses',
+                 headers={'Content-Type': 'text/turtle'})
+    CliRunner().invoke(main, ['--log-file', '', 'batch_upload_theses',
+                              directory, '-f', fedora_server.url])
+    with open(os.path.join(directory, 'thesis', 'thesis.pdf'), 'ab') as f:
+        f.write(b'changed')
+    shutil.copytree(os.path.join(theses_dir, 'thesis-02'),
+                    os.path.join(directory, 'thesis-02'))
+    report = os.path.join(tempfile.mkdtemp(), 'report.json')
+    result = CliRunner().invoke(main, ['--log-file', '', 'verify',
+                                       directory, '-o', report, '-f',
+                                       fedora_server.url, '-w', '2'])
+    assert result.exit_code == 0
+    assert 'TOTAL: 1 of 3 theses verified' in caplog.text
+    with open(report) as f:
+        report = json.load(f)
+    assert report['results'] == {'Verified': 1, 'Missing': 1, 'Failed': 1}
+    assert report['failures'] == [
+        {'name': 'thesis', 'result': 'Failed',
+         'files': {'thesis.pdf': 'Digest mismatch'}},
+        {'name': 'thesis-02', 'result': 'Missing', 'files': {}}]
+
+
+def test_harvest_daemon_advances_watermark(fedora_server, tika_standin,
+                                           caplog):
+    state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    args = ['--log-file', '', 'harvest_daemon', None,
+            'oai:dspace.mit.edu:1721.1/', '-s', state_file, '-f',
+            fedora_server.url, '-w', '2', '--once']
+    with DSpaceServer(count=3, page_size=2, pdf_size=1024) as dspace:
+        args[3] = dspace.url
+        result = CliRunner().invoke(main, args)
+        assert result.exit_code == 0
+        assert '3 theses added to Fedora' in caplog.text
+        with open(state_file) as f:
+            assert json.load(f)['datestamp'] == dspace.datestamp(2)
+        result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0
+    assert '3 theses already in Fedora' in caplog.text
+
+
+@pytest.mark.parametrize('backend', ['threads', 'asyncio'])
+def test_harvest_daemon_holds_watermark_at_failed_record(
+        fedora_server, tika_standin, caplog, backend):
+    state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    with DSpaceServer(count=3, page_size=2, pdf_size=1024,
+                      forbidden=[1]) as dspace:
+        result = CliRunner().invoke(main, [
+            '--log-file', '', 'harvest_daemon', dspace.url,
+            'oai:dspace.mit.edu:1721.1/', '-s', state_file, '-f',
+            fedora_server.url, '-w', '2', '--once', '--backend', backend])
+    assert result.exit_code == 0
+    assert 'Harvest failed' not in caplog.text
+    assert '2 theses added to Fedora' in caplog.text
+    assert 'Thesis "1721.1-100001" upload failed' in caplog.text
+    with open(state_file) as f:
+        assert json.load(f)['datestamp'] == dspace.datestamp(1)
+
+
+def test_harvest_daemon_stops_listing_on_sigterm(fedora_server,
+                                                 tika_standin, caplog):
+    state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    with DSpaceServer(count=50, page_size=2, pdf_size=1024,
+                      latency=0.05) as dspace:
+        timer.start()
+        result = CliRunner().invoke(main, [
+            '--log-file', '', 'harvest_daemon', dspace.url,
+            'oai:dspace.mit.edu:1721.1/', '-s', state_file, '-f',
+            fedora_server.url, '-w', '2'])
+    timer.join()
+    assert result.exit_code == 0
+    assert 'Harvest stopped before all records were listed' in caplog.text
+    assert dspace.counts['requests'] < 50
+    assert not os.path.exists(state_file)
+
+
+def test_harvest_daemon_stops_on_sigterm(fedora_server, tika_standin,
+                                         caplog):
+    state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGTERM))
+    with DSpaceServer(count=1, pdf_size=1024) as dspace:
+        timer.start()
+        result = CliRunner().invoke(main, [
+            '--log-file', '', 'harvest_daemon', dspace.url,
+            'oai:dspace.mit.edu:1721.1/', '-s', state_file, '-f',
+            fedora_server.url, '-i', '3600'])
+    timer.join()
+    assert result.exit_code == 0
+    assert 'Harvest daemon stopped at watermark %s' % dspace.datestamp(0) \
+        in caplog.text
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import io
+import xml.etree.ElementTree as ET
+
+import rdflib
+import requests_mock
+
+from foist import Thesis
+from foist.namespaces import DCTERMS, LOCAL
+from foist.sync import (create_sparql_diff, DeltaStats, diff_metadata,
+                        file_digest, get_binary_digest, get_item_graph,
+                        sync_file, sync_thesis_metadata)
+
+ITEM_URI = 'mock://example.com/rest/theses/thesis'
+
+
+def _thesis_turtle(xml):
+    mets = ET.parse(xml).getroot()
+    return Thesis('thesis', mets, ['Department One']).get_metadata()
+
+
+def _fedora_turtle(turtle, extra=''):
+    g = rdflib.Graph()
+    g.parse(data=turtle, format='turtle', publicID=ITEM_URI)
+    return (g.serialize(format='turtle').decode('utf-8') + extra)
+
+
+def test_diff_metadata_ignores_unmanaged_statements(xml):
+    turtle = _thesis_turtle(xml)
+    extra = ('<%s> a <http://fedora.info/definitions/v4/repository#'
+             'Container> ; <http://pcdm.org/models#hasFile> <%s/f> .' %
+             (ITEM_URI, ITEM_URI))
+    current = rdflib.Graph()
+    current.parse(data=_fedora_turtle(turtle, extra), format='turtle')
+    assert diff_metadata(current, turtle, ITEM_URI) == (set(), set())
+
+
+def test_diff_metadata_finds_changed_statements(xml):
+    turtle = _thesis_turtle(xml)
+    current = rdflib.Graph()
+    current.parse(data=turtle, format='turtle', publicID=ITEM_URI)
+    current.remove((rdflib.URIRef(ITEM_URI), DCTERMS.title,
+                    rdflib.Literal('Sample Title.')))
+    current.add((rdflib.URIRef(ITEM_URI), LOCAL.obsolete,
+                 rdflib.Literal('x')))
+    current.add((rdflib.URIRef(ITEM_URI), DCTERMS.title,
+                 rdflib.Literal('Old Title.')))
+    deletes, inserts = diff_metadata(current, turtle, ITEM_URI)
+    assert deletes == {(DCTERMS.title, rdflib.Literal('Old Title.'))}
+    assert inserts == {(DCTERMS.title, rdflib.Literal('Sample Title.'))}
+
+
+def test_create_sparql_diff():
+    s = create_sparql_diff({(DCTERMS.title, rdflib.Literal('Old'))},
+                           {(DCTERMS.title, rdflib.Literal('New'))})
+    assert s == ('DELETE { <> <http://purl.org/dc/terms/title> "Old" . } '
+                 'INSERT { <> <http://purl.org/dc/terms/title> "New" . } '
+                 'WHERE { }')
+
+
+def test_get_item_graph(xml):
+    turtle = _thesis_turtle(xml)
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI, text=_fedora_turtle(turtle))
+        g = get_item_graph(ITEM_URI)
+    assert (rdflib.URIRef(ITEM_URI), DCTERMS.title,
+            rdflib.Literal('Sample Title.')) in g
+
+
+def test_sync_thesis_metadata_skips_unchanged_item(xml):
+    turtle = _thesis_turtle(xml)
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI, text=_fedora_turtle(turtle))
+        assert sync_thesis_metadata(ITEM_URI, turtle) == 'Unchanged'
+        assert [h.method for h in m.request_history] == ['GET']
+
+
+def test_sync_thesis_metadata_updates_changed_item(xml):
+    turtle = _thesis_turtle(xml)
+    old = _fedora_turtle(turtle).replace('Sample Title.', 'Old Title.')
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI, text=old)
+        m.patch(ITEM_URI, status_code=204)
+        assert sync_thesis_metadata(ITEM_URI, turtle) == 'Updated'
+        assert 'Old Title.' in m.request_history[-1].text
+
+
+def _binary_metadata(digest):
+    return ('<> <http://www.loc.gov/premis/rdf/v1#hasMessageDigest> '
+            '<urn:sha1:%s> .' % digest)
+
+
+def test_file_digest_of_path_and_file_object(pdf):
+    with open(pdf, 'rb') as f:
+        data = f.read()
+    expected = (hashlib.sha1(data).hexdigest(), len(data))
+    assert file_digest(pdf) == expected
+    assert file_digest(io.BytesIO(data)) == expected
+
+
+def test_get_binary_digest():
+    uri = ITEM_URI + '/thesis.pdf/'
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI + '/thesis.pdf/fcr:metadata',
+              text=_binary_metadata('abc123'))
+        assert get_binary_digest(uri) == 'abc123'
+        m.get(ITEM_URI + '/thesis.pdf/fcr:metadata', status_code=404)
+        assert get_binary_digest(uri) is None
+
+
+def test_sync_file_skips_unchanged_binary(pdf):
+    digest, size = file_digest(pdf)
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI + '/thesis.pdf/fcr:metadata',
+              text=_binary_metadata(digest))
+        r = sync_file('mock://example.com/rest/', 'theses', 'thesis', '.pdf',
+                      pdf, 'application/pdf', 'INSERT {} WHERE {}')
+        assert r == ('Unchanged', size)
+        assert [h.method for h in m.request_history] == ['GET']
+
+
+def test_sync_file_uploads_changed_and_missing_binaries(pdf):
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI + '/thesis.pdf/fcr:metadata',
+              text=_binary_metadata('abc123'))
+        m.put(ITEM_URI + '/thesis.pdf/', status_code=204)
+        r = sync_file('mock://example.com/rest/', 'theses', 'thesis', '.pdf',
+                      pdf, 'application/pdf', 'INSERT {} WHERE {}')
+        assert r[0] == 'Uploaded'
+        assert [h.method for h in m.request_history] == ['GET', 'PUT']
+
+    text = io.BytesIO(b'Some text.')
+    with requests_mock.Mocker() as m:
+        m.get(ITEM_URI + '/thesis.txt/fcr:metadata', status_code=404)
+        m.put(ITEM_URI + '/thesis.txt/', status_code=201)
+        m.patch(ITEM_URI + '/thesis.txt/fcr:metadata', status_code=204)
+        m.patch(ITEM_URI + '/', status_code=204)
+        r = sync_file('mock://example.com/rest/', 'theses', 'thesis', '.txt',
+                      text, 'text/plain', 'INSERT {} WHERE {}')
+        assert r == ('Uploaded', 10)
+        assert 'pcdm:hasFile <%s/thesis.txt/>' % ITEM_URI in \
+            m.request_history[-1].text
+
+
+def test_delta_stats_counts_files():
+    stats = DeltaStats()
+    stats.add('Unchanged', 100)
+    stats.add('Uploaded', 5)
+    assert str(stats) == ('1 files unchanged (100 bytes skipped), 1 files '
+                          'uploaded (5 bytes)')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import os
+import tempfile
+
+import pytest
+
+from foist import tracing
+
+
+@pytest.yield_fixture
+def tracer():
+    tracing.tracer = tracing.Tracer()
+    yield tracing.tracer
+    tracing.tracer = None
+
+
+def test_span_without_tracer_records_nothing():
+    with tracing.span('get_metadata', handle='thesis') as args:
+        tracing.annotate(bytes=10)
+    assert args == {'handle': 'thesis'}
+
+
+def test_nested_spans_inherit_handle(tracer):
+    with tracing.span('thesis', handle='1721.1-108390'):
+        with tracing.span('GET', 'http', url='mock://example.com/') as span:
+            span['status'] = 200
+        with tracing.span('download_pdf'):
+            tracing.annotate(bytes=1024)
+    events = {e['name']: e for e in tracer.events}
+    assert events['GET']['args'] == {'handle': '1721.1-108390',
+                                     'url': 'mock://example.com/',
+                                     'status': 200}
+    assert events['GET']['cat'] == 'http'
+    assert events['download_pdf']['args']['bytes'] == 1024
+    assert events['thesis']['ts'] <= events['GET']['ts']
+    assert events['thesis']['dur'] >= events['download_pdf']['dur']
+
+
+def test_span_records_errors(tracer):
+    with pytest.raises(ValueError):
+        with tracing.span('extract_text'):
+            raise ValueError
+    assert tracer.events[0]['args'] == {'error': 'ValueError'}
+
+
+def test_tracer_writes_trace_event_file(tracer):
+    with tracing.span('thesis', handle='thesis'):
+        pass
+    path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    tracer.write(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert events[0]['ph'] == 'M'
+    assert events[1]['ph'] == 'X'
+    assert events[1]['name'] == 'thesis'
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import tempfile
+
+import pytest
+import requests
+
+from foist.verify import (get_item_files, list_container, verify_item,
+                          write_report)
+from tests.servers import FedoraServer
+
+
+@pytest.yield_fixture
+def fedora_server():
+    with FedoraServer() as server:
+        item = server.url + 'theses/thesis'
+        requests.put(server.url + 'theses',
+                     headers={'Content-Type': 'text/turtle'})
+        requests.put(item, headers={'Content-Type': 'text/turtle'})
+        requests.put(item + '/thesis.pdf', data=b'pdf',
+                     headers={'Content-Type': 'application/pdf'})
+        requests.patch(item, data=('INSERT { <> pcdm:hasFile <%s/thesis.pdf>'
+                                   ' . } WHERE { }' % item))
+        server.counts['requests'] = 0
+        yield server
+
+
+@pytest.fixture
+def pdf_file():
+    path = os.path.join(tempfile.mkdtemp(), 'thesis.pdf')
+    with open(path, 'wb') as f:
+        f.write(b'pdf')
+    return path
+
+
+def test_list_container_returns_contained_uris(fedora_server):
+    assert list_container(fedora_server.url + 'theses') == \
+        {fedora_server.url + 'theses/thesis'}
+    assert list_container(fedora_server.url + 'missing') is None
+
+
+def test_get_item_files_embeds_digests(fedora_server):
+    item = fedora_server.url + 'theses/thesis'
+    assert get_item_files(item) == {
+        item + '/thesis.pdf': hashlib.sha1(b'pdf').hexdigest()}
+    assert fedora_server.counts['requests'] == 1
+    assert get_item_files(item + '-02') is None
+
+
+def test_verify_item_checks_links_and_digests(fedora_server, pdf_file):
+    item = fedora_server.url + 'theses/thesis'
+    files = {item + '/thesis.pdf': pdf_file}
+    assert verify_item(item, files) == ('Verified', {})
+    assert verify_item(item, files, exists=False) == ('Missing', {})
+    files[item + '/thesis.txt'] = pdf_file + '.txt'
+    assert verify_item(item, files) == ('Failed', {pdf_file + '.txt':
+                                                   'Not linked'})
+    with open(pdf_file, 'wb') as f:
+        f.write(b'changed')
+    assert verify_item(item, {item + '/thesis.pdf': pdf_file}) == \
+        ('Failed', {pdf_file: 'Digest mismatch'})
+
+
+def test_write_report_writes_json():
+    path = os.path.join(tempfile.mkdtemp(), 'report.json')
+    write_report(path, {'results': {'Verified': 1}})
+    with open(path) as f:
+        assert json.load(f) == {'results': {'Verified': 1}}
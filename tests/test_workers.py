@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+
+from foist.workers import (AdaptiveLimiter, Backoff, map_concurrent,
+                           Progress, TokenBucket)
+
+
+def test_map_concurrent_returns_all_results():
+    results = dict(map_concurrent(lambda x: x * 2, range(10), workers=4))
+    assert results == {i: i * 2 for i in range(10)}
+
+
+def test_map_concurrent_single_worker_keeps_order():
+    results = list(map_concurrent(lambda x: x, [3, 1, 2]))
+    assert results == [(3, 3), (1, 1), (2, 2)]
+
+
+def test_map_concurrent_takes_items_as_workers_free_up():
+    taken = []
+
+    def _items():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    results = map_concurrent(lambda x: x, _items(), workers=4)
+    next(results)
+    assert len(taken) <= 5
+    assert len(dict(results)) == 99
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(50, capacity=1)
+    start = time.monotonic()
+    for i in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_progress_reports_throughput_and_eta(caplog):
+    progress = Progress(4, 'theses', interval=0)
+    progress.update(2)
+    assert progress.done == 2
+    assert progress.eta is not None
+    assert '2/4 theses done' in caplog.text
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    backoff = Backoff(base=1, cap=5)
+    for attempt in range(1, 10):
+        assert 0 <= backoff.delay(attempt) <= min(5, 2 ** attempt)
+
+
+def test_adaptive_limiter_increases_on_success():
+    limiter = AdaptiveLimiter(10, initial=2)
+    for i in range(20):
+        limiter.observe('http://fedora/rest/x', 0.1, 201)
+    assert limiter.limit > 2
+
+
+def test_adaptive_limiter_halves_on_errors():
+    limiter = AdaptiveLimiter(10, initial=8)
+    for i in range(8):
+        limiter.observe('http://fedora/rest/x', 0.1, 503)
+    assert limiter.limit == 4
+    for i in range(20):
+        limiter.observe('http://fedora/rest/x', None, None)
+    assert limiter.limit == 1
+
+
+def test_adaptive_limiter_reacts_to_latency():
+    limiter = AdaptiveLimiter(10, initial=4)
+    for i in range(4):
+        limiter.observe('http://fedora/rest/x', 0.1, 201)
+    for i in range(20):
+        limiter.observe('http://fedora/rest/x', 2.0, 201)
+    assert limiter.limit < 4
+
+
+def test_adaptive_limiter_ignores_other_hosts():
+    limiter = AdaptiveLimiter(10, initial=4, url_prefix='http://fedora/')
+    limiter.observe('http://dspace/oai', 0.1, 503)
+    assert limiter.limit == 4
+
+
+def test_map_concurrent_with_limiter():
+    limiter = AdaptiveLimiter(4, initial=2)
+    results = dict(map_concurrent(lambda x: x + 1, range(10), 4, limiter))
+    assert results == {i: i + 1 for i in range(10)}
+    assert limiter.active == 0
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import tempfile
+import threading
+
+import pytest
+
+from foist.workqueue import drain, WorkQueue
+
+
+@pytest.fixture
+def queue_file():
+    return os.path.join(tempfile.mkdtemp(), 'queue.db')
+
+
+def test_work_queue_claims_largest_first(queue_file):
+    with WorkQueue(queue_file) as q:
+        assert q.put([('a', 10, None), ('b', 800, {'x': 1}),
+                      ('c', 200, None)]) == 3
+        assert q.put([('b', 800, None)]) == 0
+        claimed = [q.claim() for i in range(4)]
+    assert [t.name for t in claimed[:3]] == ['b', 'c', 'a']
+    assert claimed[0].payload == {'x': 1}
+    assert claimed[3] is None
+
+
+def test_work_queue_hands_over_expired_leases(queue_file):
+    crashed = WorkQueue(queue_file, lease=0, worker='crashed')
+    crashed.put([('a', 1, None)])
+    assert crashed.claim().name == 'a'
+    with WorkQueue(queue_file, worker='other') as q:
+        task = q.claim()
+        assert task.attempts == 2
+        q.complete(task, 'Success')
+        assert q.counts() == {'done': 1}
+        assert q.results() == [('a', 'Success')]
+    crashed.close()
+
+
+def test_work_queue_fails_items_after_max_attempts(queue_file):
+    with WorkQueue(queue_file, lease=0, max_attempts=2) as q:
+        q.put([('a', 1, None)])
+        assert q.claim().attempts == 1
+        assert q.claim().attempts == 2
+        assert q.claim() is None
+        assert q.results('failed') == [('a', 'Expired')]
+
+
+def test_work_queue_releases_and_renews_leases(queue_file):
+    with WorkQueue(queue_file) as q:
+        q.put([('a', 1, None)])
+        task = q.claim()
+        assert q.claim() is None
+        q.renew()
+        q.release(task)
+        assert q.claim().name == 'a'
+
+
+def test_drain_shares_work_between_workers(queue_file):
+    queues = [WorkQueue(queue_file, worker=str(i)) for i in range(2)]
+    queues[0].put([(str(i), i, None) for i in range(50)])
+    seen = [[], []]
+
+    def _drain(i):
+        for task, result in drain(queues[i], lambda t: t.name, workers=2):
+            seen[i].append(result)
+
+    threads = [threading.Thread(target=_drain, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(seen[0] + seen[1], key=int) == [str(i) for i in range(50)]
+    assert queues[0].counts() == {'done': 50}
+    for q in queues:
+        q.close()
+
+
+def test_drain_releases_task_and_raises_on_error(queue_file):
+    def _fail(task):
+        raise ValueError(task.name)
+
+    with WorkQueue(queue_file) as q:
+        q.put([('a', 1, None)])
+        with pytest.raises(ValueError):
+            list(drain(q, _fail))
+        assert q.counts() == {'pending': 1}
+
+
+def test_drain_marks_failed_results_failed(queue_file):
+    with WorkQueue(queue_file) as q:
+        q.put([('a', 1, None), ('b', 1, None)])
+        results = dict((t.name, r) for t, r in drain(
+            q, lambda t: 'Failure' if t.name == 'b' else 'Success',
+            failed=lambda r: r == 'Failure'))
+        assert results == {'a': 'Success', 'b': 'Failure'}
+        assert q.counts() == {'done': 1, 'failed': 1}
+        assert q.results('failed') == [('b', 'Failure')]
+        assert q.put([('b', 1, None)]) == 0
+        assert q.put([('a', 1, None), ('b', 1, None)],
+                     retry_failed=True) == 1
+        task = q.claim()
+        assert task.name == 'b' and task.attempts == 1
+        assert q.claim() is None